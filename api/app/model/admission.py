@@ -0,0 +1,120 @@
+import asyncio
+import time
+
+from .. import settings
+
+
+class AdmissionController:
+    """
+    Estimates how long a new job would wait in the queue, to turn requests
+    away right away instead of letting them time out.
+
+    Every `interval` seconds at most, the depth of the queues and the
+    counter of jobs the ML service took off them (`PROCESSED_KEY`) are read
+    in a single round trip. The drain rate is a moving average of the
+    counter increase over time, only updated while there is work, so an idle
+    spell doesn't hide the capacity of the workers. The estimated wait of a
+    lane is the number of jobs ahead of it divided by that rate: interactive
+    jobs only queue behind interactive ones, bulk jobs behind both.
+
+    Requests finding the sample stale at the same time share a single
+    sampling task, created within the event loop serving them.
+    """
+
+    def __init__(self, db, budget, interval, smoothing):
+        self.db = db
+        self.budget = budget
+        self.interval = interval
+        self.smoothing = smoothing
+        self.depths = {}
+        self.rate = None
+        self.sampled = None
+        self.processed = None
+        self.sampling = None
+        self.counters = {"admitted": 0, "rejected": 0}
+
+    def _queues(self):
+        if settings.QUEUE_TRANSPORT == "stream":
+            return settings.PRIORITY_STREAMS
+        return settings.PRIORITY_QUEUES
+
+    async def _sample(self):
+        pipe = self.db.pipeline(transaction=False)
+        queues = self._queues()
+        for name in queues.values():
+            if settings.QUEUE_TRANSPORT == "stream":
+                pipe.xlen(name)
+            else:
+                pipe.llen(name)
+        pipe.get(settings.PROCESSED_KEY)
+        *depths, processed = await pipe.execute()
+        now = time.monotonic()
+
+        self.depths = dict(zip(queues, depths))
+        processed = int(processed or 0)
+        if self.processed is not None and now > self.sampled:
+            drained = max(processed - self.processed, 0)
+            if drained or any(depths):
+                rate = drained / (now - self.sampled)
+                if self.rate is None:
+                    self.rate = rate
+                else:
+                    self.rate += self.smoothing * (rate - self.rate)
+        self.processed = processed
+        self.sampled = now
+
+    async def estimate(self, priority="interactive"):
+        """
+        Seconds a job pushed now would wait before the ML service takes it.
+
+        Args:
+            priority (str): Priority lane of the job, "interactive" or "bulk".
+
+        Returns:
+            float: The estimate, 0 until the drain rate is known and infinite
+                   if jobs are waiting but none is being taken.
+        """
+        if self.sampled is None or time.monotonic() - self.sampled >= self.interval:
+            loop = asyncio.get_running_loop()
+            if (
+                self.sampling is None
+                or self.sampling.done()
+                or self.sampling.get_loop() is not loop
+            ):
+                self.sampling = loop.create_task(self._sample())
+            # Shielded, a cancelled request doesn't cancel the others' sample
+            await asyncio.shield(self.sampling)
+
+        ahead = self.depths.get("interactive", 0)
+        if priority != "interactive":
+            ahead += sum(d for lane, d in self.depths.items() if lane != "interactive")
+        if not ahead or self.rate is None:
+            return 0.0
+        if self.rate <= 0:
+            return float("inf")
+        return ahead / self.rate
+
+    async def admit(self, priority="interactive"):
+        """
+        Whether a job would be answered within the wait budget.
+
+        Args:
+            priority (str): Priority lane of the job, "interactive" or "bulk".
+
+        Returns:
+            tuple(bool, float): Admission and estimated wait in seconds.
+        """
+        wait = await self.estimate(priority)
+        admitted = wait <= self.budget
+        self.counters["admitted" if admitted else "rejected"] += 1
+        return admitted, wait
+
+    def stats(self):
+        """
+        Admission counters of this API worker process and the last sample.
+
+        Returns:
+            dict: Counters, queue depths and drain rate in jobs per second.
+        """
+        rate = round(self.rate, 2) if self.rate is not None else None
+        return {**self.counters, "depths": self.depths, "rate": rate}
@@ -0,0 +1,173 @@
+import json
+import time
+from collections import OrderedDict
+
+from .. import settings
+
+
+class PredictionCache:
+    """
+    Two-tier cache of model outputs keyed by the uploaded file content hash.
+
+    The first tier is a bounded LRU local to the API worker process, the
+    second one is shared by every API worker: one Redis key per content,
+    `<CACHE_PREFIX>:<model version>:<md5>`, expiring `ttl` seconds after it
+    was written.
+
+    The ML service publishes the version of the model it serves under
+    `MODEL_VERSION_KEY`. When it changes, the local LRU is dropped and
+    lookups move to the keys of the new version, so a new model never serves
+    predictions of the previous one. `invalidate` bumps the counter under
+    `CACHE_GENERATION_KEY`, read along with the version, so every worker
+    drops its LRU too. LRU entries expire after `ttl` seconds, as the shared
+    ones do.
+    """
+
+    def __init__(self, db, maxsize, ttl, refresh):
+        self.db = db
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.refresh = refresh
+        self.lru = OrderedDict()
+        self.version = settings.MODEL_VERSION
+        self.generation = None
+        self.checked = None
+        self.counters = {"lru_hits": 0, "redis_hits": 0, "misses": 0}
+
+    async def current_version(self):
+        """
+        Model version currently served, re-read from Redis every `refresh`
+        seconds at most along with the cache generation. The LRU is dropped
+        when either one changed.
+        """
+        now = time.monotonic()
+        if self.checked is None or now - self.checked >= self.refresh:
+            self.checked = now
+            version, generation = await self.db.mget(
+                settings.MODEL_VERSION_KEY, settings.CACHE_GENERATION_KEY
+            )
+            if version is not None:
+                version = version.decode("utf-8")
+                if version != self.version:
+                    self.lru.clear()
+                    self.version = version
+            generation = int(generation or 0)
+            if generation != self.generation:
+                self.lru.clear()
+                self.generation = generation
+        return self.version
+
+    async def _prefix(self):
+        return f"{settings.CACHE_PREFIX}:{await self.current_version()}"
+
+    @staticmethod
+    def _field(image_name):
+        # Same content uploaded with another extension is still a hit
+        return image_name.split(".", 1)[0]
+
+    async def get(self, image_name):
+        """
+        Look up the output of a previous prediction for this content.
+
+        Args:
+            image_name (str): Upload name, `<md5>.<ext>`.
+
+        Returns:
+            dict: The cached model output, or None on a miss.
+        """
+        found = await self.lookup(image_name)
+        return found[1] if found is not None else None
+
+    async def lookup(self, image_name):
+        """
+        Same as `get`, also returning the upload name the output was stored
+        for, which has the extension of the original upload.
+
+        Args:
+            image_name (str): Upload name, `<md5>.<ext>`, or the MD5 alone.
+
+        Returns:
+            tuple(str, dict): Upload name and cached model output, or None on
+                              a miss.
+        """
+        prefix = await self._prefix()
+        field = self._field(image_name)
+
+        entry = self.lru.get(field)
+        if entry is not None:
+            expires, entry = entry
+            if time.monotonic() < expires:
+                self.lru.move_to_end(field)
+                self.counters["lru_hits"] += 1
+                return entry
+            del self.lru[field]
+
+        entry = await self.db.get(f"{prefix}:{field}")
+        if entry is None:
+            self.counters["misses"] += 1
+            return None
+
+        output = json.loads(entry.decode("utf-8"))
+        entry = (output.pop("image_name", None), output)
+        self._remember(field, entry)
+        self.counters["redis_hits"] += 1
+        return entry
+
+    async def put(self, image_name, output):
+        """
+        Store a model output in both tiers.
+
+        Args:
+            image_name (str): Upload name, `<md5>.<ext>`.
+            output (dict): Model output as written by the ML service.
+        """
+        prefix = await self._prefix()
+        field = self._field(image_name)
+
+        await self.db.set(
+            f"{prefix}:{field}",
+            json.dumps({**output, "image_name": image_name}),
+            ex=self.ttl,
+        )
+        self._remember(field, (image_name, output))
+
+    async def invalidate(self):
+        """
+        Drop every cached prediction of the current model version.
+
+        The keys are found with SCAN, which walks the whole keyspace: meant
+        for operators, not for the request path. The cache generation is
+        bumped first, so other API workers drop their LRU within `refresh`
+        seconds.
+
+        Returns:
+            int: Number of shared entries dropped.
+        """
+        self.generation = await self.db.incr(settings.CACHE_GENERATION_KEY)
+        self.lru.clear()
+        dropped = 0
+        keys = []
+        match = f"{await self._prefix()}:*"
+        async for key in self.db.scan_iter(match=match, count=1000):
+            keys.append(key)
+            if len(keys) >= 1000:
+                dropped += await self.db.unlink(*keys)
+                keys = []
+        if keys:
+            dropped += await self.db.unlink(*keys)
+        return dropped
+
+    def stats(self):
+        """
+        Hit/miss counters of this API worker process.
+
+        Returns:
+            dict: Counters plus the model version and LRU size.
+        """
+        return {**self.counters, "version": self.version, "size": len(self.lru)}
+
+    def _remember(self, field, entry):
+        self.lru[field] = (time.monotonic() + self.ttl, entry)
+        self.lru.move_to_end(field)
+        while len(self.lru) > self.maxsize:
+            self.lru.popitem(last=False)
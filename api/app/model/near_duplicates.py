@@ -0,0 +1,152 @@
+import json
+import time
+
+from PIL import Image
+
+from .. import settings
+
+HASH_BITS = 64
+
+
+def dhash(source):
+    """
+    Difference hash of an image: 64 bits telling whether each pixel of a
+    9x8 grayscale thumbnail is brighter than its right neighbour.
+
+    Re-encoding, resizing or stripping metadata barely changes it, so copies
+    of the same picture end up a few bits apart.
+
+    Args:
+        source (file): Image file, read from its current position.
+
+    Returns:
+        int: The hash, None if the file is not a readable image.
+    """
+    try:
+        with Image.open(source) as img:
+            # JPEGs decode at a fraction of their size, plenty for 9x8
+            img.draft("L", (64, 64))
+            pixels = img.convert("L").resize((9, 8), Image.BILINEAR).tobytes()
+    except Exception:
+        return None
+
+    value = 0
+    for row in range(8):
+        for col in range(8):
+            left, right = pixels[row * 9 + col], pixels[row * 9 + col + 1]
+            value = (value << 1) | (left > right)
+    return value
+
+
+def hamming(a, b):
+    return bin(a ^ b).count("1")
+
+
+class NearDuplicateIndex:
+    """
+    Recent perceptual hashes and their model outputs, shared in Redis by
+    every API worker, to reuse the prediction of an image already seen in
+    another encoding or size.
+
+    The 64 bits of a hash are split in `max_distance + 1` bands, each band
+    value indexing a Redis set of the hashes that have it. Two hashes at
+    most `max_distance` bits apart agree on at least one band, so looking
+    up the sets of the bands of an upload finds every candidate without
+    scanning the index.
+
+    Keys are named after the model version, like in `PredictionCache`. The
+    output of each hash has its own key, expiring `ttl` seconds after it was
+    written. Band sets belong to a time bucket of `ttl` seconds and are only
+    written to while it is the current one, so they expire at most
+    `2 * ttl` seconds after it started. Lookups read the sets of the
+    current and previous buckets, which hold every hash written in the last
+    `ttl` seconds at least.
+    """
+
+    def __init__(self, db, max_distance, ttl, version):
+        self.db = db
+        self.max_distance = max_distance
+        self.ttl = ttl
+        self.version = version
+        bands = max_distance + 1
+        edges = [HASH_BITS * i // bands for i in range(bands + 1)]
+        self.bands = list(zip(edges[:-1], edges[1:]))
+        self.counters = {"hits": 0, "misses": 0}
+
+    async def _prefix(self):
+        return f"{settings.NEAR_DUPLICATE_PREFIX}:{await self.version()}"
+
+    def _bucket(self):
+        return int(time.time() // self.ttl)
+
+    def _band_keys(self, prefix, bucket, value):
+        keys = []
+        for i, (start, end) in enumerate(self.bands):
+            band = (value >> start) & ((1 << (end - start)) - 1)
+            keys.append(f"{prefix}:{bucket}:band:{i}:{band:x}")
+        return keys
+
+    async def get(self, value):
+        """
+        Output of the closest indexed image within `max_distance` bits.
+
+        Args:
+            value (int): Perceptual hash of the upload.
+
+        Returns:
+            dict: Model output, or None if no indexed image is close enough.
+        """
+        prefix = await self._prefix()
+        bucket = self._bucket()
+        pipe = self.db.pipeline(transaction=False)
+        for recent in (bucket, bucket - 1):
+            for key in self._band_keys(prefix, recent, value):
+                pipe.smembers(key)
+        candidates = {
+            int(member, 16) for members in await pipe.execute() for member in members
+        }
+
+        distances = {other: hamming(value, other) for other in candidates}
+        close = sorted(
+            (other for other, d in distances.items() if d <= self.max_distance),
+            key=distances.get,
+        )
+        if close:
+            # The output of the closest one may have expired already
+            outputs = await self.db.mget(
+                [f"{prefix}:output:{other:x}" for other in close]
+            )
+            for output in outputs:
+                if output is not None:
+                    self.counters["hits"] += 1
+                    return json.loads(output.decode("utf-8"))
+
+        self.counters["misses"] += 1
+        return None
+
+    async def put(self, value, output):
+        """
+        Index the output of an image under its perceptual hash.
+
+        Args:
+            value (int): Perceptual hash of the image.
+            output (dict): Model output as written by the ML service.
+        """
+        prefix = await self._prefix()
+        pipe = self.db.pipeline()
+        for key in self._band_keys(prefix, self._bucket(), value):
+            pipe.sadd(key, f"{value:x}")
+            pipe.expire(key, 2 * self.ttl)
+        pipe.set(f"{prefix}:output:{value:x}", json.dumps(output), ex=self.ttl)
+        await pipe.execute()
+
+    def stats(self):
+        """
+        Hit/miss counters of this API worker process.
+
+        Returns:
+            dict: Counters plus the hit rate.
+        """
+        lookups = self.counters["hits"] + self.counters["misses"]
+        hit_rate = self.counters["hits"] / lookups if lookups else 0.0
+        return {**self.counters, "hit_rate": round(hit_rate, 4)}
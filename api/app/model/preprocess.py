@@ -0,0 +1,42 @@
+from PIL import Image
+
+from .. import settings
+
+# Model input size and the byte length of its uint8 RGB pixels
+INPUT_SIZE = (224, 224)
+TENSOR_BYTES = INPUT_SIZE[0] * INPUT_SIZE[1] * 3
+
+
+def load_tensor(source):
+    """
+    Decodes an image and resizes it to the model input, exactly like
+    `load_image` of the ML service: header checked against
+    `MAX_IMAGE_PIXELS`, JPEGs decoded in draft mode if `FAST_DECODE`,
+    converted to RGB and resized with nearest neighbour.
+
+    Args:
+        source (file): Image file, read from its current position.
+
+    Returns:
+        bytes: Raw RGB pixels, 224x224x3 uint8 in row-major order.
+
+    Raises:
+        ValueError: If the image is too large or can't be decoded.
+    """
+    try:
+        with Image.open(source) as img:
+            width, height = img.size
+            if width * height > settings.MAX_IMAGE_PIXELS:
+                raise ValueError(
+                    f"Image of {width}x{height} pixels exceeds the "
+                    f"{settings.MAX_IMAGE_PIXELS} pixels limit"
+                )
+            if settings.FAST_DECODE and img.format == "JPEG":
+                img.draft("RGB", (settings.DECODE_MIN_SIZE, settings.DECODE_MIN_SIZE))
+            if img.mode != "RGB":
+                img = img.convert("RGB")
+            if img.size != INPUT_SIZE:
+                img = img.resize(INPUT_SIZE, Image.NEAREST)
+            return img.tobytes()
+    except (OSError, Image.DecompressionBombError) as exc:
+        raise ValueError(f"Could not decode the image: {exc}") from exc
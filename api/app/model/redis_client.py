@@ -0,0 +1,36 @@
+import asyncio
+
+import redis.asyncio as redis
+
+
+class LoopRedis:
+    """
+    Redis client of the running event loop, behaving as a `redis.Redis`.
+
+    The connection pool holds asyncio primitives that, on Python < 3.10,
+    bind to the event loop current when they are created. Built at import,
+    they would belong to a loop gunicorn's worker never runs, and the first
+    request waiting for a free connection would fail. The pool and client
+    are instead created on first use from within a loop, and again if the
+    loop changes.
+
+    Args:
+        **kwargs: Arguments of `redis.BlockingConnectionPool`.
+    """
+
+    def __init__(self, **kwargs):
+        self.kwargs = kwargs
+        self.loop = None
+        self.pool = None
+        self.client = None
+
+    def _client(self):
+        loop = asyncio.get_running_loop()
+        if self.client is None or self.loop is not loop:
+            self.pool = redis.BlockingConnectionPool(**self.kwargs)
+            self.client = redis.Redis(connection_pool=self.pool)
+            self.loop = loop
+        return self.client
+
+    def __getattr__(self, name):
+        return getattr(self._client(), name)
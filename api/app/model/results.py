@@ -0,0 +1,130 @@
+import asyncio
+import json
+import logging
+import os
+import socket
+
+from .. import settings
+
+logger = logging.getLogger(__name__)
+
+
+class ResultListener:
+    """
+    Hands the job outputs the ML service publishes to the coroutines of this
+    API worker waiting for them.
+
+    Every job carries the reply channel of the API worker that pushed it,
+    "<RESULTS_CHANNEL>:<host>:<pid>", and the ML service publishes the
+    output there once done. A single pub/sub connection serves every
+    in-flight job of the worker, so waiting costs a future and no Redis
+    connection or polling. The outputs are also stored under the job ID,
+    which covers results published while the subscription was down.
+
+    Jobs submitted through the asynchronous API answer on `JOBS_CHANNEL`
+    instead, heard by every API worker, as their results may be awaited
+    from any of them and by several clients at once.
+    """
+
+    def __init__(self, db):
+        self.db = db
+        self.channel = None
+        self.waiters = {}
+        self.task = None
+        self.loop = None
+        self.subscribed = None
+
+    async def start(self):
+        """
+        Subscribe to the reply channel, once per process and event loop.
+        """
+        loop = asyncio.get_running_loop()
+        if self.task is None or self.task.done() or self.loop is not loop:
+            self.loop = loop
+            # Computed here, gunicorn may import the app before forking
+            self.channel = (
+                f"{settings.RESULTS_CHANNEL}:{socket.gethostname()}:{os.getpid()}"
+            )
+            self.subscribed = asyncio.Event()
+            self.task = loop.create_task(self._listen())
+        await self.subscribed.wait()
+
+    async def _listen(self):
+        while True:
+            pubsub = self.db.pubsub(ignore_subscribe_messages=True)
+            try:
+                await pubsub.subscribe(self.channel, settings.JOBS_CHANNEL)
+                self.subscribed.set()
+                await self._recover()
+                async for message in pubsub.listen():
+                    data = json.loads(message["data"])
+                    self._deliver(data["id"], data["output"])
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Lost the subscription to %s", self.channel)
+                await asyncio.sleep(1)
+            finally:
+                await pubsub.reset()
+
+    async def _recover(self):
+        # Outputs published before (re)subscribing were missed
+        for job_id in list(self.waiters):
+            output = await self.db.get(job_id)
+            if output is not None:
+                self._deliver(job_id, json.loads(output))
+
+    def _deliver(self, job_id, output):
+        for future in self.waiters.pop(job_id, ()):
+            if not future.done():
+                future.set_result(output)
+
+    def register(self, job_id):
+        """
+        Start expecting the output of a job, before pushing it so a fast
+        answer can't be missed.
+
+        Args:
+            job_id (str): ID of the job.
+
+        Returns:
+            asyncio.Future: Resolved with the model output.
+        """
+        future = self.loop.create_future()
+        self.waiters.setdefault(job_id, []).append(future)
+        return future
+
+    def discard(self, job_id, future):
+        """
+        Stop expecting the output of a job for a future of `register`.
+        """
+        futures = self.waiters.get(job_id, [])
+        if future in futures:
+            futures.remove(future)
+        if not futures:
+            self.waiters.pop(job_id, None)
+
+    async def wait(self, job_id, future, timeout):
+        """
+        Wait for the output of a registered job.
+
+        Args:
+            job_id (str): ID of the job.
+            future (asyncio.Future): As returned by `register`.
+            timeout (float): Seconds to wait.
+
+        Returns:
+            dict: Model output.
+
+        Raises:
+            TimeoutError: If the ML service doesn't answer in time.
+        """
+        try:
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            output = await self.db.get(job_id)
+            if output is None:
+                raise TimeoutError("Model prediction timed out")
+            return json.loads(output)
+        finally:
+            self.discard(job_id, future)
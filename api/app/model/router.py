@@ -1,21 +1,229 @@
+import hashlib
+import math
 import os
-from typing import List
+from functools import partial
+from typing import List, Optional
+from uuid import UUID
 
 from app import db
 from app import settings as config
 from app import utils
 from app.auth.jwt import get_current_user
-from app.model.schema import PredictRequest, PredictResponse
-from app.model.services import model_predict
-from fastapi import APIRouter, Depends, File, HTTPException, UploadFile, status
+from app.model.near_duplicates import dhash
+from app.model.preprocess import load_tensor
+from app.model.schema import (
+    BatchPredictItem,
+    BatchPredictResponse,
+    JobStatus,
+    PredictRequest,
+    PredictResponse,
+    Priority,
+    SimilarResponse,
+    SubmitResponse,
+)
+from app.model.services import (
+    admission,
+    cache,
+    has_tensor,
+    job_status,
+    model_predict,
+    model_predict_batch,
+    model_predict_by_hash,
+    model_similar,
+    near_duplicates,
+    prediction_etag,
+    singleflight,
+    store_image,
+    store_tensor,
+    submit_jobs,
+    watch_jobs,
+)
+from fastapi import (
+    APIRouter,
+    BackgroundTasks,
+    Depends,
+    File,
+    Header,
+    HTTPException,
+    Path,
+    Query,
+    Response,
+    UploadFile,
+    status,
+)
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
 from sqlalchemy.orm import Session
 
 router = APIRouter(tags=["Model"], prefix="/model")
 
 
+async def save_upload(file, background_tasks):
+    """
+    Validates an uploaded image and makes it available to the ML service,
+    on disk or in Redis depending on `IMAGE_TRANSPORT`.
+
+    Args:
+        file (UploadFile): Uploaded image.
+        background_tasks (BackgroundTasks): Tasks run after answering.
+
+    Returns:
+        str: Upload name, `<md5>.<ext>`.
+
+    Raises:
+        HTTPException: 400 if the file type is not supported, 413 if the file
+                       is over `MAX_UPLOAD_BYTES`.
+    """
+    if file is None or not file.filename or not utils.allowed_file(file.filename):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="File type is not supported.",
+        )
+
+    upload_dir = getattr(config, "UPLOAD_FOLDER", "uploads")
+    os.makedirs(upload_dir, exist_ok=True)
+
+    try:
+        if config.IMAGE_TRANSPORT == "redis":
+            # The ML service reads the bytes from Redis, the copy on disk is
+            # only kept for the record and can be written after answering
+            await file.seek(0)
+            content = await file.read(config.MAX_UPLOAD_BYTES + 1)
+            if len(content) > config.MAX_UPLOAD_BYTES:
+                raise utils.UploadTooLarge()
+            new_filename = utils.upload_name(
+                hashlib.md5(content).hexdigest(), file.filename
+            )
+            await store_image(new_filename, content)
+            dest_path = os.path.join(upload_dir, new_filename)
+            if config.PERSIST_UPLOADS and not os.path.exists(dest_path):
+                background_tasks.add_task(utils.save_file, dest_path, content)
+        else:
+            # Hashed while copied, the content is never held in memory
+            new_filename = await run_in_threadpool(
+                utils.spool_upload,
+                file.file,
+                file.filename,
+                upload_dir,
+                config.MAX_UPLOAD_BYTES,
+            )
+    except utils.UploadTooLarge:
+        raise HTTPException(
+            status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            detail=f"Files must be at most {config.MAX_UPLOAD_BYTES} bytes.",
+        )
+
+    if config.PREPROCESS_IN_API:
+        await preprocess_upload(file, new_filename)
+
+    return new_filename
+
+
+async def preprocess_upload(file, image_name):
+    """
+    Decodes an upload to the model input in the threadpool and stores the
+    pixels for the ML service, unless a previous upload already did.
+
+    Args:
+        file (UploadFile): Uploaded image.
+        image_name (str): Upload name, `<md5>.<ext>`.
+    """
+    if await has_tensor(image_name):
+        return
+
+    await file.seek(0)
+    try:
+        tensor = await run_in_threadpool(load_tensor, file.file)
+    except ValueError:
+        # Sent as it is, the ML service answers it with an error output
+        return
+    await store_tensor(image_name, tensor)
+
+
+async def save_uploads(files, background_tasks):
+    """
+    Validates and saves the images of a multi-file upload, see `save_upload`.
+
+    Args:
+        files (list): Uploaded images.
+        background_tasks (BackgroundTasks): Tasks run after answering.
+
+    Returns:
+        list: Per file, in order, a (upload name, error) pair, the upload
+              name being None if the file was rejected.
+
+    Raises:
+        HTTPException: 413 past `BATCH_MAX_FILES` files or `BATCH_MAX_BYTES`
+                       bytes.
+    """
+    if len(files) > config.BATCH_MAX_FILES:
+        raise HTTPException(
+            status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            detail=f"At most {config.BATCH_MAX_FILES} files per batch.",
+        )
+
+    total_bytes = sum(utils.file_size(file.file) for file in files)
+    if total_bytes > config.BATCH_MAX_BYTES:
+        raise HTTPException(
+            status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            detail=f"At most {config.BATCH_MAX_BYTES} bytes per batch.",
+        )
+
+    saved = []
+    for file in files:
+        try:
+            saved.append((await save_upload(file, background_tasks), None))
+        except HTTPException as exc:
+            saved.append((None, exc.detail))
+    return saved
+
+
+async def admit(response, priority):
+    """
+    Turns a request away right away if the job it is about to push would
+    wait more than `ADMISSION_WAIT_BUDGET` seconds in the queue, see
+    `AdmissionController`. The estimated wait is sent in the
+    "X-Estimated-Wait" header.
+
+    Passed to the model services, which only call it when a job is pushed:
+    requests answered from the cache are never turned away nor counted.
+
+    Args:
+        response (Response): Response of the request.
+        priority (str): Priority lane of the job, "interactive" or "bulk".
+
+    Raises:
+        HTTPException: 503 with a "Retry-After" header if the ML service is
+                       too far behind.
+    """
+    if not config.ADMISSION_CONTROL:
+        return
+
+    admitted, wait = await admission.admit(priority)
+    estimate = f"{wait:.1f}"
+    if not admitted:
+        # Roughly when the backlog is back within the budget
+        overshoot = wait - config.ADMISSION_WAIT_BUDGET
+        retry_after = overshoot if math.isfinite(wait) else config.ADMISSION_WAIT_BUDGET
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="The model service is overloaded, try again later",
+            headers={
+                "Retry-After": str(max(1, math.ceil(retry_after))),
+                "X-Estimated-Wait": estimate,
+            },
+        )
+    response.headers["X-Estimated-Wait"] = estimate
+
+
 @router.post("/predict")
 async def predict(
-    file: UploadFile = File(None), current_user=Depends(get_current_user)
+    background_tasks: BackgroundTasks,
+    response: Response,
+    file: UploadFile = File(None),
+    top_k: int = Query(1, ge=1, le=config.MAX_TOP_K),
+    priority: Priority = Priority.interactive,
+    current_user=Depends(get_current_user),
 ):
     rpse = {
         "success": False,
@@ -24,24 +232,22 @@ async def predict(
         "image_file_name": None,
     }
 
-    if file is None or not file.filename or not utils.allowed_file(file.filename):
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail="File type is not supported.",
-        )
-
-    new_filename = await utils.get_file_hash(file)
-    upload_dir = getattr(config, "UPLOAD_FOLDER", "uploads")
-    os.makedirs(upload_dir, exist_ok=True)
-    dest_path = os.path.join(upload_dir, new_filename)
+    new_filename = await save_upload(file, background_tasks)
 
-    if not os.path.exists(dest_path):
-        content = await file.read()
-        with open(dest_path, "wb") as f:
-            f.write(content)
+    phash = None
+    if config.NEAR_DUPLICATES:
+        # Straight from the spooled file, the upload isn't read in memory
+        await file.seek(0)
+        phash = await run_in_threadpool(dhash, file.file)
 
     try:
-        prediction, score = await model_predict(new_filename)
+        output = await model_predict(
+            new_filename,
+            top_k,
+            priority.value,
+            phash,
+            admit=partial(admit, response, priority.value),
+        )
     except TimeoutError:
         raise HTTPException(
             status_code=status.HTTP_504_GATEWAY_TIMEOUT,
@@ -51,9 +257,237 @@ async def predict(
     rpse.update(
         {
             "success": True,
-            "prediction": prediction,
-            "score": score,
+            "prediction": output["prediction"],
+            "score": output["score"],
             "image_file_name": new_filename,
+            "top_k": output.get("top_k"),
         }
     )
+    # Failed predictions aren't cached, asking again may succeed
+    if output["prediction"] != "error":
+        digest = new_filename.split(".", 1)[0]
+        response.headers["ETag"] = await prediction_etag(digest, top_k)
     return PredictResponse(**rpse)
+
+
+@router.get("/predict/{md5}")
+async def predict_by_hash(
+    response: Response,
+    md5: str = Path(..., regex="^[0-9a-fA-F]{32}$"),
+    top_k: int = Query(1, ge=1, le=config.MAX_TOP_K),
+    priority: Priority = Priority.interactive,
+    if_none_match: Optional[str] = Header(None),
+    current_user=Depends(get_current_user),
+):
+    """
+    Prediction for an image already sent, from the MD5 of its content, so
+    clients don't upload it again. Answers 304 if the client has it already.
+    """
+    digest = md5.lower()
+    etag = await prediction_etag(digest, top_k)
+    if utils.etag_matches(if_none_match, etag):
+        return Response(
+            status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag}
+        )
+
+    try:
+        found = await model_predict_by_hash(
+            digest,
+            top_k,
+            priority.value,
+            admit=partial(admit, response, priority.value),
+        )
+    except TimeoutError:
+        raise HTTPException(
+            status_code=status.HTTP_504_GATEWAY_TIMEOUT,
+            detail="Model prediction timed out",
+        )
+    if found is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Unknown image, upload it to /model/predict",
+        )
+
+    image_name, output = found
+    if output["prediction"] != "error":
+        response.headers["ETag"] = etag
+    return PredictResponse(
+        success=True,
+        prediction=output["prediction"],
+        score=output["score"],
+        image_file_name=image_name,
+        top_k=output.get("top_k"),
+    )
+
+
+@router.post("/predict/batch")
+async def predict_batch(
+    background_tasks: BackgroundTasks,
+    response: Response,
+    files: List[UploadFile] = File(...),
+    top_k: int = Query(1, ge=1, le=config.MAX_TOP_K),
+    priority: Priority = Priority.interactive,
+    current_user=Depends(get_current_user),
+):
+    items = [
+        BatchPredictItem(
+            filename=file.filename,
+            success=False,
+            image_file_name=image_file_name,
+            error=error,
+        )
+        for file, (image_file_name, error) in zip(
+            files, await save_uploads(files, background_tasks)
+        )
+    ]
+
+    uploaded = [item for item in items if item.image_file_name is not None]
+    outputs = await model_predict_batch(
+        [item.image_file_name for item in uploaded],
+        top_k,
+        priority.value,
+        admit=partial(admit, response, priority.value),
+    )
+
+    for item, output in zip(uploaded, outputs):
+        if isinstance(output, TimeoutError):
+            item.error = "Model prediction timed out"
+        elif output["prediction"] == "error":
+            item.error = "Could not process the image"
+        else:
+            item.success = True
+            item.prediction = output["prediction"]
+            item.score = output["score"]
+            item.top_k = output.get("top_k")
+
+    return BatchPredictResponse(results=items)
+
+
+@router.post("/jobs", status_code=status.HTTP_202_ACCEPTED)
+async def submit(
+    background_tasks: BackgroundTasks,
+    files: List[UploadFile] = File(...),
+    top_k: int = Query(1, ge=1, le=config.MAX_TOP_K),
+    priority: Priority = Priority.interactive,
+    current_user=Depends(get_current_user),
+):
+    saved = await save_uploads(files, background_tasks)
+    image_names = [image_name for image_name, _ in saved if image_name is not None]
+    job_ids = iter(await submit_jobs(image_names, top_k, priority.value))
+
+    return SubmitResponse(
+        jobs=[
+            {
+                "filename": file.filename,
+                "job_id": next(job_ids) if image_name is not None else None,
+                "image_file_name": image_name,
+                "error": error,
+            }
+            for file, (image_name, error) in zip(files, saved)
+        ]
+    )
+
+
+@router.get("/jobs/events")
+async def job_events(
+    job_id: List[UUID] = Query(...),
+    current_user=Depends(get_current_user),
+):
+    """
+    Server-sent events with the status of each job once it is over.
+    """
+
+    async def events():
+        async for job in watch_jobs(
+            [str(i) for i in job_id],
+            config.JOB_STREAM_TIMEOUT,
+            config.JOB_STREAM_HEARTBEAT,
+        ):
+            if job is None:
+                yield ": keep-alive\n\n"
+            else:
+                yield f"event: job\ndata: {JobStatus(**job).json()}\n\n"
+        yield "event: end\ndata: {}\n\n"
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@router.get("/jobs/{job_id}", response_model=JobStatus)
+async def get_job(job_id: UUID, current_user=Depends(get_current_user)):
+    job = await job_status(str(job_id))
+    if job is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Job not found or its result expired",
+        )
+    return job
+
+
+@router.post("/similar")
+async def similar(
+    background_tasks: BackgroundTasks,
+    response: Response,
+    file: UploadFile = File(None),
+    k: int = Query(5, ge=1, le=config.MAX_SIMILAR_K),
+    priority: Priority = Priority.interactive,
+    current_user=Depends(get_current_user),
+):
+    new_filename = await save_upload(file, background_tasks)
+
+    try:
+        output = await model_similar(
+            new_filename,
+            k,
+            priority.value,
+            admit=partial(admit, response, priority.value),
+        )
+    except TimeoutError:
+        raise HTTPException(
+            status_code=status.HTTP_504_GATEWAY_TIMEOUT,
+            detail="Model prediction timed out",
+        )
+
+    if output["prediction"] == "error":
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail="Could not compute the image embedding",
+        )
+
+    return SimilarResponse(
+        success=True,
+        prediction=output["prediction"],
+        score=output["score"],
+        image_file_name=new_filename,
+        similar=[
+            {"image_hash": image_hash, "score": score}
+            for image_hash, score in output["similar"]
+        ],
+    )
+
+
+@router.get("/cache")
+async def cache_stats(current_user=Depends(get_current_user)):
+    return {
+        **cache.stats(),
+        "near_duplicates": near_duplicates.stats(),
+        "singleflight": singleflight.stats(),
+        "admission": admission.stats(),
+    }
+
+
+@router.delete("/cache", status_code=status.HTTP_204_NO_CONTENT)
+async def invalidate_cache(current_user=Depends(get_current_user)):
+    """
+    Operator endpoint dropping every cached prediction of the served model,
+    only allowed to the users listed in `CACHE_ADMINS`.
+    """
+    if current_user.email not in config.CACHE_ADMINS:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Only operators can empty the cache",
+        )
+    await cache.invalidate()
@@ -1,4 +1,15 @@
-from pydantic import BaseModel
+from enum import Enum
+from typing import List, Optional, Tuple
+
+from pydantic import BaseModel, validator
+
+# Decimals of the scores returned to clients
+SCORE_DECIMALS = 4
+
+
+class Priority(str, Enum):
+    interactive = "interactive"
+    bulk = "bulk"
 
 
 class PredictRequest(BaseModel):
@@ -10,3 +21,63 @@ class PredictResponse(BaseModel):
     prediction: str
     score: float
     image_file_name: str
+    top_k: Optional[List[Tuple[str, float]]] = None
+
+    @validator("score")
+    def round_score(cls, score):
+        return round(score, SCORE_DECIMALS)
+
+
+class BatchPredictItem(BaseModel):
+    filename: Optional[str]
+    success: bool
+    prediction: Optional[str] = None
+    score: Optional[float] = None
+    image_file_name: Optional[str] = None
+    top_k: Optional[List[Tuple[str, float]]] = None
+    error: Optional[str] = None
+
+
+class BatchPredictResponse(BaseModel):
+    results: List[BatchPredictItem]
+
+
+class JobState(str, Enum):
+    queued = "queued"
+    done = "done"
+    failed = "failed"
+    expired = "expired"
+    unknown = "unknown"
+
+
+class SubmittedJob(BaseModel):
+    filename: Optional[str]
+    job_id: Optional[str] = None
+    image_file_name: Optional[str] = None
+    error: Optional[str] = None
+
+
+class SubmitResponse(BaseModel):
+    jobs: List[SubmittedJob]
+
+
+class JobStatus(BaseModel):
+    job_id: str
+    status: JobState
+    image_file_name: Optional[str] = None
+    prediction: Optional[str] = None
+    score: Optional[float] = None
+    top_k: Optional[List[Tuple[str, float]]] = None
+
+
+class SimilarImage(BaseModel):
+    image_hash: str
+    score: float
+
+
+class SimilarResponse(BaseModel):
+    success: bool
+    prediction: str
+    score: float
+    image_file_name: str
+    similar: List[SimilarImage]
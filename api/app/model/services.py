@@ -1,46 +1,603 @@
+import asyncio
+import hashlib
 import json
+import os
 import time
 from uuid import uuid4
 
-import redis
+from fastapi.concurrency import run_in_threadpool
 
-from .. import settings
+from .. import settings, utils
+from .admission import AdmissionController
+from .cache import PredictionCache
+from .near_duplicates import NearDuplicateIndex
+from .redis_client import LoopRedis
+from .results import ResultListener
+from .singleflight import SingleFlight
 
-db = redis.Redis(
+# Shared by every request of the API worker, commands never block the event
+# loop and waiting for a job holds no connection. Past REDIS_MAX_CONNECTIONS
+# commands wait for a free connection instead of failing. The pool is only
+# created once the worker runs its event loop, see `LoopRedis`
+db = LoopRedis(
     host=settings.REDIS_IP,
     port=settings.REDIS_PORT,
     db=settings.REDIS_DB_ID,
+    max_connections=settings.REDIS_MAX_CONNECTIONS,
+    timeout=settings.API_SLEEP_TIMEOUT,
 )
+results = ResultListener(db)
+
+cache = PredictionCache(
+    db,
+    maxsize=settings.CACHE_LRU_SIZE,
+    ttl=settings.CACHE_TTL,
+    refresh=settings.CACHE_VERSION_REFRESH,
+)
+
+near_duplicates = NearDuplicateIndex(
+    db,
+    max_distance=settings.NEAR_DUPLICATE_DISTANCE,
+    ttl=settings.NEAR_DUPLICATE_TTL,
+    version=cache.current_version,
+)
+
+singleflight = SingleFlight(db, results, ttl=settings.API_SLEEP_TIMEOUT)
+
+admission = AdmissionController(
+    db,
+    budget=settings.ADMISSION_WAIT_BUDGET,
+    interval=settings.ADMISSION_INTERVAL,
+    smoothing=settings.ADMISSION_SMOOTHING,
+)
+
+
+async def store_image(image_name, content):
+    """
+    Stores the raw bytes of an upload in Redis for the ML service to read,
+    used with the "redis" image transport.
+
+    Args:
+        image_name (str): Upload name, `<md5>.<ext>`.
+        content (bytes): Image file content.
+    """
+    await db.set(
+        f"{settings.IMAGE_KEY_PREFIX}:{image_name}", content, ex=settings.IMAGE_TTL
+    )
+
+
+async def store_tensor(image_name, tensor):
+    """
+    Stores the model-sized pixels of an upload in Redis for the ML service to
+    skip decoding it, used with `PREPROCESS_IN_API`.
+
+    Args:
+        image_name (str): Upload name, `<md5>.<ext>`.
+        tensor (bytes): Raw pixels, as returned by `preprocess.load_tensor`.
+    """
+    await db.set(tensor_key(image_name), tensor, ex=settings.IMAGE_TTL)
+
+
+async def has_tensor(image_name):
+    """
+    Whether the model-sized pixels of an upload are already in Redis.
+    """
+    return bool(await db.exists(tensor_key(image_name)))
+
+
+def tensor_key(image_name):
+    return f"{settings.TENSOR_KEY_PREFIX}:{image_name}"
+
+
+async def enqueue(job_data, priority="interactive"):
+    """
+    Pushes a job to the ML service through the transport selected by
+    `QUEUE_TRANSPORT`.
+
+    Args:
+        job_data (dict): Job payload.
+        priority (str): Priority lane of the job, "interactive" or "bulk".
+    """
+    await _push(db, job_data, priority)
+
+
+async def enqueue_many(jobs, priority="interactive"):
+    """
+    Pushes several jobs to the ML service in a single round trip.
+
+    Args:
+        jobs (list): Job payloads.
+        priority (str): Priority lane of the jobs, "interactive" or "bulk".
+    """
+    pipe = db.pipeline(transaction=False)
+    for job_data in jobs:
+        _push(pipe, job_data, priority)
+    await pipe.execute()
+
+
+def _push(client, job_data, priority):
+    """
+    Queue command for a job, on the client or a pipeline of it.
+    """
+    job_json = json.dumps(job_data)
+    if settings.QUEUE_TRANSPORT == "stream":
+        return client.xadd(
+            settings.PRIORITY_STREAMS[priority],
+            {"job": job_json},
+            maxlen=settings.STREAM_MAXLEN,
+            approximate=True,
+        )
+    return client.lpush(settings.PRIORITY_QUEUES[priority], job_json)
 
 
-async def model_predict(image_name):
+async def model_predict(
+    image_name, top_k=1, priority="interactive", phash=None, admit=None
+):
+    """
+    Gets the prediction of the model for an uploaded image.
+
+    Cached outputs are returned right away, then the output of a near
+    duplicate of the image if `NEAR_DUPLICATES` is on. Otherwise a job is
+    pushed to the ML service queue and we wait for its result, unless a job
+    for the same content is already in flight and `SINGLEFLIGHT` is on.
+
+    Args:
+        image_name (str): Upload name, `<md5>.<ext>`.
+        top_k (int): Number of most likely classes to return in `top_k`.
+        priority (str): Priority lane of the job, "interactive" or "bulk".
+        phash (int): Perceptual hash of the image, see
+                     `near_duplicates.dhash`.
+        admit (callable): Coroutine function awaited right before pushing a
+                          job, raising to turn the request away.
+
+    Returns:
+        dict: Model output with "prediction" and "score", plus "top_k" with
+              the (class_name, score) pairs when top_k > 1.
+
+    Raises:
+        TimeoutError: If the ML service doesn't answer in time.
+    """
     print(f"Processing image {image_name}...")
-    prediction = None
-    score = None
 
-    job_id = str(uuid4())
+    output = await cache.get(image_name)
+    if _covers(output, top_k):
+        return _with_top_k(output, top_k)
+
+    use_near_duplicates = settings.NEAR_DUPLICATES and phash is not None
+    if use_near_duplicates:
+        output = await near_duplicates.get(phash)
+        if _covers(output, top_k):
+            await cache.put(image_name, output)
+            return _with_top_k(output, top_k)
+
+    job_data = new_job(image_name, priority)
+    if top_k > 1:
+        job_data["top_k"] = top_k
+
+    async def push():
+        if admit is not None:
+            await admit()
+        return await run_job(job_data, priority, shared=settings.SINGLEFLIGHT)
+
+    if settings.SINGLEFLIGHT:
+        output = await singleflight.run(image_name, top_k, job_data, push)
+    else:
+        output = await push()
+    if output["prediction"] != "error":
+        await cache.put(image_name, output)
+        if use_near_duplicates:
+            await near_duplicates.put(phash, output)
+
+    return _with_top_k(output, top_k)
+
+
+async def model_predict_by_hash(digest, top_k=1, priority="interactive", admit=None):
+    """
+    Gets the prediction of the model for an image the API already received,
+    from the MD5 of its content alone.
+
+    Cached outputs are returned right away. Otherwise, if the image is still
+    in `UPLOAD_FOLDER` (or in Redis with the "redis" image transport), it is
+    predicted as in `model_predict`.
+
+    Args:
+        digest (str): MD5 of the image content, in lowercase hex.
+        top_k (int): Number of most likely classes to return in `top_k`.
+        priority (str): Priority lane of the job, "interactive" or "bulk".
+        admit (callable): See `model_predict`.
+
+    Returns:
+        tuple(str, dict): Upload name, `<md5>.<ext>`, and model output as
+                          returned by `model_predict`. None if neither the
+                          prediction nor the image are known.
+
+    Raises:
+        TimeoutError: If the ML service doesn't answer in time.
+    """
+    found = await cache.lookup(digest)
+    # Entries cached before upload names were stored have no name
+    if found is not None and found[0] is not None and _covers(found[1], top_k):
+        image_name, output = found
+        return image_name, _with_top_k(output, top_k)
+
+    image_name = await find_upload(digest)
+    if image_name is None:
+        return None
+    output = await model_predict(image_name, top_k, priority, admit=admit)
+    return image_name, output
+
+
+async def find_upload(digest):
+    """
+    Upload name of an image the ML service can still read, from the MD5 of
+    its content.
+
+    With the "redis" image transport the ML service only gets the bytes
+    stored in Redis for `IMAGE_TTL` seconds. Once they expired, an upload
+    still on the disk of this API worker is stored again.
+
+    Args:
+        digest (str): MD5 of the image content, in lowercase hex.
+
+    Returns:
+        str: Upload name, `<md5>.<ext>`, or None if the image is gone.
+    """
+    names = [f"{digest}.{ext}" for ext in utils.ALLOWED_EXTENSIONS]
+    if settings.IMAGE_TRANSPORT == "redis":
+        pipe = db.pipeline(transaction=False)
+        for image_name in names:
+            pipe.exists(f"{settings.IMAGE_KEY_PREFIX}:{image_name}")
+        for image_name, exists in zip(names, await pipe.execute()):
+            if exists:
+                return image_name
+
+    for image_name in names:
+        path = os.path.join(settings.UPLOAD_FOLDER, image_name)
+        if os.path.exists(path):
+            if settings.IMAGE_TRANSPORT == "redis":
+                await store_image(
+                    image_name, await run_in_threadpool(utils.read_file, path)
+                )
+            return image_name
+    return None
+
+
+async def prediction_etag(digest, top_k=1):
+    """
+    ETag of the prediction for an image content: the output only depends on
+    the content, the number of classes and the served model version.
+
+    Args:
+        digest (str): MD5 of the image content, in lowercase hex.
+        top_k (int): Number of most likely classes returned in `top_k`.
+
+    Returns:
+        str: Quoted entity tag.
+    """
+    version = await cache.current_version()
+    tag = hashlib.md5(f"{version}:{digest}:{top_k}".encode("utf-8")).hexdigest()
+    return f'"{tag}"'
+
+
+async def model_predict_batch(image_names, top_k=1, priority="interactive", admit=None):
+    """
+    Gets the predictions of the model for several uploaded images at once.
+
+    Cached outputs are used as in `model_predict`. The other images are
+    pushed to the ML service queue in a single round trip, once per distinct
+    content, and their results are awaited concurrently.
+
+    Args:
+        image_names (list): Upload names, `<md5>.<ext>`.
+        top_k (int): Number of most likely classes to return in `top_k`.
+        priority (str): Priority lane of the jobs, "interactive" or "bulk".
+        admit (callable): See `model_predict`, awaited once if any job is
+                          pushed.
+
+    Returns:
+        list: Per image, in order, the model output as returned by
+              `model_predict`, or the TimeoutError if the ML service didn't
+              answer in time.
+    """
+    cached = await asyncio.gather(*(cache.get(name) for name in image_names))
+    outputs = {
+        name: _with_top_k(output, top_k)
+        for name, output in zip(image_names, cached)
+        if _covers(output, top_k)
+    }
+
+    jobs = {}
+    for image_name in image_names:
+        if image_name not in outputs and image_name not in jobs:
+            jobs[image_name] = new_job(image_name, priority)
+            if top_k > 1:
+                jobs[image_name]["top_k"] = top_k
+
+    if jobs and admit is not None:
+        await admit()
+    for image_name, output in zip(jobs, await run_jobs(list(jobs.values()), priority)):
+        if not isinstance(output, Exception):
+            if output["prediction"] != "error":
+                await cache.put(image_name, output)
+            output = _with_top_k(output, top_k)
+        outputs[image_name] = output
+
+    return [outputs[name] for name in image_names]
+
+
+async def model_similar(image_name, k=5, priority="interactive", admit=None):
+    """
+    Gets the prediction of the model for an uploaded image together with
+    the `k` most similar images the ML service has seen.
+
+    Args:
+        image_name (str): Upload name, `<md5>.<ext>`.
+        k (int): Number of similar images to return.
+        priority (str): Priority lane of the job, "interactive" or "bulk".
+        admit (callable): See `model_predict`.
+
+    Returns:
+        dict: Model output with "prediction", "score" and "similar", the
+              (content hash, cosine similarity) pairs of the nearest images.
+
+    Raises:
+        TimeoutError: If the ML service doesn't answer in time.
+    """
+    job_data = new_job(image_name, priority)
+    job_data["task"] = "similar"
+    job_data["k"] = k
+
+    if admit is not None:
+        await admit()
+    return await run_job(job_data, priority)
+
+
+def new_job(image_name, priority="interactive", timeout=None):
+    """
+    Builds the payload of a job for an uploaded image.
+
+    Args:
+        image_name (str): Upload name, `<md5>.<ext>`.
+        priority (str): Priority lane of the job, "interactive" or "bulk".
+        timeout (float): Seconds until the deadline of the job,
+                         `API_SLEEP_TIMEOUT` by default.
+
+    Returns:
+        dict: Job payload.
+    """
+    if timeout is None:
+        timeout = settings.API_SLEEP_TIMEOUT
+    now = time.time()
+    job_data = {
+        "id": str(uuid4()),
+        "image_name": image_name,
+        "priority": priority,
+        "enqueued_at": now,
+        "deadline": now + timeout,
+    }
+    if settings.IMAGE_TRANSPORT == "redis":
+        job_data["image_key"] = f"{settings.IMAGE_KEY_PREFIX}:{image_name}"
+    if settings.PREPROCESS_IN_API:
+        job_data["tensor_key"] = tensor_key(image_name)
+    return job_data
+
+
+async def run_job(job_data, priority="interactive", shared=False):
+    """
+    Pushes a job to the ML service and waits for its output, which is
+    published on the reply channel of this API worker.
+
+    Args:
+        job_data (dict): Job payload, as built by `new_job`.
+        priority (str): Priority lane of the job, "interactive" or "bulk".
+        shared (bool): Whether other API workers may wait for the job too,
+                       its output is then kept until it expires.
+
+    Returns:
+        dict: Model output.
+
+    Raises:
+        TimeoutError: If the ML service doesn't answer in
+                      `API_SLEEP_TIMEOUT` seconds.
+    """
+    await results.start()
+    job_id = job_data["id"]
+    job_data["reply_to"] = results.channel
+    future = results.register(job_id)
+
+    await enqueue(job_data, priority)
+    output = await results.wait(job_id, future, settings.API_SLEEP_TIMEOUT)
+    if not shared:
+        await db.delete(job_id)
+    return output
+
+
+async def run_jobs(jobs, priority="interactive"):
+    """
+    Pushes several jobs to the ML service in a single round trip and waits
+    for all their outputs concurrently.
+
+    Args:
+        jobs (list): Job payloads, as built by `new_job`.
+        priority (str): Priority lane of the jobs, "interactive" or "bulk".
+
+    Returns:
+        list: Per job, in order, the model output or the TimeoutError if the
+              ML service didn't answer in `API_SLEEP_TIMEOUT` seconds.
+    """
+    if not jobs:
+        return []
+
+    await results.start()
+    futures = []
+    for job_data in jobs:
+        job_data["reply_to"] = results.channel
+        futures.append(results.register(job_data["id"]))
+
+    await enqueue_many(jobs, priority)
+    outputs = await asyncio.gather(
+        *(
+            results.wait(job_data["id"], future, settings.API_SLEEP_TIMEOUT)
+            for job_data, future in zip(jobs, futures)
+        ),
+        return_exceptions=True,
+    )
+    await db.delete(*(job_data["id"] for job_data in jobs))
+    return outputs
+
+
+async def submit_jobs(image_names, top_k=1, priority="interactive"):
+    """
+    Submits uploaded images to the ML service without waiting for them.
+
+    Every image gets a job record, kept until its output expires, and the
+    jobs are pushed in a single round trip. Images with a cached prediction
+    are answered right away. Images and pixels stored in Redis for the ML
+    service are kept until the job deadline.
+
+    Args:
+        image_names (list): Upload names, `<md5>.<ext>`.
+        top_k (int): Number of most likely classes to return in `top_k`.
+        priority (str): Priority lane of the jobs, "interactive" or "bulk".
+
+    Returns:
+        list: Job IDs, in order.
+    """
+    cached = await asyncio.gather(*(cache.get(name) for name in image_names))
+
+    job_ids = []
+    pipe = db.pipeline(transaction=False)
+    for image_name, output in zip(image_names, cached):
+        job_data = new_job(image_name, priority, timeout=settings.JOB_TIMEOUT)
+        job_data["reply_to"] = settings.JOBS_CHANNEL
+        job_data["result_ttl"] = settings.JOB_RESULT_TTL
+        if top_k > 1:
+            job_data["top_k"] = top_k
+
+        job_id = job_data["id"]
+        record = {
+            "image_name": image_name,
+            "top_k": top_k,
+            "deadline": job_data["deadline"],
+        }
+        pipe.set(
+            f"{settings.JOB_KEY_PREFIX}:{job_id}",
+            json.dumps(record),
+            ex=int(settings.JOB_TIMEOUT) + settings.JOB_RESULT_TTL,
+        )
+        if _covers(output, top_k):
+            pipe.set(job_id, json.dumps(output), ex=settings.JOB_RESULT_TTL)
+        else:
+            # The image must outlive the job, stored for IMAGE_TTL only
+            for key in ("image_key", "tensor_key"):
+                if key in job_data:
+                    pipe.expire(job_data[key], int(settings.JOB_TIMEOUT))
+            _push(pipe, job_data, priority)
+        job_ids.append(job_id)
+
+    await pipe.execute()
+    return job_ids
+
+
+async def job_status(job_id):
+    """
+    Status of a job submitted with `submit_jobs`.
+
+    Args:
+        job_id (str): ID of the job.
+
+    Returns:
+        dict: "job_id", "image_file_name" and "status": "queued", "done",
+              "failed" if the image could not be processed or "expired" if
+              the ML service dropped the job. Done jobs also have the model
+              output. None if the job is unknown or its result expired.
+    """
+    record, output = await db.mget(f"{settings.JOB_KEY_PREFIX}:{job_id}", job_id)
+    if record is None:
+        return None
+
+    record = json.loads(record)
+    status = {
+        "job_id": job_id,
+        "image_file_name": record["image_name"],
+        "status": "queued",
+    }
+    if output is not None:
+        output = json.loads(output)
+        if output["prediction"] == "error":
+            status["status"] = "failed"
+        else:
+            status["status"] = "done"
+            status.update(_with_top_k(output, record["top_k"]))
+    elif record["deadline"] < time.time():
+        status["status"] = "expired"
+    return status
+
+
+async def watch_jobs(job_ids, timeout, heartbeat):
+    """
+    Follows jobs submitted with `submit_jobs` until all of them are over.
+
+    Args:
+        job_ids (list): IDs of the jobs.
+        timeout (float): Seconds to follow the jobs for.
+        heartbeat (float): Seconds of silence after which None is yielded.
 
-    job_data = {"id": job_id, "image_name": image_name}
+    Yields:
+        dict: Status of each job, as returned by `job_status`, once it is
+              over, or with status "unknown". Jobs still queued when
+              `timeout` runs out are yielded as such. None after `heartbeat`
+              seconds without news.
+    """
+    await results.start()
+    # Registered first, a result published while reading the statuses can't
+    # be missed
+    futures = {results.register(job_id): job_id for job_id in set(job_ids)}
+    try:
+        pending = set()
+        for future, job_id in futures.items():
+            status = await _job_status_or_unknown(job_id)
+            if status["status"] != "queued":
+                yield status
+            else:
+                pending.add(future)
 
-    db.lpush(settings.REDIS_QUEUE, json.dumps(job_data))
+        end = time.monotonic() + timeout
+        while pending and time.monotonic() < end:
+            wait = min(heartbeat, end - time.monotonic())
+            done, pending = await asyncio.wait(
+                pending, timeout=wait, return_when=asyncio.FIRST_COMPLETED
+            )
+            if not done and time.monotonic() < end:
+                yield None
+            for future in done:
+                yield await _job_status_or_unknown(futures[future])
 
-    start = time.monotonic()
-    timeout_s = getattr(settings, "API_SLEEP_TIMEOUT", 45)
+        for future in pending:
+            yield await _job_status_or_unknown(futures[future])
+    finally:
+        for future, job_id in futures.items():
+            results.discard(job_id, future)
 
-    while True:
-        output = db.get(job_id)
 
-        if output is not None:
-            output = json.loads(output.decode("utf-8"))
-            prediction = output["prediction"]
-            score = output["score"]
+async def _job_status_or_unknown(job_id):
+    status = await job_status(job_id)
+    return status or {"job_id": job_id, "status": "unknown"}
 
-            db.delete(job_id)
-            break
 
-        if time.monotonic() - start > timeout_s:
-            raise TimeoutError("Model prediction timed out")
+def _covers(output, top_k):
+    """
+    Whether a stored output has at least `top_k` classes.
+    """
+    return output is not None and (top_k == 1 or len(output.get("top_k", [])) >= top_k)
 
-        time.sleep(getattr(settings, "API_SLEEP", 0.1))
 
-    return prediction, score
+def _with_top_k(output, top_k):
+    """
+    Copy of a model output keeping `top_k` only when more than one class was
+    asked for, and at most that many classes.
+    """
+    result = {"prediction": output["prediction"], "score": output["score"]}
+    if top_k > 1 and "top_k" in output:
+        result["top_k"] = output["top_k"][:top_k]
+    return result
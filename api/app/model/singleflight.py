@@ -0,0 +1,148 @@
+import asyncio
+import json
+
+from .. import settings
+
+# Drops the marker if it is still the one of the owner, a newer owner may
+# have set its own once it expired, and hands over the followers to forward
+# the output to
+RELEASE_SCRIPT = """
+local followers = redis.call("smembers", KEYS[2])
+redis.call("del", KEYS[2])
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    redis.call("del", KEYS[1])
+end
+return followers
+"""
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent predictions of the same content into a single job.
+
+    The first request for a content hash owns the job, later ones wait for
+    its output instead of pushing their own. Within an API worker they share
+    the owner's future. Across workers, the owner holds a Redis marker with
+    the ID of its job for `ttl` seconds; other workers read it and wait for
+    that job through their `ResultListener`. The owner's job answers on the
+    owner's reply channel as any other, only workers following it add their
+    own channel to `<SINGLEFLIGHT_PREFIX>:followers:<job ID>`, and the owner
+    forwards them the output. Its output is also kept under the job ID until
+    it expires, for followers arriving once it was forwarded.
+
+    A job asked for fewer classes than a request needs is not shared with
+    it.
+    """
+
+    def __init__(self, db, results, ttl):
+        self.db = db
+        self.results = results
+        self.ttl = ttl
+        self.flights = {}
+        self.counters = {"owned": 0, "coalesced_local": 0, "coalesced_remote": 0}
+
+    @staticmethod
+    def _key(image_name):
+        # Same content uploaded with another extension is the same flight
+        return f"{settings.SINGLEFLIGHT_PREFIX}:{image_name.split('.', 1)[0]}"
+
+    async def run(self, image_name, top_k, job_data, run_job):
+        """
+        Gets the output of a job for an upload, sharing it with concurrent
+        requests for the same content.
+
+        Args:
+            image_name (str): Upload name, `<md5>.<ext>`.
+            top_k (int): Number of classes the request needs.
+            job_data (dict): Job payload, pushed if no job is in flight.
+            run_job (callable): Coroutine function pushing `job_data` and
+                                returning its output.
+
+        Returns:
+            dict: Model output.
+
+        Raises:
+            TimeoutError: If the ML service doesn't answer in time.
+        """
+        key = self._key(image_name)
+
+        flight = self.flights.get(key)
+        if flight is not None and flight[0] >= top_k:
+            self.counters["coalesced_local"] += 1
+            return await asyncio.shield(flight[1])
+
+        # Registered before talking to Redis, so concurrent requests of this
+        # worker wait here whichever worker ends up owning the job
+        flight = (top_k, asyncio.get_running_loop().create_future())
+        self.flights[key] = flight
+        owner = False
+        output = None
+        marker = json.dumps({"id": job_data["id"], "top_k": top_k})
+        try:
+            owner = await self.db.set(key, marker, nx=True, ex=int(self.ttl))
+            other = None if owner else await self.db.get(key)
+            if other is not None and json.loads(other)["top_k"] >= top_k:
+                self.counters["coalesced_remote"] += 1
+                output = await self._follow(json.loads(other)["id"])
+            else:
+                # Without a marker if the other flight needs fewer classes or
+                # just landed
+                self.counters["owned"] += 1
+                output = await run_job()
+            flight[1].set_result(output)
+            return output
+        except asyncio.CancelledError:
+            flight[1].cancel()
+            raise
+        except Exception as exc:
+            flight[1].set_exception(exc)
+            # Retrieved, asyncio won't complain if nobody else was waiting
+            flight[1].exception()
+            raise
+        finally:
+            if self.flights.get(key) is flight:
+                del self.flights[key]
+            if owner:
+                await self._release(key, marker, job_data["id"], output)
+
+    @staticmethod
+    def _followers_key(job_id):
+        return f"{settings.SINGLEFLIGHT_PREFIX}:followers:{job_id}"
+
+    async def _release(self, key, marker, job_id, output):
+        followers = await self.db.eval(
+            RELEASE_SCRIPT, 2, key, self._followers_key(job_id), marker
+        )
+        if followers and output is not None:
+            message = json.dumps({"id": job_id, "output": output})
+            pipe = self.db.pipeline(transaction=False)
+            for channel in followers:
+                pipe.publish(channel, message)
+            await pipe.execute()
+
+    async def _follow(self, job_id):
+        await self.results.start()
+        future = self.results.register(job_id)
+        pipe = self.db.pipeline(transaction=False)
+        pipe.sadd(self._followers_key(job_id), self.results.channel)
+        pipe.expire(self._followers_key(job_id), int(self.ttl))
+        await pipe.execute()
+        # The job may have been answered before following it
+        output = await self.db.get(job_id)
+        if output is not None:
+            self.results.discard(job_id, future)
+            return json.loads(output)
+        return await self.results.wait(job_id, future, self.ttl)
+
+    def stats(self):
+        """
+        Counters of this API worker process: jobs owned and requests that
+        waited for the job of another request, in this worker or another.
+
+        Returns:
+            dict: Counters plus the share of coalesced requests.
+        """
+        coalesced = self.counters["coalesced_local"] + self.counters["coalesced_remote"]
+        requests = self.counters["owned"] + coalesced
+        rate = coalesced / requests if requests else 0.0
+        return {**self.counters, "coalesced_rate": round(rate, 4)}
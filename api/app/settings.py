@@ -23,9 +23,106 @@ REDIS_PORT = 6379
 REDIS_DB_ID = 0
 # Host IP
 REDIS_IP = os.getenv("REDIS_IP", "redis")
-# Sleep parameters which manages the
-# interval between requests to our redis queue
-API_SLEEP = 0.05
+# Priority lanes, each one with its own queue drained by the ML service in
+# weighted order
+PRIORITY_QUEUES = {"interactive": REDIS_QUEUE, "bulk": f"{REDIS_QUEUE}:bulk"}
+# Job transport, must match the ML service: "list" or "stream" (Redis Streams
+# consumer group, jobs of a crashed worker are picked up by another one)
+QUEUE_TRANSPORT = os.getenv("QUEUE_TRANSPORT", "list")
+PRIORITY_STREAMS = {"interactive": "service_stream", "bulk": "service_stream:bulk"}
+# Approximate cap on each stream length, acknowledged entries are deleted by
+# the workers so this only bounds a backlog nobody consumes
+STREAM_MAXLEN = int(os.getenv("STREAM_MAXLEN", 100000))
+# Connections of the Redis pool shared by the requests of an API worker
+REDIS_MAX_CONNECTIONS = int(os.getenv("REDIS_MAX_CONNECTIONS", 50))
+# The ML service publishes job outputs on "<RESULTS_CHANNEL>:<host>:<pid>"
+# of the API worker waiting for them
+RESULTS_CHANNEL = "ml_service:results"
+# Seconds to wait for a prediction, jobs carry the matching deadline so the
+# ML service drops them once nobody waits for the result
+API_SLEEP_TIMEOUT = float(os.getenv("API_SLEEP_TIMEOUT", 45))
+# Admission control: predictions are turned away with a 503 when a new job
+# would wait more than ADMISSION_WAIT_BUDGET seconds in the queue, estimated
+# every ADMISSION_INTERVAL seconds from the queue depth and the drain rate,
+# a moving average of the PROCESSED_KEY counter of the ML service
+ADMISSION_CONTROL = os.getenv("ADMISSION_CONTROL", "1") == "1"
+ADMISSION_WAIT_BUDGET = float(os.getenv("ADMISSION_WAIT_BUDGET", 30))
+ADMISSION_INTERVAL = float(os.getenv("ADMISSION_INTERVAL", 1))
+ADMISSION_SMOOTHING = float(os.getenv("ADMISSION_SMOOTHING", 0.3))
+PROCESSED_KEY = "ml_service:processed"
+# Asynchronous jobs of /model/jobs: their outputs are published on
+# JOBS_CHANNEL, heard by every API worker, and kept JOB_RESULT_TTL seconds.
+# Jobs the ML service hasn't started within JOB_TIMEOUT seconds are dropped
+JOBS_CHANNEL = f"{RESULTS_CHANNEL}:jobs"
+JOB_KEY_PREFIX = "job"
+JOB_TIMEOUT = float(os.getenv("JOB_TIMEOUT", 600))
+JOB_RESULT_TTL = int(os.getenv("JOB_RESULT_TTL", 60 * 60))
+# Seconds a /model/jobs/events stream stays open, with a comment sent every
+# JOB_STREAM_HEARTBEAT seconds of silence so proxies keep it alive
+JOB_STREAM_TIMEOUT = float(os.getenv("JOB_STREAM_TIMEOUT", JOB_TIMEOUT))
+JOB_STREAM_HEARTBEAT = float(os.getenv("JOB_STREAM_HEARTBEAT", 15))
+# Concurrent predictions of the same content share a single job, across API
+# workers through a marker under "<SINGLEFLIGHT_PREFIX>:<md5>". The owner of
+# the job forwards its output to the workers that followed it, if any
+SINGLEFLIGHT = os.getenv("SINGLEFLIGHT", "1") == "1"
+SINGLEFLIGHT_PREFIX = "inflight"
+# How uploaded images reach the ML service: "disk" through the shared
+# UPLOAD_FOLDER volume, or "redis" with the raw bytes stored under
+# "<IMAGE_KEY_PREFIX>:<image name>" for IMAGE_TTL seconds
+IMAGE_TRANSPORT = os.getenv("IMAGE_TRANSPORT", "disk")
+IMAGE_KEY_PREFIX = "image"
+IMAGE_TTL = int(os.getenv("IMAGE_TTL", 120))
+# With the redis transport, still save uploads to UPLOAD_FOLDER in the
+# background after answering
+PERSIST_UPLOADS = os.getenv("PERSIST_UPLOADS", "1") == "1"
+# Decode and resize uploads to the 224x224 model input here, in a thread
+# pool, and hand the ML service the raw uint8 pixels under
+# "<TENSOR_KEY_PREFIX>:<image name>" for IMAGE_TTL seconds, so it only runs
+# preprocess_input and the model. The decoding settings must match the ones
+# of the ML service for the predictions to be the same
+PREPROCESS_IN_API = os.getenv("PREPROCESS_IN_API", "0") == "1"
+TENSOR_KEY_PREFIX = "tensor"
+FAST_DECODE = os.getenv("FAST_DECODE", "1") == "1"
+DECODE_MIN_SIZE = int(os.getenv("DECODE_MIN_SIZE", 448))
+MAX_IMAGE_PIXELS = int(os.getenv("MAX_IMAGE_PIXELS", 40_000_000))
+
+# Largest image accepted, uploads are copied in chunks and rejected as soon
+# as they go over
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES", 20 * 1024 * 1024))
+# Largest number of classes a client can ask for with top_k
+MAX_TOP_K = int(os.getenv("MAX_TOP_K", 10))
+# Largest number of neighbours a client can ask /model/similar for
+MAX_SIMILAR_K = int(os.getenv("MAX_SIMILAR_K", 50))
+# Largest number of files and total upload size of /model/predict/batch
+BATCH_MAX_FILES = int(os.getenv("BATCH_MAX_FILES", 64))
+BATCH_MAX_BYTES = int(os.getenv("BATCH_MAX_BYTES", 64 * 1024 * 1024))
+
+# Prediction cache settings
+# Version of the served model, the ML service publishes it under
+# MODEL_VERSION_KEY and cached predictions are kept per version
+MODEL_VERSION = os.getenv("MODEL_VERSION", "resnet50-imagenet")
+MODEL_VERSION_KEY = "model_version"
+# Prefix of the shared Redis keys holding cached predictions, one per content
+CACHE_PREFIX = "prediction_cache"
+# Counter bumped by DELETE /model/cache, every API worker drops its LRU when
+# it sees it change
+CACHE_GENERATION_KEY = "prediction_cache_generation"
+# Entries kept in the in-process LRU of each API worker
+CACHE_LRU_SIZE = int(os.getenv("CACHE_LRU_SIZE", 1024))
+# Seconds a shared cache entry lives after it was written
+CACHE_TTL = int(os.getenv("CACHE_TTL", 24 * 60 * 60))
+# Seconds between two checks of the served model version and cache generation
+CACHE_VERSION_REFRESH = float(os.getenv("CACHE_VERSION_REFRESH", 5))
+# Comma-separated emails of the operators allowed to empty the cache with
+# DELETE /model/cache, nobody by default
+CACHE_ADMINS = [email for email in os.getenv("CACHE_ADMINS", "").split(",") if email]
+
+# Near-duplicate reuse: uploads whose perceptual hash (dHash) is at most
+# NEAR_DUPLICATE_DISTANCE bits away from a recent image get its prediction
+NEAR_DUPLICATES = os.getenv("NEAR_DUPLICATES", "0") == "1"
+NEAR_DUPLICATE_DISTANCE = int(os.getenv("NEAR_DUPLICATE_DISTANCE", 4))
+NEAR_DUPLICATE_PREFIX = "near_duplicates"
+NEAR_DUPLICATE_TTL = int(os.getenv("NEAR_DUPLICATE_TTL", CACHE_TTL))
 
 # Database settings
 DATABASE_USERNAME = os.getenv("POSTGRES_USER")
@@ -1,5 +1,16 @@
 import hashlib
 import os
+import tempfile
+from contextlib import suppress
+
+# Bytes read at a time when copying or hashing an upload
+CHUNK_SIZE = 1024 * 1024
+# Image file extensions accepted, in lowercase
+ALLOWED_EXTENSIONS = ("jpeg", "jpg", "png", "gif")
+
+
+class UploadTooLarge(ValueError):
+    pass
 
 
 def allowed_file(filename):
@@ -9,7 +20,7 @@ def allowed_file(filename):
     if not filename or "." not in filename:
         return False
     ext = filename.rsplit(".", 1)[-1].lower()
-    return ext in {"png", "jpg", "jpeg", "gif"}
+    return ext in ALLOWED_EXTENSIONS
 
 
 async def get_file_hash(file):
@@ -17,10 +28,120 @@ async def get_file_hash(file):
     MD5 del contenido + extensión original en minúsculas.
     Devuelve <md5>.<ext>
     """
-    content = await file.read()
-    digest = hashlib.md5(content).hexdigest()
+    digest = hashlib.md5()
+    while chunk := await file.read(CHUNK_SIZE):
+        digest.update(chunk)
     await file.seek(0)
 
-    _, ext = os.path.splitext(file.filename or "")
+    return upload_name(digest.hexdigest(), file.filename)
+
+
+def upload_name(digest, filename):
+    """
+    Name of an upload: MD5 of the content + original extension in lowercase,
+    `<md5>.<ext>`.
+    """
+    _, ext = os.path.splitext(filename or "")
     ext = (ext or "").lower().lstrip(".") or "jpg"
     return f"{digest}.{ext}"
+
+
+def file_size(fileobj):
+    """
+    Size in bytes of a seekable file, without reading it.
+    """
+    position = fileobj.tell()
+    fileobj.seek(0, os.SEEK_END)
+    size = fileobj.tell()
+    fileobj.seek(position)
+    return size
+
+
+def spool_upload(src, filename, upload_dir, max_bytes):
+    """
+    Copies an upload to `upload_dir` in a single pass, hashing it on the way.
+
+    The content goes to a temporary file renamed to `<md5>.<ext>` once
+    complete, so readers never see a partial image. If an upload with the
+    same name is already there the copy is discarded.
+
+    Args:
+        src (file): Uploaded file, read from the start in `CHUNK_SIZE` chunks.
+        filename (str): Original file name, for the extension.
+        upload_dir (str): Folder the uploads are stored in.
+        max_bytes (int): Largest upload accepted.
+
+    Returns:
+        str: Upload name, `<md5>.<ext>`.
+
+    Raises:
+        UploadTooLarge: If the upload is over `max_bytes`.
+    """
+    src.seek(0)
+    digest = hashlib.md5()
+    size = 0
+    fd, tmp_path = tempfile.mkstemp(dir=upload_dir, prefix=".upload-")
+    try:
+        with os.fdopen(fd, "wb") as tmp:
+            while chunk := src.read(CHUNK_SIZE):
+                size += len(chunk)
+                if size > max_bytes:
+                    raise UploadTooLarge(f"Upload is over {max_bytes} bytes")
+                digest.update(chunk)
+                tmp.write(chunk)
+
+        new_filename = upload_name(digest.hexdigest(), filename)
+        dest_path = os.path.join(upload_dir, new_filename)
+        if os.path.exists(dest_path):
+            os.unlink(tmp_path)
+        else:
+            # mkstemp creates the file readable by its owner only
+            os.chmod(tmp_path, 0o644)
+            os.replace(tmp_path, dest_path)
+    except BaseException:
+        with suppress(FileNotFoundError):
+            os.unlink(tmp_path)
+        raise
+
+    return new_filename
+
+
+def read_file(path):
+    """
+    Reads the content of a file, to be run in the threadpool.
+    """
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def save_file(path, content):
+    """
+    Writes content to path, used to persist uploads in the background.
+
+    As in `spool_upload`, the content goes to a temporary file renamed once
+    complete, and nothing is written if the file is already there.
+    """
+    if os.path.exists(path):
+        return
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".upload-")
+    try:
+        with os.fdopen(fd, "wb") as tmp:
+            tmp.write(content)
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except BaseException:
+        with suppress(FileNotFoundError):
+            os.unlink(tmp_path)
+        raise
+
+
+def etag_matches(if_none_match, etag):
+    """
+    Whether an If-None-Match header value matches an ETag, weak comparison.
+    """
+    if not if_none_match:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(",")]
+    return "*" in tags or etag in (
+        tag[2:] if tag.startswith("W/") else tag for tag in tags
+    )
@@ -0,0 +1,128 @@
+import argparse
+import asyncio
+import json
+import time
+
+from app.model.schema import PredictResponse
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, ORJSONResponse
+
+OUTPUT = {
+    "prediction": "Labrador_retriever",
+    "score": 0.8976543,
+    "top_k": [["Labrador_retriever", 0.8976543]]
+    + [[f"class_{i}", 0.01 / (i + 1)] for i in range(9)],
+}
+
+
+def build_app(legacy):
+    """
+    App with a /model/predict route answering a fixed model output.
+
+    Args:
+        legacy (bool): Whether to serve it the previous way, through the
+                       middleware rounding the score of the JSON body.
+
+    Returns:
+        FastAPI: The app.
+    """
+    app = FastAPI(
+        default_response_class=JSONResponse if legacy else ORJSONResponse,
+    )
+
+    @app.post("/model/predict")
+    async def predict():
+        return PredictResponse(success=True, image_file_name="abc.jpeg", **OUTPUT)
+
+    if legacy:
+
+        @app.middleware("http")
+        async def round_score_on_predict(request: Request, call_next):
+            resp = await call_next(request)
+            if request.url.path == "/model/predict":
+                body_bytes = b""
+                async for chunk in resp.body_iterator:
+                    body_bytes += chunk
+                data = json.loads(body_bytes.decode("utf-8"))
+                data["score"] = round(float(data["score"]), 4)
+                return JSONResponse(content=data, status_code=resp.status_code)
+            return resp
+
+    return app
+
+
+async def call(app):
+    """
+    One request straight through the ASGI interface, without any client or
+    network overhead.
+    """
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": "POST",
+        "scheme": "http",
+        "path": "/model/predict",
+        "raw_path": b"/model/predict",
+        "root_path": "",
+        "query_string": b"",
+        "headers": [],
+        "client": ("127.0.0.1", 1234),
+        "server": ("test", 80),
+    }
+    body = []
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        if message["type"] == "http.response.body":
+            body.append(message.get("body", b""))
+
+    await app(scope, receive, send)
+    return b"".join(body)
+
+
+async def time_app(app, requests, rounds):
+    """
+    Microseconds per request, best of `rounds`.
+    """
+    best = float("inf")
+    for _ in range(rounds):
+        start = time.perf_counter()
+        for _ in range(requests):
+            await call(app)
+        best = min(best, time.perf_counter() - start)
+    return 1e6 * best / requests
+
+
+async def run(requests, rounds):
+    legacy, current = build_app(legacy=True), build_app(legacy=False)
+    assert json.loads(await call(legacy)) == json.loads(await call(current))
+
+    legacy_us = await time_app(legacy, requests, rounds)
+    current_us = await time_app(current, requests, rounds)
+
+    print(f"{'path':<22} {'us/request':>11}")
+    print(f"{'middleware + json':<22} {legacy_us:>11.1f}")
+    print(f"{'schema + orjson':<22} {current_us:>11.1f}")
+    print(
+        f"saved {legacy_us - current_us:.1f} us per request "
+        f"({legacy_us / current_us:.2f}x)"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compare the cost of answering /model/predict through "
+        "the score rounding middleware with the orjson response path"
+    )
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--rounds", type=int, default=5)
+    args = parser.parse_args()
+
+    asyncio.run(run(args.requests, args.rounds))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+import asyncio
+from unittest.mock import AsyncMock, MagicMock, patch
+
+import pytest
+from app.model.admission import AdmissionController
+
+
+def make_db(samples):
+    """
+    Redis client whose pipelines answer (interactive depth, bulk depth,
+    processed counter) from `samples`, one per round trip.
+    """
+    pipe = MagicMock()
+    pipe.execute = AsyncMock(side_effect=[list(sample) for sample in samples])
+    db = MagicMock()
+    db.pipeline.return_value = pipe
+    return db
+
+
+@pytest.mark.asyncio
+async def test_estimate_from_depth_and_drain_rate():
+    db = make_db([(0, 0, None), (50, 10, b"20")])
+    controller = AdmissionController(db, budget=5.5, interval=1, smoothing=1)
+    clock = [0]
+
+    with patch("app.model.admission.time.monotonic", lambda: clock[0]):
+        # No rate yet: admitted whatever the depth
+        assert await controller.estimate() == 0.0
+        clock[0] = 2
+        # 20 jobs drained in 2 s, 50 interactive jobs ahead
+        assert await controller.estimate() == 5.0
+        # Sampled at most once per interval, bulk jobs wait behind both lanes
+        assert await controller.admit("bulk") == (False, 6.0)
+
+    assert controller.counters == {"admitted": 0, "rejected": 1}
+
+
+@pytest.mark.asyncio
+async def test_idle_keeps_rate_and_stall_is_infinite():
+    db = make_db([(0, 0, b"0"), (0, 0, b"10"), (0, 0, b"10"), (5, 0, b"10")])
+    controller = AdmissionController(db, budget=10, interval=1, smoothing=1)
+    clock = [0]
+
+    with patch("app.model.admission.time.monotonic", lambda: clock[0]):
+        await controller.estimate()
+        clock[0] = 1
+        await controller.estimate()
+        assert controller.rate == 10
+        # Nothing queued and nothing drained: the rate is kept
+        clock[0] = 2
+        await controller.estimate()
+        assert controller.rate == 10
+        # Jobs waiting and none taken: the workers are stalled
+        clock[0] = 3
+        assert await controller.estimate() == float("inf")
+
+
+def test_concurrent_requests_share_a_sample_in_any_loop():
+    db = make_db([])
+
+    async def execute():
+        # A round trip lets the other requests run
+        await asyncio.sleep(0.01)
+        return [0, 0, b"0"]
+
+    db.pipeline.return_value.execute = AsyncMock(side_effect=execute)
+    # Built outside of any event loop, like the one of the API workers. Every
+    # estimate needs a new sample, requests arriving meanwhile share it
+    controller = AdmissionController(db, budget=10, interval=0, smoothing=1)
+
+    async def burst():
+        return await asyncio.gather(*(controller.estimate() for _ in range(5)))
+
+    assert asyncio.run(burst()) == [0.0] * 5
+    assert db.pipeline.return_value.execute.await_count == 1
+    assert asyncio.run(burst()) == [0.0] * 5
+    assert db.pipeline.return_value.execute.await_count == 2
@@ -0,0 +1,142 @@
+import json
+from unittest.mock import AsyncMock, patch
+
+import pytest
+from app.model.cache import PredictionCache
+
+
+def make_cache(version=b"v1", stored=None, generation=None):
+    db = AsyncMock()
+    db.mget.return_value = [version, generation]
+    db.get.return_value = stored
+    return db, PredictionCache(db, maxsize=2, ttl=60, refresh=0)
+
+
+@pytest.mark.asyncio
+async def test_miss_then_lru_hit():
+    db, cache = make_cache()
+    output = {"prediction": "Eskimo_dog", "score": 0.9346}
+
+    assert await cache.get("abc.jpeg") is None
+    await cache.put("abc.jpeg", output)
+    db.get.reset_mock()
+
+    # Same content under another extension is served from the LRU
+    assert await cache.get("abc.png") == output
+    db.get.assert_not_called()
+    db.mget.assert_called_with("model_version", "prediction_cache_generation")
+    assert cache.stats()["misses"] == 1
+    assert cache.stats()["lru_hits"] == 1
+
+
+@pytest.mark.asyncio
+async def test_redis_hit_keyed_by_version():
+    output = {"prediction": "cat", "score": 0.5}
+    db, cache = make_cache(stored=json.dumps(output).encode("utf-8"))
+
+    assert await cache.get("abc.jpeg") == output
+    db.get.assert_called_with("prediction_cache:v1:abc")
+    assert cache.stats()["redis_hits"] == 1
+
+
+@pytest.mark.asyncio
+async def test_entries_expire_on_their_own():
+    db, cache = make_cache()
+    output = {"prediction": "cat", "score": 0.5}
+
+    await cache.put("abc.jpeg", output)
+    await cache.put("def.jpeg", output)
+
+    # One key per content, each one with its own TTL
+    db.set.assert_any_call(
+        "prediction_cache:v1:abc",
+        json.dumps({**output, "image_name": "abc.jpeg"}),
+        ex=60,
+    )
+    db.set.assert_any_call(
+        "prediction_cache:v1:def",
+        json.dumps({**output, "image_name": "def.jpeg"}),
+        ex=60,
+    )
+    db.expire.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_lru_is_bounded():
+    _, cache = make_cache()
+    for name in ("a.jpg", "b.jpg", "c.jpg"):
+        await cache.put(name, {"prediction": name, "score": 1.0})
+
+    assert cache.stats()["size"] == 2
+    assert "a" not in cache.lru
+
+
+@pytest.mark.asyncio
+async def test_model_change_invalidates():
+    db, cache = make_cache()
+    await cache.put("abc.jpeg", {"prediction": "cat", "score": 0.5})
+
+    db.mget.return_value = [b"v2", None]
+    assert await cache.get("abc.jpeg") is None
+    db.get.assert_called_with("prediction_cache:v2:abc")
+
+
+@pytest.mark.asyncio
+async def test_invalidate_drops_keys_of_the_version():
+    db, cache = make_cache()
+    await cache.put("abc.jpeg", {"prediction": "cat", "score": 0.5})
+
+    async def scan_iter(match, count):
+        assert match == "prediction_cache:v1:*"
+        for key in (b"prediction_cache:v1:abc", b"prediction_cache:v1:def"):
+            yield key
+
+    db.scan_iter = scan_iter
+    db.unlink.return_value = 2
+    db.incr.return_value = 1
+    assert await cache.invalidate() == 2
+    db.unlink.assert_called_once_with(
+        b"prediction_cache:v1:abc", b"prediction_cache:v1:def"
+    )
+    db.incr.assert_called_once_with("prediction_cache_generation")
+    assert cache.stats()["size"] == 0
+
+
+@pytest.mark.asyncio
+async def test_invalidate_reaches_other_workers():
+    db, cache = make_cache()
+    output = {"prediction": "cat", "score": 0.5}
+    await cache.put("abc.jpeg", output)
+    assert await cache.get("abc.jpeg") == output
+
+    # Another worker emptied the cache and bumped the generation
+    db.mget.return_value = [b"v1", b"1"]
+    assert await cache.get("abc.jpeg") is None
+    assert cache.stats()["size"] == 0
+
+
+@pytest.mark.asyncio
+async def test_lru_entries_expire_with_the_shared_ones():
+    db, cache = make_cache()
+    output = {"prediction": "cat", "score": 0.5}
+    with patch("app.model.cache.time.monotonic", return_value=100):
+        await cache.put("abc.jpeg", output)
+    with patch("app.model.cache.time.monotonic", return_value=159):
+        assert await cache.get("abc.jpeg") == output
+    with patch("app.model.cache.time.monotonic", return_value=160):
+        assert await cache.get("abc.jpeg") is None
+    db.get.assert_called_once_with("prediction_cache:v1:abc")
+    assert cache.stats()["size"] == 0
+
+
+@pytest.mark.asyncio
+async def test_lookup_returns_upload_name():
+    output = {"prediction": "cat", "score": 0.5}
+    stored = json.dumps({**output, "image_name": "abc.png"}).encode("utf-8")
+    _, cache = make_cache(stored=stored)
+
+    assert await cache.lookup("abc") == ("abc.png", output)
+    assert await cache.get("abc.jpeg") == output
+
+    await cache.put("def.jpeg", output)
+    assert await cache.lookup("def") == ("def.jpeg", output)
@@ -0,0 +1,119 @@
+import io
+from unittest.mock import patch
+
+import pytest
+from app.model.near_duplicates import NearDuplicateIndex, dhash, hamming
+from PIL import Image
+
+
+class FakeRedis:
+    """
+    The few Redis commands the index uses, on dicts. Pipelines run them
+    synchronously, so only the methods awaited outside of one are async.
+    """
+
+    def __init__(self):
+        self.sets = {}
+        self.strings = {}
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+    def sadd(self, key, member):
+        self.sets.setdefault(key, set()).add(member)
+
+    def smembers(self, key):
+        return {member.encode() for member in self.sets.get(key, ())}
+
+    def set(self, key, value, ex=None):
+        self.strings[key] = value
+
+    async def mget(self, keys):
+        values = [self.strings.get(key) for key in keys]
+        return [value.encode() if value is not None else None for value in values]
+
+    def expire(self, key, ttl):
+        pass
+
+
+class FakePipeline:
+    def __init__(self, db):
+        self.db = db
+        self.calls = []
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: self.calls.append((name, args, kwargs))
+
+    async def execute(self):
+        return [
+            getattr(self.db, name)(*args, **kwargs) for name, args, kwargs in self.calls
+        ]
+
+
+def encode(img, **kwargs):
+    buffer = io.BytesIO()
+    img.save(buffer, **kwargs)
+    return buffer.getvalue()
+
+
+def test_dhash_survives_reencoding():
+    with open("tests/dog.jpeg", "rb") as f:
+        original = f.read()
+    img = Image.open(io.BytesIO(original)).convert("RGB")
+    resized = encode(img.resize((300, 200)), format="JPEG", quality=60)
+    as_png = encode(img, format="PNG")
+    other = encode(img.rotate(90, expand=True), format="JPEG")
+
+    def phash(content):
+        return dhash(io.BytesIO(content))
+
+    assert hamming(phash(original), phash(resized)) <= 4
+    assert hamming(phash(original), phash(as_png)) <= 4
+    assert hamming(phash(original), phash(other)) > 10
+    assert phash(b"not an image") is None
+
+
+async def version():
+    return "v1"
+
+
+@pytest.mark.asyncio
+async def test_index_within_distance():
+    db = FakeRedis()
+    index = NearDuplicateIndex(db, max_distance=4, ttl=60, version=version)
+    output = {"prediction": "Eskimo_dog", "score": 0.9346}
+    value = 0x0F0F_F0F0_1234_ABCD
+
+    assert await index.get(value) is None
+    await index.put(value, output)
+
+    # Up to 4 flipped bits are still found
+    assert await index.get(value ^ 0x8000_0000_0000_0101) == output
+    assert await index.get(value ^ 0xF) == output
+    assert await index.get(value ^ 0x1F) is None
+    assert index.stats() == {"hits": 2, "misses": 2, "hit_rate": 0.5}
+
+
+@pytest.mark.asyncio
+async def test_index_forgets_old_buckets():
+    db = FakeRedis()
+    index = NearDuplicateIndex(db, max_distance=4, ttl=60, version=version)
+    output = {"prediction": "Eskimo_dog", "score": 0.9346}
+    value = 0x0F0F_F0F0_1234_ABCD
+
+    with patch("app.model.near_duplicates.time.time", return_value=6000.0):
+        await index.put(value, output)
+    # Band keys are only written in the bucket of the write
+    assert all(":100:band:" in key for key in db.sets)
+
+    with patch("app.model.near_duplicates.time.time", return_value=6119.0):
+        assert await index.get(value ^ 0xF) == output
+    with patch("app.model.near_duplicates.time.time", return_value=6120.0):
+        assert await index.get(value ^ 0xF) is None
+
+    # The output of the closest hash expired, the next one is used
+    await index.put(value, output)
+    await index.put(value ^ 0x3, {"prediction": "husky", "score": 0.5})
+    assert await index.get(value) == output
+    del db.strings[f"near_duplicates:v1:output:{value:x}"]
+    assert await index.get(value) == {"prediction": "husky", "score": 0.5}
@@ -0,0 +1,37 @@
+import io
+from unittest.mock import patch
+
+import pytest
+from app.model.preprocess import TENSOR_BYTES, load_tensor
+from PIL import Image
+
+
+def test_load_tensor():
+    with open("tests/dog.jpeg", "rb") as fp:
+        tensor = load_tensor(fp)
+
+    with Image.open("tests/dog.jpeg") as img:
+        expected = img.convert("RGB").resize((224, 224), Image.NEAREST).tobytes()
+    assert len(tensor) == TENSOR_BYTES
+    # Small JPEGs are decoded at full resolution, like the ML service does
+    assert tensor == expected
+
+
+def test_load_tensor_converts_to_rgb():
+    buffer = io.BytesIO()
+    Image.new("RGBA", (300, 200), (10, 20, 30, 0)).save(buffer, format="PNG")
+    buffer.seek(0)
+
+    tensor = load_tensor(buffer)
+
+    assert len(tensor) == TENSOR_BYTES
+    assert tensor[:3] == bytes([10, 20, 30])
+
+
+def test_load_tensor_rejects():
+    with pytest.raises(ValueError):
+        load_tensor(io.BytesIO(b"not an image"))
+
+    with patch("app.model.preprocess.settings.MAX_IMAGE_PIXELS", 100 * 100):
+        with open("tests/dog.jpeg", "rb") as fp, pytest.raises(ValueError):
+            load_tensor(fp)
@@ -0,0 +1,34 @@
+import asyncio
+
+import pytest
+from app.model.redis_client import LoopRedis
+from redis.asyncio.connection import UnixDomainSocketConnection
+
+redislite = pytest.importorskip("redislite")
+
+
+@pytest.fixture
+def server(tmp_path):
+    server = redislite.Redis(str(tmp_path / "redis.db"))
+    yield server
+    server.shutdown()
+
+
+def test_exhausted_pool_waits_in_every_loop(server):
+    db = LoopRedis(
+        connection_class=UnixDomainSocketConnection,
+        path=server.socket_file,
+        max_connections=2,
+        timeout=5,
+    )
+
+    async def exhaust():
+        # Each command holds a connection, most of them wait for a free one
+        await asyncio.gather(
+            *(db.execute_command("DEBUG", "SLEEP", "0.02") for _ in range(10))
+        )
+        return await db.ping()
+
+    # gunicorn may build the app in one loop and serve it in another
+    assert asyncio.run(exhaust())
+    assert asyncio.run(exhaust())
@@ -1,7 +1,9 @@
-from unittest.mock import AsyncMock, MagicMock, patch
+import os
+from unittest.mock import ANY, AsyncMock, MagicMock, patch
 
 import pytest
 from app.auth.jwt import get_current_user
+from app.model.near_duplicates import dhash
 from app.model.schema import PredictResponse
 from fastapi import UploadFile
 from fastapi.testclient import TestClient
@@ -9,6 +11,22 @@ from httpx import AsyncClient
 from main import app
 
 
+@pytest.fixture(autouse=True)
+def admission():
+    with patch("app.model.router.admission") as admission:
+        admission.admit = AsyncMock(return_value=(True, 0.0))
+        yield admission
+
+
+@pytest.fixture(autouse=True)
+def prediction_etag():
+    with patch(
+        "app.model.router.prediction_etag", new_callable=AsyncMock
+    ) as prediction_etag:
+        prediction_etag.return_value = '"etag123"'
+        yield prediction_etag
+
+
 @pytest.mark.asyncio
 async def test_predict():
     mock_file = AsyncMock(spec=UploadFile)
@@ -23,12 +41,12 @@ async def test_predict():
 
     app.dependency_overrides[get_current_user] = lambda: mock_current_user
 
-    with patch("app.model.router.utils.get_file_hash", return_value="fakehash123"):
+    with patch("app.model.router.utils.spool_upload", return_value="fakehash123"):
         with patch(
             "app.model.router.model_predict", new_callable=AsyncMock
         ) as mock_model_predict:
             with patch("app.model.router.os.path.exists", return_value=False):
-                mock_model_predict.return_value = ("cat", 0.95)
+                mock_model_predict.return_value = {"prediction": "cat", "score": 0.95}
                 with patch("builtins.open", new_callable=MagicMock):
                     async with AsyncClient(app=app, base_url="http://test") as ac:
                         response = await ac.post(
@@ -66,12 +84,12 @@ async def test_predict_fails_bad_extension():
 
     app.dependency_overrides[get_current_user] = lambda: mock_current_user
 
-    with patch("app.model.router.utils.get_file_hash", return_value="fakehash123"):
+    with patch("app.model.router.utils.spool_upload", return_value="fakehash123"):
         with patch(
             "app.model.router.model_predict", new_callable=AsyncMock
         ) as mock_model_predict:
             with patch("app.model.router.os.path.exists", return_value=False):
-                mock_model_predict.return_value = ("cat", 0.95)
+                mock_model_predict.return_value = {"prediction": "cat", "score": 0.95}
                 with patch("builtins.open", new_callable=MagicMock):
                     async with AsyncClient(app=app, base_url="http://test") as ac:
                         response = await ac.post(
@@ -90,3 +108,439 @@ async def test_predict_fails_bad_extension():
                         assert response.json() == {
                             "detail": "File type is not supported."
                         }
+
+
+@pytest.mark.asyncio
+async def test_predict_top_k():
+    app.dependency_overrides[get_current_user] = lambda: MagicMock()
+
+    with patch("app.model.router.utils.spool_upload", return_value="fakehash123"):
+        with patch(
+            "app.model.router.model_predict", new_callable=AsyncMock
+        ) as mock_model_predict:
+            with patch("app.model.router.os.path.exists", return_value=True):
+                mock_model_predict.return_value = {
+                    "prediction": "cat",
+                    "score": 0.6,
+                    "top_k": [["cat", 0.6], ["lynx", 0.3]],
+                }
+                async with AsyncClient(app=app, base_url="http://test") as ac:
+                    response = await ac.post(
+                        "/model/predict?top_k=2",
+                        files={"file": ("test_image.png", b"data", "image/png")},
+                        headers={"Authorization": "Bearer testtoken"},
+                    )
+
+                    assert response.status_code == 200
+                    assert response.json()["top_k"] == [["cat", 0.6], ["lynx", 0.3]]
+                    mock_model_predict.assert_called_once_with(
+                        "fakehash123", 2, "interactive", None, admit=ANY
+                    )
+
+
+@pytest.mark.asyncio
+async def test_predict_redis_transport():
+    app.dependency_overrides[get_current_user] = lambda: MagicMock()
+
+    with patch("app.model.router.config.IMAGE_TRANSPORT", "redis"), patch(
+        "app.model.router.config.PERSIST_UPLOADS", False
+    ), patch("app.model.router.store_image") as mock_store_image, patch(
+        "app.model.router.utils.upload_name", return_value="fakehash123"
+    ), patch(
+        "app.model.router.model_predict", new_callable=AsyncMock
+    ) as mock_model_predict, patch(
+        "builtins.open", new_callable=MagicMock
+    ) as mock_open:
+        mock_model_predict.return_value = {"prediction": "cat", "score": 0.95}
+        async with AsyncClient(app=app, base_url="http://test") as ac:
+            response = await ac.post(
+                "/model/predict",
+                files={"file": ("test_image.png", b"data", "image/png")},
+                headers={"Authorization": "Bearer testtoken"},
+            )
+
+        assert response.status_code == 200
+        mock_store_image.assert_called_once_with("fakehash123", b"data")
+        mock_open.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_similar():
+    app.dependency_overrides[get_current_user] = lambda: MagicMock()
+
+    with patch("app.model.router.utils.spool_upload", return_value="fakehash123"):
+        with patch(
+            "app.model.router.model_similar", new_callable=AsyncMock
+        ) as mock_model_similar:
+            with patch("app.model.router.os.path.exists", return_value=True):
+                mock_model_similar.return_value = {
+                    "prediction": "cat",
+                    "score": 0.6,
+                    "similar": [["abc", 0.93], ["def", 0.81]],
+                }
+                async with AsyncClient(app=app, base_url="http://test") as ac:
+                    response = await ac.post(
+                        "/model/similar?k=2",
+                        files={"file": ("test_image.png", b"data", "image/png")},
+                        headers={"Authorization": "Bearer testtoken"},
+                    )
+
+                    assert response.status_code == 200
+                    assert response.json()["similar"] == [
+                        {"image_hash": "abc", "score": 0.93},
+                        {"image_hash": "def", "score": 0.81},
+                    ]
+                    mock_model_similar.assert_called_once_with(
+                        "fakehash123", 2, "interactive", admit=ANY
+                    )
+
+
+@pytest.mark.asyncio
+async def test_predict_batch():
+    app.dependency_overrides[get_current_user] = lambda: MagicMock()
+
+    with patch(
+        "app.model.router.utils.spool_upload", side_effect=["hash1.png", "hash2.png"]
+    ), patch(
+        "app.model.router.model_predict_batch", new_callable=AsyncMock
+    ) as mock_predict_batch, patch(
+        "app.model.router.os.path.exists", return_value=True
+    ):
+        mock_predict_batch.return_value = [
+            {"prediction": "cat", "score": 0.9},
+            TimeoutError("Model prediction timed out"),
+        ]
+        async with AsyncClient(app=app, base_url="http://test") as ac:
+            response = await ac.post(
+                "/model/predict/batch",
+                files=[
+                    ("files", ("a.png", b"a", "image/png")),
+                    ("files", ("notes.txt", b"b", "text/plain")),
+                    ("files", ("c.png", b"c", "image/png")),
+                ],
+                headers={"Authorization": "Bearer testtoken"},
+            )
+
+    assert response.status_code == 200
+    results = response.json()["results"]
+    assert [r["success"] for r in results] == [True, False, False]
+    assert results[0]["prediction"] == "cat"
+    assert results[0]["image_file_name"] == "hash1.png"
+    assert results[1]["error"] == "File type is not supported."
+    assert results[2]["error"] == "Model prediction timed out"
+    mock_predict_batch.assert_called_once_with(
+        ["hash1.png", "hash2.png"], 1, "interactive", admit=ANY
+    )
+
+
+@pytest.mark.asyncio
+async def test_predict_batch_too_many_files():
+    app.dependency_overrides[get_current_user] = lambda: MagicMock()
+
+    with patch("app.model.router.config.BATCH_MAX_FILES", 1):
+        async with AsyncClient(app=app, base_url="http://test") as ac:
+            response = await ac.post(
+                "/model/predict/batch",
+                files=[
+                    ("files", ("a.png", b"a", "image/png")),
+                    ("files", ("b.png", b"b", "image/png")),
+                ],
+                headers={"Authorization": "Bearer testtoken"},
+            )
+
+    assert response.status_code == 413
+
+
+@pytest.mark.asyncio
+async def test_submit_jobs():
+    app.dependency_overrides[get_current_user] = lambda: MagicMock()
+
+    with patch("app.model.router.utils.spool_upload", return_value="hash1.png"), patch(
+        "app.model.router.submit_jobs", new_callable=AsyncMock
+    ) as mock_submit, patch("app.model.router.os.path.exists", return_value=True):
+        mock_submit.return_value = ["job-1"]
+        async with AsyncClient(app=app, base_url="http://test") as ac:
+            response = await ac.post(
+                "/model/jobs?priority=bulk",
+                files=[
+                    ("files", ("notes.txt", b"b", "text/plain")),
+                    ("files", ("a.png", b"a", "image/png")),
+                ],
+                headers={"Authorization": "Bearer testtoken"},
+            )
+
+    assert response.status_code == 202
+    jobs = response.json()["jobs"]
+    assert jobs[0]["job_id"] is None
+    assert jobs[0]["error"] == "File type is not supported."
+    assert jobs[1]["job_id"] == "job-1"
+    assert jobs[1]["image_file_name"] == "hash1.png"
+    mock_submit.assert_called_once_with(["hash1.png"], 1, "bulk")
+
+
+@pytest.mark.asyncio
+async def test_get_job():
+    app.dependency_overrides[get_current_user] = lambda: MagicMock()
+    job_id = "0b0a4f0c-3f1e-4a8e-9d5e-6f1f3c2b1a00"
+
+    with patch("app.model.router.job_status", new_callable=AsyncMock) as mock_status:
+        mock_status.side_effect = [
+            {
+                "job_id": job_id,
+                "status": "done",
+                "image_file_name": "hash1.png",
+                "prediction": "cat",
+                "score": 0.9,
+            },
+            None,
+        ]
+        async with AsyncClient(app=app, base_url="http://test") as ac:
+            done = await ac.get(
+                f"/model/jobs/{job_id}",
+                headers={"Authorization": "Bearer testtoken"},
+            )
+            missing = await ac.get(
+                f"/model/jobs/{job_id}",
+                headers={"Authorization": "Bearer testtoken"},
+            )
+
+    assert done.status_code == 200
+    assert done.json()["status"] == "done"
+    assert done.json()["prediction"] == "cat"
+    assert missing.status_code == 404
+
+
+@pytest.mark.asyncio
+async def test_predict_upload_too_large(tmp_path):
+    app.dependency_overrides[get_current_user] = lambda: MagicMock()
+
+    with patch("app.model.router.config.MAX_UPLOAD_BYTES", 4), patch(
+        "app.model.router.config.UPLOAD_FOLDER", str(tmp_path)
+    ):
+        async with AsyncClient(app=app, base_url="http://test") as ac:
+            response = await ac.post(
+                "/model/predict",
+                files={"file": ("test_image.png", b"too-large", "image/png")},
+                headers={"Authorization": "Bearer testtoken"},
+            )
+
+    assert response.status_code == 413
+    assert os.listdir(tmp_path) == []
+
+
+@pytest.mark.asyncio
+async def test_predict_rounds_score():
+    app.dependency_overrides[get_current_user] = lambda: MagicMock()
+
+    with patch(
+        "app.model.router.utils.spool_upload", return_value="fakehash123"
+    ), patch("app.model.router.model_predict", new_callable=AsyncMock) as mock_predict:
+        mock_predict.return_value = {"prediction": "cat", "score": 0.123456789}
+        async with AsyncClient(app=app, base_url="http://test") as ac:
+            response = await ac.post(
+                "/model/predict",
+                files={"file": ("test_image.png", b"data", "image/png")},
+                headers={"Authorization": "Bearer testtoken"},
+            )
+
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/json"
+    assert response.json()["score"] == 0.1235
+
+
+@pytest.mark.asyncio
+async def test_predict_overloaded(admission):
+    app.dependency_overrides[get_current_user] = lambda: MagicMock()
+    admission.admit.return_value = (False, 42.3)
+    pushed = AsyncMock()
+
+    async def predict(*args, admit):
+        # Admission happens right before pushing the job
+        await admit()
+        await pushed()
+
+    with patch(
+        "app.model.router.utils.spool_upload", return_value="fakehash123"
+    ), patch("app.model.router.model_predict", side_effect=predict):
+        async with AsyncClient(app=app, base_url="http://test") as ac:
+            response = await ac.post(
+                "/model/predict?priority=bulk",
+                files={"file": ("test_image.png", b"data", "image/png")},
+                headers={"Authorization": "Bearer testtoken"},
+            )
+
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "13"
+    assert response.headers["X-Estimated-Wait"] == "42.3"
+    admission.admit.assert_called_once_with("bulk")
+    pushed.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_predict_admission_after_auth_and_cache(admission):
+    app.dependency_overrides.pop(get_current_user, None)
+    admission.admit.return_value = (False, 42.3)
+
+    async with AsyncClient(app=app, base_url="http://test") as ac:
+        response = await ac.post(
+            "/model/predict",
+            files={"file": ("test_image.png", b"data", "image/png")},
+        )
+    # Unauthenticated requests are neither turned away nor counted
+    assert response.status_code == 401
+    admission.admit.assert_not_called()
+
+    app.dependency_overrides[get_current_user] = lambda: MagicMock()
+    with patch(
+        "app.model.router.utils.spool_upload", return_value="fakehash123"
+    ), patch("app.model.router.model_predict", new_callable=AsyncMock) as mock_predict:
+        # Answered without pushing a job, admit is never awaited
+        mock_predict.return_value = {"prediction": "cat", "score": 0.9}
+        async with AsyncClient(app=app, base_url="http://test") as ac:
+            response = await ac.post(
+                "/model/predict",
+                files={"file": ("test_image.png", b"data", "image/png")},
+                headers={"Authorization": "Bearer testtoken"},
+            )
+    assert response.status_code == 200
+    admission.admit.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_predict_by_hash():
+    app.dependency_overrides[get_current_user] = lambda: MagicMock()
+    digest = "0a7c757a80f2c5b13fa7a2a47a683593"
+
+    with patch(
+        "app.model.router.model_predict_by_hash", new_callable=AsyncMock
+    ) as mock_predict:
+        mock_predict.side_effect = [
+            (f"{digest}.jpeg", {"prediction": "cat", "score": 0.9}),
+            None,
+        ]
+        async with AsyncClient(app=app, base_url="http://test") as ac:
+            headers = {"Authorization": "Bearer testtoken"}
+            found = await ac.get(f"/model/predict/{digest.upper()}", headers=headers)
+            unknown = await ac.get(f"/model/predict/{digest}", headers=headers)
+            not_modified = await ac.get(
+                f"/model/predict/{digest}",
+                headers={**headers, "If-None-Match": 'W/"etag123"'},
+            )
+            invalid = await ac.get("/model/predict/not-a-hash", headers=headers)
+
+    assert found.status_code == 200
+    assert found.json()["image_file_name"] == f"{digest}.jpeg"
+    assert found.headers["ETag"] == '"etag123"'
+    mock_predict.assert_any_call(digest, 1, "interactive", admit=ANY)
+    assert unknown.status_code == 404
+    assert not_modified.status_code == 304
+    assert mock_predict.call_count == 2
+    assert invalid.status_code == 422
+
+
+@pytest.mark.asyncio
+async def test_predict_preprocess_in_api():
+    app.dependency_overrides[get_current_user] = lambda: MagicMock()
+    with open("tests/dog.jpeg", "rb") as fp:
+        content = fp.read()
+
+    with patch("app.model.router.config.PREPROCESS_IN_API", True), patch(
+        "app.model.router.utils.spool_upload", return_value="fakehash123.jpeg"
+    ), patch(
+        "app.model.router.has_tensor", new_callable=AsyncMock, return_value=False
+    ), patch(
+        "app.model.router.store_tensor", new_callable=AsyncMock
+    ) as mock_store_tensor, patch(
+        "app.model.router.model_predict", new_callable=AsyncMock
+    ) as mock_predict:
+        mock_predict.return_value = {"prediction": "cat", "score": 0.9}
+        async with AsyncClient(app=app, base_url="http://test") as ac:
+            response = await ac.post(
+                "/model/predict",
+                files={"file": ("dog.jpeg", content, "image/jpeg")},
+                headers={"Authorization": "Bearer testtoken"},
+            )
+
+    assert response.status_code == 200
+    image_name, tensor = mock_store_tensor.call_args[0]
+    assert image_name == "fakehash123.jpeg"
+    assert len(tensor) == 224 * 224 * 3
+
+
+@pytest.mark.asyncio
+async def test_predict_error_has_no_etag():
+    app.dependency_overrides[get_current_user] = lambda: MagicMock()
+    digest = "0a7c757a80f2c5b13fa7a2a47a683593"
+    error = {"prediction": "error", "score": 0.0}
+
+    with patch(
+        "app.model.router.utils.spool_upload", return_value="fakehash123"
+    ), patch(
+        "app.model.router.model_predict", new_callable=AsyncMock, return_value=error
+    ), patch(
+        "app.model.router.model_predict_by_hash",
+        new_callable=AsyncMock,
+        return_value=(f"{digest}.jpeg", error),
+    ):
+        async with AsyncClient(app=app, base_url="http://test") as ac:
+            headers = {"Authorization": "Bearer testtoken"}
+            uploaded = await ac.post(
+                "/model/predict",
+                files={"file": ("test_image.png", b"data", "image/png")},
+                headers=headers,
+            )
+            by_hash = await ac.get(f"/model/predict/{digest}", headers=headers)
+
+    # Not cached, the client must not be told to keep it
+    assert uploaded.status_code == by_hash.status_code == 200
+    assert "ETag" not in uploaded.headers
+    assert "ETag" not in by_hash.headers
+
+
+@pytest.mark.asyncio
+async def test_invalidate_cache_needs_operator():
+    app.dependency_overrides[get_current_user] = lambda: MagicMock(
+        email="user@example.com"
+    )
+    headers = {"Authorization": "Bearer testtoken"}
+
+    with patch(
+        "app.model.router.cache.invalidate", new_callable=AsyncMock
+    ) as invalidate:
+        async with AsyncClient(app=app, base_url="http://test") as ac:
+            forbidden = await ac.delete("/model/cache", headers=headers)
+            with patch("app.model.router.config.CACHE_ADMINS", ["user@example.com"]):
+                allowed = await ac.delete("/model/cache", headers=headers)
+
+    assert forbidden.status_code == 403
+    assert allowed.status_code == 204
+    invalidate.assert_awaited_once()
+
+
+@pytest.mark.asyncio
+async def test_predict_near_duplicates_hashes_spooled_file():
+    app.dependency_overrides[get_current_user] = lambda: MagicMock()
+    with open("tests/dog.jpeg", "rb") as fp:
+        content = fp.read()
+        expected = dhash(fp)
+
+    with patch("app.model.router.config.NEAR_DUPLICATES", True), patch(
+        "app.model.router.utils.spool_upload", return_value="fakehash123.jpeg"
+    ), patch(
+        "app.model.router.model_predict", new_callable=AsyncMock
+    ) as mock_predict, patch.object(
+        UploadFile, "read", side_effect=AssertionError("upload read in memory")
+    ):
+        mock_predict.return_value = {"prediction": "cat", "score": 0.9}
+        async with AsyncClient(app=app, base_url="http://test") as ac:
+            response = await ac.post(
+                "/model/predict",
+                files={"file": ("dog.jpeg", content, "image/jpeg")},
+                headers={"Authorization": "Bearer testtoken"},
+            )
+
+    assert response.status_code == 200
+    assert expected is not None
+    mock_predict.assert_called_once_with(
+        "fakehash123.jpeg", 1, "interactive", expected, admit=ANY
+    )
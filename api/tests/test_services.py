@@ -0,0 +1,283 @@
+import asyncio
+import json
+import time
+from unittest.mock import AsyncMock, MagicMock, patch
+
+import pytest
+from app.model import services
+from app.model.results import ResultListener
+
+
+def make_results(output):
+    results = MagicMock()
+    results.start = AsyncMock()
+    results.channel = "ml_service:results:host:1"
+    results.wait = AsyncMock(return_value=output)
+    return results
+
+
+@pytest.mark.asyncio
+async def test_model_predict_job_lane_and_deadline():
+    db = AsyncMock()
+    cache = AsyncMock()
+    cache.get.return_value = None
+    results = make_results({"prediction": "cat", "score": 0.9})
+
+    with patch.object(services, "db", db), patch.object(
+        services, "cache", cache
+    ), patch.object(services, "results", results), patch.object(
+        services.settings, "SINGLEFLIGHT", False
+    ):
+        admit = AsyncMock()
+        output = await services.model_predict("abc.jpeg", priority="bulk", admit=admit)
+
+    assert output == {"prediction": "cat", "score": 0.9}
+    admit.assert_awaited_once()
+    queue_name, job_json = db.lpush.call_args[0]
+    job = json.loads(job_json)
+    assert queue_name == "service_queue:bulk"
+    assert job["image_name"] == "abc.jpeg"
+    assert job["reply_to"] == "ml_service:results:host:1"
+    assert time.time() < job["deadline"] <= time.time() + 45
+    results.register.assert_called_once_with(job["id"])
+    cache.put.assert_called_once_with("abc.jpeg", output)
+
+
+@pytest.mark.asyncio
+async def test_enqueue_stream_transport():
+    db = AsyncMock()
+
+    with patch.object(services, "db", db), patch.object(
+        services.settings, "QUEUE_TRANSPORT", "stream"
+    ):
+        await services.enqueue({"id": "1", "image_name": "abc.jpeg"}, "interactive")
+
+    db.lpush.assert_not_called()
+    (stream, fields), kwargs = db.xadd.call_args
+    assert stream == "service_stream"
+    assert json.loads(fields["job"])["id"] == "1"
+    assert kwargs["approximate"] is True
+
+
+@pytest.mark.asyncio
+async def test_model_predict_near_duplicate_hit():
+    db = AsyncMock()
+    cache = AsyncMock()
+    cache.get.return_value = None
+    near_duplicates = AsyncMock()
+    near_duplicates.get.return_value = {"prediction": "cat", "score": 0.9}
+
+    with patch.object(services, "db", db), patch.object(
+        services, "cache", cache
+    ), patch.object(services, "near_duplicates", near_duplicates), patch.object(
+        services.settings, "NEAR_DUPLICATES", True
+    ):
+        admit = AsyncMock()
+        output = await services.model_predict("abc.jpeg", phash=0xABC, admit=admit)
+
+    assert output == {"prediction": "cat", "score": 0.9}
+    near_duplicates.get.assert_called_once_with(0xABC)
+    db.lpush.assert_not_called()
+    # Nothing pushed, nothing to admit
+    admit.assert_not_called()
+    cache.put.assert_called_once_with("abc.jpeg", output)
+
+
+@pytest.mark.asyncio
+async def test_model_predict_batch_single_round_trip():
+    db = MagicMock()
+    db.delete = AsyncMock()
+    pipe = MagicMock()
+    pipe.execute = AsyncMock()
+    db.pipeline.return_value = pipe
+    cache = AsyncMock()
+    cache.get.side_effect = lambda name: (
+        {"prediction": "dog", "score": 0.8} if name == "cached.png" else None
+    )
+    results = make_results(None)
+    results.wait.side_effect = [
+        {"prediction": "cat", "score": 0.9},
+        TimeoutError("Model prediction timed out"),
+    ]
+
+    with patch.object(services, "db", db), patch.object(
+        services, "cache", cache
+    ), patch.object(services, "results", results):
+        outputs = await services.model_predict_batch(
+            ["a.png", "cached.png", "b.png", "a.png"]
+        )
+
+    assert outputs[0] == outputs[3] == {"prediction": "cat", "score": 0.9}
+    assert outputs[1] == {"prediction": "dog", "score": 0.8}
+    assert isinstance(outputs[2], TimeoutError)
+    # One push per distinct uncached image, all in the same pipeline
+    assert [
+        json.loads(call[0][1])["image_name"] for call in pipe.lpush.call_args_list
+    ] == ["a.png", "b.png"]
+    pipe.execute.assert_awaited_once()
+    cache.put.assert_called_once_with("a.png", {"prediction": "cat", "score": 0.9})
+
+
+@pytest.mark.asyncio
+async def test_submit_jobs_and_status():
+    db = MagicMock()
+    pipe = MagicMock()
+    pipe.execute = AsyncMock()
+    db.pipeline.return_value = pipe
+    cache = AsyncMock()
+    cache.get.side_effect = lambda name: (
+        {"prediction": "dog", "score": 0.8} if name == "cached.png" else None
+    )
+
+    with patch.object(services, "db", db), patch.object(services, "cache", cache):
+        job_ids = await services.submit_jobs(["a.png", "cached.png"], priority="bulk")
+
+    queue_name, job_json = pipe.lpush.call_args[0]
+    job = json.loads(job_json)
+    assert queue_name == "service_queue:bulk"
+    assert job["id"] == job_ids[0]
+    assert job["reply_to"] == services.settings.JOBS_CHANNEL
+    assert job["result_ttl"] == services.settings.JOB_RESULT_TTL
+    # The cached image is answered without a job for the ML service
+    pipe.lpush.assert_called_once()
+    pipe.set.assert_any_call(
+        job_ids[1],
+        json.dumps({"prediction": "dog", "score": 0.8}),
+        ex=services.settings.JOB_RESULT_TTL,
+    )
+
+    record = json.dumps({"image_name": "a.png", "top_k": 1, "deadline": 0})
+    db.mget = AsyncMock()
+    with patch.object(services, "db", db):
+        db.mget.return_value = [None, None]
+        assert await services.job_status(job_ids[0]) is None
+        db.mget.return_value = [record, None]
+        assert (await services.job_status(job_ids[0]))["status"] == "expired"
+        db.mget.return_value = [record, json.dumps({"prediction": "cat", "score": 1})]
+        assert await services.job_status(job_ids[0]) == {
+            "job_id": job_ids[0],
+            "image_file_name": "a.png",
+            "status": "done",
+            "prediction": "cat",
+            "score": 1,
+        }
+
+
+@pytest.mark.asyncio
+async def test_submit_jobs_keeps_images_until_deadline():
+    db = MagicMock()
+    pipe = MagicMock()
+    pipe.execute = AsyncMock()
+    db.pipeline.return_value = pipe
+    cache = AsyncMock()
+    cache.get.return_value = None
+
+    with patch.object(services, "db", db), patch.object(
+        services, "cache", cache
+    ), patch.multiple(
+        services.settings, IMAGE_TRANSPORT="redis", PREPROCESS_IN_API=True
+    ):
+        await services.submit_jobs(["a.png"])
+
+    # In the same round trip as the job, for as long as it may wait
+    timeout = int(services.settings.JOB_TIMEOUT)
+    assert timeout > services.settings.IMAGE_TTL
+    pipe.expire.assert_any_call("image:a.png", timeout)
+    pipe.expire.assert_any_call("tensor:a.png", timeout)
+    pipe.execute.assert_awaited_once()
+
+
+@pytest.mark.asyncio
+async def test_model_predict_by_hash(tmp_path):
+    cache = AsyncMock()
+    digest = "0a7c757a80f2c5b13fa7a2a47a683593"
+    cache.lookup.return_value = (f"{digest}.jpeg", {"prediction": "dog", "score": 0.8})
+    admit = AsyncMock()
+
+    with patch.object(services, "cache", cache), patch.object(
+        services.settings, "UPLOAD_FOLDER", str(tmp_path)
+    ), patch.object(services, "model_predict", new_callable=AsyncMock) as predict:
+        predict.return_value = {"prediction": "cat", "score": 0.9}
+        # Image gone, prediction cached with the name of the upload
+        assert await services.model_predict_by_hash(digest, admit=admit) == (
+            f"{digest}.jpeg",
+            {"prediction": "dog", "score": 0.8},
+        )
+        # Not enough classes cached
+        assert await services.model_predict_by_hash(digest, top_k=3) is None
+
+        (tmp_path / f"{digest}.png").write_bytes(b"image")
+        assert await services.model_predict_by_hash(digest, top_k=3, admit=admit) == (
+            f"{digest}.png",
+            {"prediction": "cat", "score": 0.9},
+        )
+        predict.assert_called_once_with(f"{digest}.png", 3, "interactive", admit=admit)
+    # Only model_predict may push a job
+    admit.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_find_upload_redis_transport(tmp_path):
+    digest = "0a7c757a80f2c5b13fa7a2a47a683593"
+    db = MagicMock()
+    pipe = MagicMock()
+    db.pipeline.return_value = pipe
+    db.set = AsyncMock()
+    names = [f"{digest}.{ext}" for ext in services.utils.ALLOWED_EXTENSIONS]
+
+    with patch.object(services, "db", db), patch.multiple(
+        services.settings, IMAGE_TRANSPORT="redis", UPLOAD_FOLDER=str(tmp_path)
+    ):
+        # Bytes expired and the image is not on disk either
+        pipe.execute = AsyncMock(return_value=[0] * len(names))
+        assert await services.find_upload(digest) is None
+
+        # Only on the disk of the API: stored again for the ML service
+        (tmp_path / f"{digest}.png").write_bytes(b"image")
+        assert await services.find_upload(digest) == f"{digest}.png"
+        db.set.assert_awaited_once_with(
+            f"image:{digest}.png", b"image", ex=services.settings.IMAGE_TTL
+        )
+
+        # Still in Redis: nothing to do
+        db.set.reset_mock()
+        pipe.execute = AsyncMock(return_value=[0, 1] + [0] * (len(names) - 2))
+        assert await services.find_upload(digest) == names[1]
+        db.set.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_result_listener():
+    published = asyncio.Queue()
+
+    class FakePubSub:
+        async def subscribe(self, *channels):
+            pass
+
+        async def listen(self):
+            while True:
+                yield await published.get()
+
+        async def reset(self):
+            pass
+
+    db = AsyncMock()
+    db.pubsub = MagicMock(return_value=FakePubSub())
+    db.get.return_value = None
+    listener = ResultListener(db)
+    await listener.start()
+
+    future = listener.register("1")
+    output = {"prediction": "cat", "score": 0.9}
+    await published.put({"data": json.dumps({"id": "1", "output": output})})
+    assert await listener.wait("1", future, 1) == output
+
+    # A missed notification is found under the job ID when the wait ends
+    db.get.return_value = json.dumps(output).encode()
+    assert await listener.wait("2", listener.register("2"), 0.01) == output
+
+    db.get.return_value = None
+    with pytest.raises(TimeoutError):
+        await listener.wait("3", listener.register("3"), 0.01)
+    assert listener.waiters == {}
+    listener.task.cancel()
@@ -0,0 +1,181 @@
+import asyncio
+import json
+from unittest.mock import AsyncMock, MagicMock
+
+import pytest
+from app.model.singleflight import SingleFlight
+
+
+class FakeRedis:
+    """
+    The few Redis commands the coalescing uses, on a dict.
+    """
+
+    def __init__(self):
+        self.values = {}
+        self.sets = {}
+        self.published = []
+
+    async def set(self, key, value, nx=False, ex=None):
+        if nx and key in self.values:
+            return None
+        self.values[key] = value.encode()
+        return True
+
+    async def get(self, key):
+        return self.values.get(key)
+
+    async def eval(self, script, numkeys, marker_key, followers_key, marker):
+        # RELEASE_SCRIPT
+        followers = sorted(self.sets.pop(followers_key, ()))
+        if self.values.get(marker_key) == marker.encode():
+            del self.values[marker_key]
+        return followers
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+    def sadd(self, key, member):
+        self.sets.setdefault(key, set()).add(member)
+
+    def expire(self, key, ttl):
+        pass
+
+    def publish(self, channel, message):
+        self.published.append((channel, json.loads(message)))
+
+
+class FakePipeline:
+    def __init__(self, db):
+        self.db = db
+        self.calls = []
+
+    def __getattr__(self, name):
+        return lambda *args: self.calls.append((name, args))
+
+    async def execute(self):
+        return [getattr(self.db, name)(*args) for name, args in self.calls]
+
+
+def make_results():
+    results = MagicMock()
+    results.start = AsyncMock()
+    results.wait = AsyncMock()
+    return results
+
+
+@pytest.mark.asyncio
+async def test_coalesces_local_requests():
+    db = FakeRedis()
+    singleflight = SingleFlight(db, make_results(), ttl=5)
+    output = {"prediction": "cat", "score": 0.9}
+    answered = asyncio.Event()
+    calls = []
+
+    async def owner():
+        calls.append(1)
+        await answered.wait()
+        return output
+
+    first = asyncio.create_task(singleflight.run("abc.png", 1, {"id": "1"}, owner))
+    await asyncio.sleep(0)
+    # Same content with another extension: waits for the first job
+    second = asyncio.create_task(
+        singleflight.run("abc.jpeg", 1, {"id": "2"}, AsyncMock())
+    )
+    await asyncio.sleep(0)
+    answered.set()
+
+    assert await first == await second == output
+    assert len(calls) == 1
+    assert db.values == {}
+    assert singleflight.stats()["coalesced_local"] == 1
+    assert singleflight.stats()["coalesced_rate"] == 0.5
+
+
+@pytest.mark.asyncio
+async def test_follows_job_of_another_worker():
+    db = FakeRedis()
+    output = {"prediction": "cat", "score": 0.9}
+    await db.set("inflight:abc", json.dumps({"id": "1", "top_k": 3}))
+    results = make_results()
+    results.channel = "results:host:2"
+    results.wait.return_value = output
+    singleflight = SingleFlight(db, results, ttl=5)
+    run_job = AsyncMock()
+
+    assert await singleflight.run("abc.png", 2, {"id": "2"}, run_job) == output
+    run_job.assert_not_called()
+    results.register.assert_called_once_with("1")
+    # The owner forwards the output to the channel of this worker
+    assert db.sets == {"inflight:followers:1": {"results:host:2"}}
+
+    # A job with fewer classes than needed is not shared
+    await singleflight.run("abc.png", 5, {"id": "3"}, run_job)
+    run_job.assert_called_once()
+    assert singleflight.stats()["coalesced_remote"] == 1
+
+
+@pytest.mark.asyncio
+async def test_owner_failure_reaches_local_followers():
+    db = FakeRedis()
+    singleflight = SingleFlight(db, make_results(), ttl=5)
+    answered = asyncio.Event()
+
+    async def owner():
+        await answered.wait()
+        raise TimeoutError("Model prediction timed out")
+
+    first = asyncio.create_task(singleflight.run("abc.png", 1, {"id": "1"}, owner))
+    await asyncio.sleep(0)
+    second = asyncio.create_task(
+        singleflight.run("abc.png", 1, {"id": "2"}, AsyncMock())
+    )
+    await asyncio.sleep(0)
+    answered.set()
+
+    with pytest.raises(TimeoutError):
+        await first
+    with pytest.raises(TimeoutError):
+        await second
+    assert db.values == {}
+
+
+@pytest.mark.asyncio
+async def test_owner_forwards_to_followers_only():
+    db = FakeRedis()
+    singleflight = SingleFlight(db, make_results(), ttl=5)
+    output = {"prediction": "cat", "score": 0.9}
+
+    # Nobody followed: nothing published
+    assert (
+        await singleflight.run(
+            "abc.png", 1, {"id": "1"}, AsyncMock(return_value=output)
+        )
+        == output
+    )
+    assert db.published == []
+
+    async def followed():
+        db.sadd("inflight:followers:2", "results:host:2")
+        return output
+
+    await singleflight.run("abc.png", 1, {"id": "2"}, followed)
+    assert db.published == [("results:host:2", {"id": "2", "output": output})]
+    assert db.values == db.sets == {}
+
+
+@pytest.mark.asyncio
+async def test_owner_keeps_marker_of_a_newer_owner():
+    db = FakeRedis()
+    singleflight = SingleFlight(db, make_results(), ttl=5)
+    newer = json.dumps({"id": "2", "top_k": 1})
+
+    async def timed_out():
+        # The marker of this owner expired and another worker took over
+        db.values["inflight:abc"] = newer.encode()
+        raise TimeoutError("Model prediction timed out")
+
+    with pytest.raises(TimeoutError):
+        await singleflight.run("abc.png", 1, {"id": "1"}, timed_out)
+    assert db.values == {"inflight:abc": newer.encode()}
@@ -34,3 +34,44 @@ async def test_get_file_hash():
     new_filename = await utils.get_file_hash(file)
 
     assert md5_filename == new_filename
+
+
+def test_spool_upload(tmp_path):
+    md5_filename = "0a7c757a80f2c5b13fa7a2a47a683593.jpeg"
+    with open("tests/dog.jpeg", "rb") as fp:
+        content = fp.read()
+
+    new_filename = utils.spool_upload(
+        BytesIO(content), "dog.JPEG", str(tmp_path), max_bytes=len(content)
+    )
+
+    assert new_filename == md5_filename
+    assert (tmp_path / md5_filename).read_bytes() == content
+    # Same content again: nothing new, no temporary file left behind
+    utils.spool_upload(BytesIO(content), "dog.jpeg", str(tmp_path), len(content))
+    assert os.listdir(tmp_path) == [md5_filename]
+
+    with pytest.raises(utils.UploadTooLarge):
+        utils.spool_upload(BytesIO(content), "big.jpeg", str(tmp_path), 1024)
+    assert os.listdir(tmp_path) == [md5_filename]
+
+
+def test_save_file(tmp_path):
+    path = tmp_path / "abc.jpeg"
+    utils.save_file(str(path), b"first")
+    assert path.read_bytes() == b"first"
+    assert oct(path.stat().st_mode & 0o777) == oct(0o644)
+
+    # Already there: left untouched, no temporary file left behind
+    utils.save_file(str(path), b"second")
+    assert path.read_bytes() == b"first"
+    assert os.listdir(tmp_path) == ["abc.jpeg"]
+
+
+def test_etag_matches():
+    assert utils.etag_matches('"abc"', '"abc"')
+    assert utils.etag_matches('"xyz", W/"abc"', '"abc"')
+    assert utils.etag_matches("*", '"abc"')
+
+    assert not utils.etag_matches(None, '"abc"')
+    assert not utils.etag_matches('"xyz"', '"abc"')
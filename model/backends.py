@@ -0,0 +1,146 @@
+import numpy as np
+import settings
+import tensorflow as tf
+
+# Every backend takes a preprocessed float32 batch of shape (N, 224, 224, 3)
+# and returns the (N, 1000) matrix of class probabilities. The TFLite and ONNX
+# artifacts are produced from the Keras model by `convert_model.py`.
+BACKENDS = ("keras", "tflite", "onnx")
+
+
+class KerasBackend:
+    """
+    Run the Keras model directly. `predict_on_batch` skips the data adapter
+    and callbacks machinery `model.predict` sets up on every call.
+    """
+
+    name = "keras"
+    # Whether `predict_with_embeddings` is available
+    embeddings = True
+
+    def __init__(self, model):
+        self.model = model
+        self.embedding_model = None
+
+    def predict(self, x):
+        return np.asarray(self.model.predict_on_batch(x))
+
+    def predict_with_embeddings(self, x):
+        """
+        Class probabilities and pooled embeddings of shape (N, 2048), from
+        the same forward pass.
+        """
+        if self.embedding_model is None:
+            self.embedding_model = tf.keras.Model(
+                self.model.input,
+                [self.model.output, self.model.get_layer("avg_pool").output],
+            )
+        probs, embeddings = self.embedding_model.predict_on_batch(x)
+        return np.asarray(probs), np.asarray(embeddings)
+
+
+class TFLiteBackend:
+    """
+    Run a TFLite flatbuffer with the TFLite interpreter.
+
+    The interpreter is not thread safe, it must only be used from the
+    inference loop.
+    """
+
+    name = "tflite"
+    embeddings = False
+
+    def __init__(self, path, threads=None):
+        self.interpreter = tf.lite.Interpreter(model_path=path, num_threads=threads)
+        self.input_index = self.interpreter.get_input_details()[0]["index"]
+        self.output_index = self.interpreter.get_output_details()[0]["index"]
+        self.batch_size = None
+
+    def predict(self, x):
+        x = np.asarray(x, dtype=np.float32)
+        if x.shape[0] != self.batch_size:
+            self.interpreter.resize_tensor_input(self.input_index, x.shape)
+            self.interpreter.allocate_tensors()
+            self.batch_size = x.shape[0]
+
+        self.interpreter.set_tensor(self.input_index, x)
+        self.interpreter.invoke()
+        return self.interpreter.get_tensor(self.output_index)
+
+
+class OnnxBackend:
+    """
+    Run an ONNX graph with ONNX Runtime on the CPU. Needs the optional
+    `onnxruntime` package.
+    """
+
+    name = "onnx"
+    embeddings = False
+
+    def __init__(self, path, threads=None):
+        try:
+            import onnxruntime as ort
+        except ImportError as exc:
+            raise ImportError(
+                "The onnx backend needs onnxruntime: pip install onnxruntime"
+            ) from exc
+
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = threads or 0
+        self.session = ort.InferenceSession(
+            path, options, providers=["CPUExecutionProvider"]
+        )
+        self.input_name = self.session.get_inputs()[0].name
+
+    def predict(self, x):
+        x = np.asarray(x, dtype=np.float32)
+        return self.session.run(None, {self.input_name: x})[0]
+
+
+def artifact_path(name, int8=False):
+    """
+    Path of the model artifact used by a non-Keras backend.
+
+    Parameters
+    ----------
+    name : str
+        "tflite" or "onnx".
+    int8 : bool
+        Whether to use the int8-quantized variant.
+
+    Returns
+    -------
+    path : str
+    """
+    paths = {
+        ("tflite", False): settings.TFLITE_PATH,
+        ("tflite", True): settings.TFLITE_INT8_PATH,
+        ("onnx", False): settings.ONNX_PATH,
+        ("onnx", True): settings.ONNX_INT8_PATH,
+    }
+    if (name, int8) not in paths:
+        raise ValueError(f"Unknown inference backend {name!r}, use one of {BACKENDS}")
+    return paths[(name, int8)]
+
+
+def load(name, int8=False, threads=None):
+    """
+    Create a TFLite or ONNX Runtime backend from its artifact.
+
+    Parameters
+    ----------
+    name : str
+        "tflite" or "onnx".
+    int8 : bool
+        Whether to use the int8-quantized variant.
+    threads : int, optional
+        Intra-op threads, None lets the runtime decide.
+
+    Returns
+    -------
+    backend : TFLiteBackend or OnnxBackend
+    """
+    path = artifact_path(name, int8)
+    if name == "tflite":
+        return TFLiteBackend(path, threads)
+    return OnnxBackend(path, threads)
@@ -0,0 +1,126 @@
+import argparse
+import io
+import os
+import time
+
+import ml_service
+import numpy as np
+import settings
+from PIL import Image
+from tensorflow.keras.applications.resnet50 import preprocess_input
+from tensorflow.keras.preprocessing import image
+
+# Typical phone camera resolutions
+SIZES = {"3mp": (2048, 1536), "12mp": (4032, 3024), "24mp": (6000, 4000)}
+
+
+def make_samples(folder, limit, size):
+    """
+    Upscale the sample images to a large resolution and encode them as JPEG,
+    like photos straight from a phone.
+
+    Parameters
+    ----------
+    folder : str
+        Folder with the source images.
+    limit : int
+        Maximum number of images to use.
+    size : tuple(int, int)
+        Target (width, height).
+
+    Returns
+    -------
+    samples : list(bytes)
+        JPEG file contents.
+    """
+    names = sorted(
+        name
+        for name in os.listdir(folder)
+        if name.lower().rsplit(".", 1)[-1] in {"jpg", "jpeg", "png", "gif"}
+    )[:limit]
+    if not names:
+        raise SystemExit(f"No sample images found in {folder}")
+
+    samples = []
+    for name in names:
+        with Image.open(os.path.join(folder, name)) as img:
+            img = img.convert("RGB").resize(size, Image.BICUBIC)
+        buffer = io.BytesIO()
+        img.save(buffer, format="JPEG", quality=90)
+        samples.append(buffer.getvalue())
+    return samples
+
+
+def keras_load(data):
+    """
+    The previous loader: full decode with `load_img`, then resize.
+    """
+    img = image.load_img(io.BytesIO(data), target_size=(224, 224))
+    return image.img_to_array(img)
+
+
+def fast_load(data):
+    return ml_service.load_image("sample.jpeg", data)
+
+
+def time_loader(loader, samples, rounds):
+    """
+    Milliseconds per image of a loader, best of `rounds`.
+    """
+    best = float("inf")
+    for _ in range(rounds):
+        start = time.monotonic()
+        for data in samples:
+            loader(data)
+        best = min(best, time.monotonic() - start)
+    return 1000 * best / len(samples)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compare the fast image loader with a full-resolution decode"
+    )
+    parser.add_argument(
+        "--samples", default="tests", help="folder with the source images"
+    )
+    parser.add_argument("--limit", type=int, default=8)
+    parser.add_argument("--rounds", type=int, default=3)
+    parser.add_argument("--sizes", nargs="+", choices=list(SIZES), default=list(SIZES))
+    parser.add_argument(
+        "--predict",
+        action="store_true",
+        help="also compare the model predictions of both loaders",
+    )
+    args = parser.parse_args()
+
+    settings.FAST_DECODE = True
+    backend = ml_service.load_backend() if args.predict else None
+
+    print(
+        f"{'size':<6} {'keras ms':>9} {'fast ms':>8} {'speedup':>8} "
+        f"{'top1':>6} {'max_diff':>9}"
+    )
+    for label in args.sizes:
+        samples = make_samples(args.samples, args.limit, SIZES[label])
+        keras_ms = time_loader(keras_load, samples, args.rounds)
+        fast_ms = time_loader(fast_load, samples, args.rounds)
+
+        top1, max_diff = float("nan"), float("nan")
+        if args.predict:
+            reference = backend.predict(
+                preprocess_input(np.stack([keras_load(d) for d in samples]))
+            )
+            probs = backend.predict(
+                preprocess_input(np.stack([fast_load(d) for d in samples]))
+            )
+            top1 = float(np.mean(probs.argmax(axis=1) == reference.argmax(axis=1)))
+            max_diff = float(np.abs(probs - reference).max())
+
+        print(
+            f"{label:<6} {keras_ms:>9.1f} {fast_ms:>8.1f} "
+            f"{keras_ms / fast_ms:>7.1f}x {top1:>6.3f} {max_diff:>9.4f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
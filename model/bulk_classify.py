@@ -0,0 +1,307 @@
+import argparse
+import collections
+import hashlib
+import json
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import ml_service
+import numpy as np
+import settings
+from tensorflow.keras.applications.resnet50 import preprocess_input
+
+logger = logging.getLogger("bulk_classify")
+
+IMAGE_EXTENSIONS = {"jpg", "jpeg", "png", "gif"}
+
+
+def list_images(source):
+    """
+    Paths of the images to classify.
+
+    Parameters
+    ----------
+    source : str
+        Directory, walked recursively for .jpg/.jpeg/.png/.gif files, or
+        manifest file with one image path per line. Relative manifest paths
+        are relative to the manifest, blank lines and "#" comments are
+        ignored.
+
+    Returns
+    -------
+    paths : list(str)
+    """
+    if os.path.isdir(source):
+        paths = []
+        for root, dirs, files in os.walk(source):
+            dirs.sort()
+            for name in sorted(files):
+                if name.lower().rsplit(".", 1)[-1] in IMAGE_EXTENSIONS:
+                    paths.append(os.path.join(root, name))
+        return paths
+
+    base = os.path.dirname(source)
+    with open(source) as f:
+        lines = (line.strip() for line in f)
+        return [
+            os.path.join(base, line)
+            for line in lines
+            if line and not line.startswith("#")
+        ]
+
+
+def load_checkpoint(path):
+    """
+    Read the results already written to the output file, which is the
+    checkpoint of the run.
+
+    A truncated last line, left by a run that was killed mid-write, is
+    ignored. Failed images are not considered done, so they are retried.
+
+    Parameters
+    ----------
+    path : str
+        JSONL output file.
+
+    Returns
+    -------
+    done : set(str)
+        Paths classified successfully.
+    known : dict
+        Model output of every classified content hash (MD5 hex digest).
+    """
+    done, known = set(), {}
+    if not os.path.exists(path):
+        return done, known
+
+    with open(path) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if record.get("prediction") == "error":
+                continue
+            done.add(record["path"])
+            known[record["md5"]] = {
+                key: value
+                for key, value in record.items()
+                if key in ("prediction", "score", "top_k")
+            }
+    return done, known
+
+
+def read_and_load(path, known):
+    """
+    Hash an image and, unless its content was already classified, decode and
+    preprocess it. Runs on the decode thread pool.
+
+    Parameters
+    ----------
+    path : str
+        Image file.
+    known : dict
+        Model output of every classified content hash.
+
+    Returns
+    -------
+    path, digest, x, error : tuple(str, str, np.ndarray, str)
+        `x` is None for known content and for images that couldn't be
+        loaded, in which case `error` says why.
+    """
+    try:
+        with open(path, "rb") as f:
+            data = f.read()
+        digest = hashlib.md5(data).hexdigest()
+        if digest in known:
+            return path, digest, None, None
+        x = preprocess_input(ml_service.load_image(path, data))
+        return path, digest, x, None
+    except Exception as exc:
+        return path, None, None, f"{type(exc).__name__}: {exc}"
+
+
+def iter_batches(pool, paths, known, batch_size, depth):
+    """
+    Yield batches of loaded images, keeping up to `depth` images decoding
+    ahead so the thread pool works while the model runs.
+
+    Parameters
+    ----------
+    pool : ThreadPoolExecutor
+        Pool running `read_and_load`.
+    paths : list(str)
+        Images to load, in order.
+    known : dict
+        Model output of every classified content hash.
+    batch_size : int
+        Images per batch.
+    depth : int
+        Maximum number of images submitted to the pool.
+
+    Yields
+    ------
+    batch : list(tuple)
+        `read_and_load` results.
+    """
+    paths = iter(paths)
+    pending = collections.deque()
+
+    def fill():
+        while len(pending) < depth:
+            path = next(paths, None)
+            if path is None:
+                return
+            pending.append(pool.submit(read_and_load, path, known))
+
+    fill()
+    while pending:
+        size = min(batch_size, len(pending))
+        batch = [pending.popleft().result() for _ in range(size)]
+        fill()
+        yield batch
+
+
+def classify_batch(batch, known, top_k):
+    """
+    Run the model over the images of a batch that need it and build the
+    output records, reusing the outputs of known content.
+
+    Parameters
+    ----------
+    batch : list(tuple)
+        `read_and_load` results.
+    known : dict
+        Model output of every classified content hash, updated in place.
+    top_k : int
+        Number of (class_name, score) pairs to keep per image.
+
+    Returns
+    -------
+    records : list(dict)
+    inferred : int
+        Number of images that went through the model.
+    """
+    # Content seen since the image was loaded, or twice in the batch, only
+    # goes through the model once
+    to_infer = {}
+    for _, digest, x, _ in batch:
+        if x is not None and digest not in known:
+            to_infer.setdefault(digest, x)
+
+    if to_infer:
+        predictions = ml_service.classify(np.stack(list(to_infer.values())), top_k)
+        for digest, top in zip(to_infer, predictions):
+            class_name, score = top[0]
+            output = {"prediction": class_name, "score": score}
+            if top_k > 1:
+                output["top_k"] = top
+            known[digest] = output
+
+    records = []
+    for path, digest, _, error in batch:
+        if error is not None:
+            records.append(
+                {"path": path, "prediction": "error", "score": 0.0, "error": error}
+            )
+        else:
+            records.append({"path": path, "md5": digest, **known[digest]})
+    return records, len(to_infer)
+
+
+def run(source, output, batch_size, workers, top_k):
+    """
+    Classify every image of `source` not in `output` yet, appending one JSON
+    record per image to `output` and flushing after every batch.
+
+    Returns
+    -------
+    stats : dict
+        Counts of the run and images/s of the model.
+    """
+    paths = list_images(source)
+    done, known = load_checkpoint(output)
+    todo = [path for path in paths if path not in done]
+    logger.info(
+        "%d images, %d already classified, %d to go", len(paths), len(done), len(todo)
+    )
+
+    ml_service.load_backend()
+    ml_service.load_labels()
+
+    stats = {"classified": 0, "reused": 0, "errors": 0, "skipped": len(done)}
+    start = last_report = time.monotonic()
+    pool = ThreadPoolExecutor(workers, thread_name_prefix="decode")
+    with open(output, "a+") as f:
+        # Start on a fresh line after a record truncated by a killed run
+        if f.tell():
+            f.seek(f.tell() - 1)
+            if f.read(1) != "\n":
+                f.write("\n")
+        for batch in iter_batches(pool, todo, known, batch_size, 4 * batch_size):
+            records, inferred = classify_batch(batch, known, top_k)
+            for record in records:
+                f.write(json.dumps(record) + "\n")
+            f.flush()
+
+            errors = sum(1 for record in records if record["prediction"] == "error")
+            stats["classified"] += inferred
+            stats["errors"] += errors
+            stats["reused"] += len(records) - inferred - errors
+
+            now = time.monotonic()
+            if now - last_report >= settings.STATS_INTERVAL:
+                processed = stats["classified"] + stats["reused"] + stats["errors"]
+                logger.info(
+                    "%d/%d images, %.1f images/s",
+                    processed,
+                    len(todo),
+                    processed / (now - start),
+                )
+                last_report = now
+    pool.shutdown()
+
+    elapsed = time.monotonic() - start
+    processed = stats["classified"] + stats["reused"] + stats["errors"]
+    stats["seconds"] = round(elapsed, 3)
+    stats["images_per_second"] = round(processed / elapsed, 2) if elapsed else 0.0
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Classify a directory or manifest of images into a JSONL file"
+    )
+    parser.add_argument("source", help="image directory or manifest file")
+    parser.add_argument(
+        "-o",
+        "--output",
+        default="predictions.jsonl",
+        help="JSONL results, also the checkpoint a rerun resumes from",
+    )
+    parser.add_argument("--batch-size", type=int, default=settings.BATCH_SIZE)
+    parser.add_argument("--workers", type=int, default=settings.DECODE_WORKERS)
+    parser.add_argument("--top-k", type=int, default=1)
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s"
+    )
+    ml_service.configure_process()
+    stats = run(args.source, args.output, args.batch_size, args.workers, args.top_k)
+    logger.info(
+        "Done: %d classified, %d reused, %d errors, %d skipped in %.1fs "
+        "(%.1f images/s)",
+        stats["classified"],
+        stats["reused"],
+        stats["errors"],
+        stats["skipped"],
+        stats["seconds"],
+        stats["images_per_second"],
+    )
+
+
+if __name__ == "__main__":
+    main()
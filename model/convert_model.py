@@ -0,0 +1,206 @@
+import argparse
+import os
+import time
+
+import backends
+import ml_service
+import numpy as np
+import settings
+import tensorflow as tf
+from tensorflow.keras.applications.resnet50 import preprocess_input
+
+
+def load_samples(folder, limit):
+    """
+    Load and preprocess the images of a folder, used both to calibrate the
+    int8 quantization and to measure agreement with Keras.
+
+    Parameters
+    ----------
+    folder : str
+        Folder with .jpg/.jpeg/.png/.gif images.
+    limit : int
+        Maximum number of images to load.
+
+    Returns
+    -------
+    x : np.ndarray
+        Preprocessed batch of shape (N, 224, 224, 3).
+    """
+    settings.UPLOAD_FOLDER = folder
+    names = sorted(
+        name
+        for name in os.listdir(folder)
+        if name.lower().rsplit(".", 1)[-1] in {"jpg", "jpeg", "png", "gif"}
+    )[:limit]
+    if not names:
+        raise SystemExit(f"No sample images found in {folder}")
+    return preprocess_input(np.stack([ml_service.load_image(name) for name in names]))
+
+
+def to_tflite(model, path, samples=None):
+    """
+    Convert the Keras model to a TFLite flatbuffer.
+
+    Parameters
+    ----------
+    model : tf.keras.Model
+        Model to convert.
+    path : str
+        Destination file.
+    samples : np.ndarray, optional
+        Preprocessed images. When given, weights and activations are
+        quantized to int8 calibrating on them; inputs and outputs stay float.
+    """
+    converter = tf.lite.TFLiteConverter.from_keras_model(model)
+    if samples is not None:
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.representative_dataset = lambda: ([x[None]] for x in samples)
+
+    with open(path, "wb") as f:
+        f.write(converter.convert())
+
+
+def to_onnx(model, path):
+    """
+    Convert the Keras model to an ONNX graph. Needs the optional `tf2onnx`
+    package.
+
+    Parameters
+    ----------
+    model : tf.keras.Model
+        Model to convert.
+    path : str
+        Destination file.
+    """
+    import tf2onnx
+
+    spec = (tf.TensorSpec((None, 224, 224, 3), tf.float32, name="input"),)
+    tf2onnx.convert.from_keras(model, input_signature=spec, output_path=path)
+
+
+def quantize_onnx(path, int8_path, samples):
+    """
+    Quantize weights and activations of an ONNX graph to int8, calibrating
+    on the sample images. Needs the optional `onnxruntime` package.
+
+    Parameters
+    ----------
+    path : str
+        Float ONNX graph.
+    int8_path : str
+        Destination file.
+    samples : np.ndarray
+        Preprocessed images.
+    """
+    from onnxruntime.quantization import (
+        CalibrationDataReader,
+        QuantFormat,
+        QuantType,
+        quantize_static,
+    )
+
+    class SampleReader(CalibrationDataReader):
+        def __init__(self):
+            self.batches = iter([{"input": x[None]} for x in samples])
+
+        def get_next(self):
+            return next(self.batches, None)
+
+    quantize_static(
+        path,
+        int8_path,
+        SampleReader(),
+        quant_format=QuantFormat.QDQ,
+        activation_type=QuantType.QInt8,
+        weight_type=QuantType.QInt8,
+        per_channel=True,
+    )
+
+
+def agreement(reference, backend, samples):
+    """
+    Compare a backend with the Keras baseline on the sample images.
+
+    Parameters
+    ----------
+    reference : np.ndarray
+        Keras probabilities for the samples.
+    backend : object
+        Backend to evaluate.
+    samples : np.ndarray
+        Preprocessed images.
+
+    Returns
+    -------
+    report : dict
+        Top-1 agreement ratio, max absolute probability difference and
+        milliseconds per image for a single batch.
+    """
+    start = time.monotonic()
+    probs = backend.predict(samples)
+    elapsed = time.monotonic() - start
+
+    return {
+        "top1_agreement": float(
+            np.mean(probs.argmax(axis=1) == reference.argmax(axis=1))
+        ),
+        "max_abs_diff": float(np.abs(probs - reference).max()),
+        "ms_per_image": 1000 * elapsed / len(samples),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Produce TFLite/ONNX artifacts from the Keras model"
+    )
+    parser.add_argument(
+        "--formats",
+        nargs="+",
+        choices=["tflite", "onnx"],
+        default=["tflite", "onnx"],
+    )
+    parser.add_argument(
+        "--int8", action="store_true", help="also produce int8-quantized variants"
+    )
+    parser.add_argument(
+        "--samples", default="tests", help="folder with calibration images"
+    )
+    parser.add_argument("--limit", type=int, default=32)
+    args = parser.parse_args()
+
+    model = ml_service.load_model()
+    samples = load_samples(args.samples, args.limit)
+    os.makedirs(os.path.dirname(settings.TFLITE_PATH) or ".", exist_ok=True)
+
+    if "tflite" in args.formats:
+        to_tflite(model, settings.TFLITE_PATH)
+        if args.int8:
+            to_tflite(model, settings.TFLITE_INT8_PATH, samples)
+    if "onnx" in args.formats:
+        to_onnx(model, settings.ONNX_PATH)
+        if args.int8:
+            quantize_onnx(settings.ONNX_PATH, settings.ONNX_INT8_PATH, samples)
+
+    keras = backends.KerasBackend(model)
+    reference = keras.predict(samples)
+
+    candidates = [("keras", keras)]
+    for name in args.formats:
+        candidates.append((name, backends.load(name)))
+        if args.int8:
+            candidates.append((f"{name}-int8", backends.load(name, int8=True)))
+
+    print(f"{'backend':<12} {'top1':>6} {'max_diff':>9} {'ms/img':>8}")
+    for label, backend in candidates:
+        # First call allocates buffers and traces graphs, don't time it
+        backend.predict(samples)
+        report = agreement(reference, backend, samples)
+        print(
+            f"{label:<12} {report['top1_agreement']:>6.3f} "
+            f"{report['max_abs_diff']:>9.4f} {report['ms_per_image']:>8.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,185 @@
+import fcntl
+import os
+import threading
+
+import numpy as np
+
+DIM = 2048
+
+
+class EmbeddingStore:
+    """
+    Append-only store of L2-normalized image embeddings, one per content
+    hash, shared by every worker process through the filesystem.
+
+    Vectors are kept as raw float16 rows in `vectors.f16` and their IDs, one
+    per line in row order, in `ids.txt`. Only the ID index lives in memory;
+    searches memory-map the matrix and scan it in blocks, so the store can
+    outgrow the RAM. Appends from several processes are serialized with an
+    exclusive lock on the ID file, and threads of a process share the ID
+    index under a lock.
+
+    Parameters
+    ----------
+    path : str
+        Folder of the store, created if needed.
+    dim : int
+        Size of the embeddings.
+    """
+
+    def __init__(self, path, dim=DIM):
+        os.makedirs(path, exist_ok=True)
+        self.vectors_path = os.path.join(path, "vectors.f16")
+        self.ids_path = os.path.join(path, "ids.txt")
+        self.dim = dim
+        self.row_bytes = 2 * dim
+        self.ids = []
+        self.index = {}
+        self.ids_offset = 0
+        self.lock = threading.Lock()
+        open(self.ids_path, "a").close()
+        open(self.vectors_path, "ab").close()
+        self.refresh()
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, id_):
+        return id_ in self.index
+
+    def refresh(self):
+        """
+        Pick up the IDs appended by other processes since the last call.
+        """
+        with self.lock:
+            with open(self.ids_path, "rb") as f:
+                f.seek(self.ids_offset)
+                chunk = f.read()
+            # A line without its newline is still being written
+            complete = chunk[: chunk.rfind(b"\n") + 1]
+            for line in complete.decode("ascii").splitlines():
+                self.index[line] = len(self.ids)
+                self.ids.append(line)
+            self.ids_offset += len(complete)
+
+    def add(self, ids, vectors):
+        """
+        Normalize and append the embeddings of IDs not stored yet.
+
+        Parameters
+        ----------
+        ids : list(str)
+            Content hashes.
+        vectors : np.ndarray
+            Embeddings of shape (len(ids), dim).
+
+        Returns
+        -------
+        added : int
+            Number of new rows.
+        """
+        vectors = normalize(vectors)
+        with open(self.ids_path, "ab") as ids_file:
+            fcntl.flock(ids_file, fcntl.LOCK_EX)
+            try:
+                self.refresh()
+                rows, new_ids, seen = [], [], set()
+                for id_, vector in zip(ids, vectors):
+                    if id_ in self.index or id_ in seen:
+                        continue
+                    seen.add(id_)
+                    new_ids.append(id_)
+                    rows.append(vector)
+                if not rows:
+                    return 0
+
+                with open(self.vectors_path, "r+b") as f:
+                    # Drop rows of an append that died before writing its IDs
+                    f.truncate(len(self.ids) * self.row_bytes)
+                    f.seek(0, os.SEEK_END)
+                    f.write(np.stack(rows).astype(np.float16).tobytes())
+                ids_file.write("".join(f"{id_}\n" for id_ in new_ids).encode("ascii"))
+                ids_file.flush()
+                self.refresh()
+            finally:
+                fcntl.flock(ids_file, fcntl.LOCK_UN)
+        return len(new_ids)
+
+    def get(self, id_):
+        """
+        Stored embedding of an ID, None if unknown.
+        """
+        self.refresh()
+        row = self.index.get(id_)
+        if row is None:
+            return None
+        return np.array(self._matrix(row + 1)[row], dtype=np.float32)
+
+    def _matrix(self, rows):
+        return np.memmap(
+            self.vectors_path, dtype=np.float16, mode="r", shape=(rows, self.dim)
+        )
+
+    def search(self, query, k, exclude=(), block_rows=8192):
+        """
+        Find the `k` stored embeddings most similar to `query` by cosine
+        similarity, scanning the memory-mapped matrix `block_rows` rows at a
+        time and keeping a running top-k.
+
+        Parameters
+        ----------
+        query : np.ndarray
+            Embedding of shape (dim,).
+        k : int
+            Number of neighbours.
+        exclude : iterable(str)
+            IDs left out of the results, e.g. the query image itself.
+        block_rows : int
+            Rows converted to float32 and scored at once.
+
+        Returns
+        -------
+        neighbours : list(tuple(str, float))
+            (id, cosine similarity) pairs by decreasing similarity.
+        """
+        self.refresh()
+        rows = len(self.ids)
+        exclude = {self.index[id_] for id_ in exclude if id_ in self.index}
+        wanted = k + len(exclude)
+        if rows == 0 or k <= 0:
+            return []
+
+        query = normalize(query[None])[0]
+        matrix = self._matrix(rows)
+        best_rows = np.empty(0, dtype=np.int64)
+        best_scores = np.empty(0, dtype=np.float32)
+        for start in range(0, rows, block_rows):
+            block = np.asarray(matrix[start : start + block_rows], dtype=np.float32)
+            scores = block @ query
+            if len(scores) > wanted:
+                top = np.argpartition(-scores, wanted - 1)[:wanted]
+            else:
+                top = np.arange(len(scores))
+            best_rows = np.concatenate([best_rows, top + start])
+            best_scores = np.concatenate([best_scores, scores[top]])
+            if len(best_scores) > wanted:
+                keep = np.argpartition(-best_scores, wanted - 1)[:wanted]
+                best_rows, best_scores = best_rows[keep], best_scores[keep]
+
+        order = np.argsort(-best_scores, kind="stable")
+        neighbours = [
+            (self.ids[row], round(float(score), 4))
+            for row, score in zip(best_rows[order], best_scores[order])
+            if row not in exclude
+        ]
+        return neighbours[:k]
+
+
+def normalize(vectors):
+    """
+    Scale the rows of `vectors` to unit L2 norm, so cosine similarity is a
+    dot product.
+    """
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
@@ -1,13 +1,29 @@
+import argparse
+import io
 import json
+import logging
+import multiprocessing
 import os
+import queue
+import shutil
+import signal
+import socket
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing.connection import wait
 
+import backends
+import embeddings
+import metrics
 import numpy as np
+import queues
 import redis
 import settings
+import tensorflow as tf
+from PIL import Image
 from tensorflow.keras.applications import ResNet50
-from tensorflow.keras.applications.resnet50 import decode_predictions, preprocess_input
-from tensorflow.keras.preprocessing import image
+from tensorflow.keras.applications.resnet50 import preprocess_input
 
 db = redis.StrictRedis(
     host=settings.REDIS_IP,
@@ -15,8 +31,436 @@ db = redis.StrictRedis(
     db=settings.REDIS_DB_ID,
     decode_responses=True,
 )
+# Uploads sent through Redis are raw bytes, they can't go through the
+# decoding client above
+raw_db = redis.StrictRedis(
+    host=settings.REDIS_IP,
+    port=settings.REDIS_PORT,
+    db=settings.REDIS_DB_ID,
+)
+
+logger = logging.getLogger(__name__)
+
+JOBS = metrics.Counter(
+    "ml_jobs_total",
+    "Jobs handled by the worker, by outcome: ok, error (the prediction "
+    "fallback) or expired (dropped past their deadline)",
+    ["outcome"],
+)
+ERRORS = metrics.Counter(
+    "ml_errors_total", "Exceptions caught by the worker", ["stage", "type"]
+)
+STAGE_SECONDS = metrics.Histogram(
+    "ml_stage_seconds",
+    "Seconds spent in each pipeline stage. queue_wait, read, decode, "
+    "preprocess and search are per job, wait, inference and write per batch",
+    ["stage"],
+)
+BATCH_JOBS = metrics.Histogram(
+    "ml_batch_jobs", "Jobs per inference batch", buckets=(1, 2, 4, 8, 16, 32, 64)
+)
+PREFETCHED_JOBS = metrics.Gauge(
+    "ml_prefetched_jobs", "Jobs pulled from Redis and waiting for inference"
+)
+
+# The model is built on first use so that the supervisor can fork consumer
+# processes before the TensorFlow runtime starts, see `supervise`.
+model = None
+backend = None
+labels = None
+embedding_store = None
+
+
+def load_model():
+    """
+    Load the model, once per process.
+
+    The pre-serialized artifact at `MODEL_PATH` is used when present, so the
+    service doesn't depend on downloading the imagenet weights at start up.
+
+    Returns
+    -------
+    model : tf.keras.Model
+        The loaded model.
+    """
+    global model
+    if model is None:
+        if os.path.exists(settings.MODEL_PATH):
+            model = tf.keras.models.load_model(settings.MODEL_PATH, compile=False)
+        else:
+            logger.warning(
+                "No model artifact at %s, building ResNet50", settings.MODEL_PATH
+            )
+            model = ResNet50(weights="imagenet")
+    return model
+
+
+def load_backend():
+    """
+    Create the `INFERENCE_BACKEND` backend, once per process.
+
+    Returns
+    -------
+    backend : backends.KerasBackend, backends.TFLiteBackend or
+        backends.OnnxBackend
+    """
+    global backend
+    if backend is None:
+        if settings.INFERENCE_BACKEND == "keras":
+            backend = backends.KerasBackend(load_model())
+        else:
+            threads = tf.config.threading.get_intra_op_parallelism_threads()
+            backend = backends.load(
+                settings.INFERENCE_BACKEND, settings.INFERENCE_INT8, threads or None
+            )
+        logger.info(
+            "Using the %s backend, int8=%s", backend.name, settings.INFERENCE_INT8
+        )
+    return backend
 
-model = ResNet50(weights="imagenet")
+
+def load_labels():
+    """
+    Load the imagenet class names as an array indexed by class id, once per
+    process. The bundled copy at `LABELS_PATH` is used when present.
+
+    Returns
+    -------
+    labels : np.ndarray
+        Array of 1000 class names.
+    """
+    global labels
+    if labels is None:
+        path = settings.LABELS_PATH
+        if not os.path.exists(path):
+            path = tf.keras.utils.get_file(
+                "imagenet_class_index.json",
+                settings.LABELS_URL,
+                cache_subdir="models",
+                file_hash=settings.LABELS_HASH,
+            )
+        with open(path) as f:
+            class_index = json.load(f)
+        labels = np.array([class_index[str(i)][1] for i in range(len(class_index))])
+    return labels
+
+
+def load_embedding_store():
+    """
+    Open the embedding store at `EMBEDDINGS_PATH`, once per process.
+
+    Returns
+    -------
+    store : embeddings.EmbeddingStore
+        None when `EMBEDDINGS` is off or the backend can't produce
+        embeddings.
+    """
+    global embedding_store
+    if embedding_store is None and settings.EMBEDDINGS:
+        if not load_backend().embeddings:
+            logger.warning(
+                "The %s backend has no embeddings, the store is disabled",
+                load_backend().name,
+            )
+            return None
+        embedding_store = embeddings.EmbeddingStore(settings.EMBEDDINGS_PATH)
+    return embedding_store
+
+
+def export_model(path=None):
+    """
+    Build ResNet50 with imagenet weights and save it as the local artifact
+    loaded by `load_model`. Used at image build time to bundle the weights.
+
+    Parameters
+    ----------
+    path : str, optional
+        Destination file, defaults to `MODEL_PATH`.
+    """
+    path = path or settings.MODEL_PATH
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+
+    root, ext = os.path.splitext(path)
+    tmp_path = f"{root}.tmp{ext}"
+    ResNet50(weights="imagenet").save(tmp_path)
+    os.replace(tmp_path, path)
+
+    class_index = tf.keras.utils.get_file(
+        "imagenet_class_index.json",
+        settings.LABELS_URL,
+        cache_subdir="models",
+        file_hash=settings.LABELS_HASH,
+    )
+    shutil.copyfile(class_index, settings.LABELS_PATH)
+
+
+def warm_up():
+    """
+    Run `WARMUP_ROUNDS` dummy predictions for a single image and for a full
+    batch, so graph tracing doesn't happen during live traffic.
+    """
+    for _ in range(settings.WARMUP_ROUNDS):
+        for size in sorted({1, settings.BATCH_SIZE}):
+            run_model(np.zeros((size, 224, 224, 3), dtype="float32"))
+
+
+def publish_ready(timings):
+    """
+    Keep a readiness key for this consumer alive in Redis.
+
+    The key expires `READY_TTL` seconds after the process stops refreshing
+    it, so it disappears shortly after the consumer dies.
+
+    Parameters
+    ----------
+    timings : dict
+        Start up phase timings, stored as the key value.
+    """
+    key = f"{settings.READY_KEY}:{socket.gethostname()}:{os.getpid()}"
+    value = json.dumps(timings)
+
+    def heartbeat():
+        while True:
+            try:
+                db.set(key, value, ex=settings.READY_TTL)
+            except redis.exceptions.RedisError:
+                logger.exception("Could not refresh readiness key")
+            time.sleep(settings.READY_TTL / 3)
+
+    db.set(key, value, ex=settings.READY_TTL)
+    threading.Thread(target=heartbeat, name="heartbeat", daemon=True).start()
+
+
+def start_up():
+    """
+    Load the model, warm it up and only then announce this consumer as
+    ready, reporting how long each phase took.
+
+    Returns
+    -------
+    timings : dict
+        Seconds spent on the "load" and "warmup" phases and in total.
+    """
+    start = time.monotonic()
+    load_backend()
+    load_labels()
+    load_embedding_store()
+    loaded = time.monotonic()
+    warm_up()
+    warmed = time.monotonic()
+
+    timings = {
+        "load": round(loaded - start, 3),
+        "warmup": round(warmed - loaded, 3),
+        "total": round(warmed - start, 3),
+    }
+    db.set(settings.MODEL_VERSION_KEY, settings.MODEL_VERSION)
+    publish_ready(timings)
+    logger.info(
+        "Start up took %.3fs (load=%.3fs warmup=%.3fs)",
+        timings["total"],
+        timings["load"],
+        timings["warmup"],
+    )
+    return timings
+
+
+def check_image_size(img):
+    """
+    Reject images whose header declares more than `MAX_IMAGE_PIXELS`
+    pixels, before any pixel data is decoded.
+
+    Parameters
+    ----------
+    img : PIL.Image.Image
+        Image opened but not loaded yet.
+
+    Raises
+    ------
+    ValueError
+        If the image is too large.
+    """
+    width, height = img.size
+    if width * height > settings.MAX_IMAGE_PIXELS:
+        raise ValueError(
+            f"Image of {width}x{height} pixels exceeds the "
+            f"{settings.MAX_IMAGE_PIXELS} pixels limit"
+        )
+
+
+def load_image(image_name, data=None):
+    """
+    Load an uploaded image and turn it into a model-sized array.
+
+    Only the header is parsed first, so oversized images and decompression
+    bombs are rejected before decoding anything. JPEGs are then decoded in
+    draft mode: libjpeg scales the DCT blocks down by 1/2, 1/4 or 1/8 while
+    decoding, to the smallest size still at least `DECODE_MIN_SIZE` pixels
+    on both sides, which skips most of the work for large photos. The result
+    is resized to 224x224 with nearest neighbour like
+    `keras.preprocessing.image.load_img`. Set `FAST_DECODE=0` to decode at
+    full resolution instead.
+
+    Parameters
+    ----------
+    image_name : str
+        Image filename.
+    data : bytes, optional
+        Image file content. When given it's decoded from memory instead of
+        reading the file from `UPLOAD_FOLDER`.
+
+    Returns
+    -------
+    x : np.ndarray
+        Array of shape (224, 224, 3), not yet preprocessed.
+
+    Raises
+    ------
+    ValueError
+        If the image has more than `MAX_IMAGE_PIXELS` pixels.
+    """
+    if data is not None:
+        source = io.BytesIO(data)
+    else:
+        source = os.path.join(settings.UPLOAD_FOLDER, image_name)
+
+    with Image.open(source) as img:
+        check_image_size(img)
+        if settings.FAST_DECODE and img.format == "JPEG":
+            img.draft("RGB", (settings.DECODE_MIN_SIZE, settings.DECODE_MIN_SIZE))
+        if img.mode != "RGB":
+            img = img.convert("RGB")
+        if img.size != (224, 224):
+            img = img.resize((224, 224), Image.NEAREST)
+        return np.asarray(img, dtype=np.float32)
+
+
+def predict_batch(images):
+    """
+    Run our ML model once over a batch of already loaded images.
+
+    Parameters
+    ----------
+    images : list(np.ndarray)
+        Arrays of shape (224, 224, 3) as returned by `load_image`.
+
+    Returns
+    -------
+    predictions : list(tuple(str, float))
+        One (class_name, pred_probability) pair per input image, in order.
+    """
+    return [top[0] for top in classify(preprocess_input(np.stack(images)))]
+
+
+def run_model(x):
+    """
+    Forward pass over a preprocessed batch, also returning the pooled
+    embeddings when the embedding store is enabled.
+
+    Parameters
+    ----------
+    x : np.ndarray
+        Preprocessed batch of shape (N, 224, 224, 3).
+
+    Returns
+    -------
+    probs, vectors : tuple(np.ndarray, np.ndarray)
+        Class probabilities of shape (N, 1000) and embeddings of shape
+        (N, 2048), or None without the store.
+    """
+    if load_embedding_store() is None:
+        return load_backend().predict(x), None
+    return load_backend().predict_with_embeddings(x)
+
+
+def content_hash(job):
+    """
+    Content hash of the image of a job, uploads are named `<md5>.<ext>`.
+    """
+    image_name = job.get("image_name") or job.get("image_file_name")
+    return os.path.splitext(os.path.basename(image_name))[0]
+
+
+def find_similar(job, vector):
+    """
+    Nearest stored images of a "similar" job.
+
+    Parameters
+    ----------
+    job : dict
+        Job payload, "k" is the number of neighbours.
+    vector : np.ndarray
+        Embedding of the job image.
+
+    Returns
+    -------
+    similar : list(tuple(str, float))
+        (content hash, cosine similarity) pairs, the image itself excluded.
+    """
+    return load_embedding_store().search(
+        vector,
+        int(job.get("k") or 5),
+        exclude={content_hash(job)},
+        block_rows=settings.SEARCH_BLOCK_ROWS,
+    )
+
+
+def classify(x, top_k=1):
+    """
+    Run our ML model over a preprocessed batch and decode the `top_k` most
+    likely classes of every image.
+
+    Parameters
+    ----------
+    x : np.ndarray
+        Preprocessed batch of shape (N, 224, 224, 3).
+    top_k : int
+        Number of classes to decode per image.
+
+    Returns
+    -------
+    predictions : list(list(tuple(str, float)))
+        Per image, the (class_name, pred_probability) pairs sorted by
+        decreasing probability.
+    """
+    return decode(load_backend().predict(x), top_k)
+
+
+def decode(probs, top_k=1):
+    """
+    Decode the `top_k` most likely classes of a whole batch at once.
+
+    With top_k=1 this is a plain argmax, otherwise `argpartition` selects the
+    k best classes of every row and only those get sorted.
+
+    Parameters
+    ----------
+    probs : np.ndarray
+        Class probabilities of shape (N, 1000).
+    top_k : int
+        Number of classes to decode per image.
+
+    Returns
+    -------
+    predictions : list(list(tuple(str, float)))
+        Per image, the (class_name, pred_probability) pairs sorted by
+        decreasing probability.
+    """
+    names = load_labels()
+    top_k = min(max(int(top_k), 1), probs.shape[1])
+
+    if top_k == 1:
+        indices = probs.argmax(axis=1)[:, None]
+    else:
+        indices = np.argpartition(-probs, top_k - 1, axis=1)[:, :top_k]
+        order = np.argsort(-np.take_along_axis(probs, indices, axis=1), axis=1)
+        indices = np.take_along_axis(indices, order, axis=1)
+    scores = np.round(np.take_along_axis(probs, indices, axis=1), 4)
+
+    return [
+        [(str(name), float(score)) for name, score in zip(row_names, row_scores)]
+        for row_names, row_scores in zip(names[indices], scores)
+    ]
 
 
 def predict(image_name):
@@ -35,50 +479,723 @@ def predict(image_name):
         Model predicted class as a string and the corresponding confidence
         score as a number.
     """
-    img_path = os.path.join(settings.UPLOAD_FOLDER, image_name)
+    return predict_batch([load_image(image_name)])[0]
+
+
+def is_expired(job, now=None):
+    """
+    Whether the API already gave up waiting for this job.
+
+    Parameters
+    ----------
+    job : dict
+        Job payload, jobs without a "deadline" never expire.
+    now : float, optional
+        Current epoch time.
+
+    Returns
+    -------
+    expired : bool
+    """
+    deadline = job.get("deadline")
+    return deadline is not None and deadline < (now or time.time())
+
+
+def read_image(job):
+    """
+    Raw bytes of the image of a job.
+
+    Jobs with an "image_key" carry the image bytes in Redis; if they expired
+    or the job has none, the file is read from `UPLOAD_FOLDER`.
+
+    Parameters
+    ----------
+    job : dict
+        Job payload as pushed by the API.
+
+    Returns
+    -------
+    data : bytes
+    """
+    data = raw_db.get(job["image_key"]) if job.get("image_key") else None
+    if data is None:
+        image_name = job.get("image_name") or job.get("image_file_name")
+        with open(os.path.join(settings.UPLOAD_FOLDER, image_name), "rb") as f:
+            data = f.read()
+    return data
+
+
+def read_tensor(job):
+    """
+    Model-sized pixels of the image of a job, decoded by the API.
+
+    Parameters
+    ----------
+    job : dict
+        Job payload as pushed by the API.
+
+    Returns
+    -------
+    x : np.ndarray
+        Array of shape (224, 224, 3) like `load_image` returns, or None if
+        the job has no "tensor_key" or the pixels expired.
+    """
+    data = raw_db.get(job["tensor_key"]) if job.get("tensor_key") else None
+    if data is None or len(data) != 224 * 224 * 3:
+        return None
+    return np.frombuffer(data, dtype=np.uint8).reshape(224, 224, 3).astype(np.float32)
+
+
+def get_job_id(job):
+    """
+    Job ID of a job payload.
+    """
+    return job.get("id") or job.get("job_id")
+
+
+def prepare(job):
+    """
+    Decode and preprocess the image of a job, ready to be batched.
+
+    This runs on the decode thread pool so it overlaps with inference. Jobs
+    whose image the API already decoded only go through `preprocess_input`.
 
-    img = image.load_img(img_path, target_size=(224, 224))
-    x = image.img_to_array(img)
-    x = np.expand_dims(x, axis=0)
-    x = preprocess_input(x)
+    Parameters
+    ----------
+    job : dict
+        Job payload as pushed by the API.
+
+    Returns
+    -------
+    job, x, timings : tuple(dict, np.ndarray, dict)
+        `x` is None when the image couldn't be loaded. `timings` holds the
+        seconds spent on the "read", "decode" and "preprocess" stages.
+    """
+    image_name = job.get("image_name") or job.get("image_file_name")
+
+    timings = {"read": 0.0, "decode": 0.0, "preprocess": 0.0}
+    start = time.monotonic()
+    try:
+        # Decoded by the API with PREPROCESS_IN_API, read as is otherwise
+        img = read_tensor(job)
+        read = time.monotonic()
+        if img is None:
+            data = read_image(job)
+            read = time.monotonic()
+            img = load_image(image_name, data)
+        decoded = time.monotonic()
+        x = preprocess_input(img)
+        timings["read"] = read - start
+        timings["decode"] = decoded - read
+        timings["preprocess"] = time.monotonic() - decoded
+    except Exception as exc:
+        logger.warning("Could not load image %s: %s", image_name, exc)
+        ERRORS.inc(stage="load", type=type(exc).__name__)
+        x = None
+
+    for stage, seconds in timings.items():
+        STAGE_SECONDS.observe(seconds, stage=stage)
+
+    return job, x, timings
+
+
+def process_batch(prepared, searches=None):
+    """
+    Classify a batch of prepared jobs with a single forward pass of the model.
+
+    Jobs whose image couldn't be loaded get an error output without spoiling
+    the rest of the batch. Jobs asking for `top_k` > 1 also get the list of
+    their k most likely (class_name, score) pairs. With the embedding store
+    enabled, the embedding of every image is stored under its content hash
+    and "similar" jobs also get their `k` nearest stored images.
+
+    Parameters
+    ----------
+    prepared : list(tuple(dict, np.ndarray, dict))
+        Items as returned by `prepare`.
+    searches : list, optional
+        If given, classified "similar" jobs are left out of the results and
+        appended to it as (job, output, embedding) for `search_job`, instead
+        of being searched here.
+
+    Returns
+    -------
+    results : list(tuple(str, dict))
+        One (job_id, output) pair per job, but the ones in `searches`.
+    """
+    results = {}
+    loaded = []
+    for job, x, _ in prepared:
+        if x is None:
+            results[get_job_id(job)] = {"prediction": "error", "score": 0.0}
+        else:
+            loaded.append((job, x))
+
+    if loaded:
+        top_k = max(int(job.get("top_k") or 1) for job, _ in loaded)
+        try:
+            probs, vectors = run_model(np.stack([x for _, x in loaded]))
+            predictions = decode(probs, top_k)
+        except Exception as exc:
+            logger.exception("Inference failed for a batch of %d jobs", len(loaded))
+            ERRORS.inc(stage="inference", type=type(exc).__name__)
+            predictions = [[("error", 0.0)]] * len(loaded)
+            vectors = None
+
+        if vectors is not None:
+            try:
+                load_embedding_store().add(
+                    [content_hash(job) for job, _ in loaded], vectors
+                )
+            except Exception as exc:
+                logger.exception("Could not store the embeddings of a batch")
+                ERRORS.inc(stage="embeddings", type=type(exc).__name__)
+
+        for i, ((job, _), top) in enumerate(zip(loaded, predictions)):
+            class_name, pred_probability = top[0]
+            output = {"prediction": class_name, "score": pred_probability}
+            job_top_k = int(job.get("top_k") or 1)
+            if job_top_k > 1 and class_name != "error":
+                output["top_k"] = top[:job_top_k]
+            if job.get("task") == "similar":
+                if output["prediction"] == "error" or vectors is None:
+                    output = {"prediction": "error", "score": 0.0}
+                elif searches is not None:
+                    searches.append((job, output, vectors[i]))
+                    continue
+                else:
+                    output = with_similar(job, output, vectors[i])
+            results[get_job_id(job)] = output
+
+    return list(results.items())
+
+
+def with_similar(job, output, vector):
+    """
+    Add the nearest stored images to the output of a "similar" job, the
+    output becomes an error if they can't be searched.
+    """
+    try:
+        return {**output, "similar": find_similar(job, vector)}
+    except Exception as exc:
+        logger.exception("Similarity search failed for %s", get_job_id(job))
+        ERRORS.inc(stage="search", type=type(exc).__name__)
+        return {"prediction": "error", "score": 0.0}
+
+
+def search_job(job, output, vector, job_queue):
+    """
+    Run the similarity search of a classified "similar" job and store its
+    output, acknowledging the job.
+
+    Scanning the store takes far longer than classifying a batch, so this
+    runs on its own thread and never holds back the inference loop. Jobs
+    that expired while waiting for a search slot are only acknowledged.
+
+    Parameters
+    ----------
+    job : dict
+        Job payload.
+    output : dict
+        Classification of the job image.
+    vector : np.ndarray
+        Embedding of the job image.
+    job_queue : queues.ListQueue or queues.StreamQueue
+        Transport the job was read from.
+    """
+    if is_expired(job):
+        results, outcome = [], "expired"
+    else:
+        start = time.monotonic()
+        output = with_similar(job, output, vector)
+        STAGE_SECONDS.observe(time.monotonic() - start, stage="search")
+        results = [(get_job_id(job), output)]
+        outcome = "error" if output["prediction"] == "error" else "ok"
+    try:
+        store_results(results, [job], job_queue)
+    except Exception as exc:
+        # Left pending with the stream transport, another consumer claims it
+        logger.exception("Could not store the output of %s", get_job_id(job))
+        ERRORS.inc(stage="write", type=type(exc).__name__)
+        return
+    JOBS.inc(outcome=outcome)
+
+
+def submit_searches(searches, search_pool, slots, job_queue):
+    """
+    Hand classified "similar" jobs to the search pool, as long as fewer than
+    `SEARCH_BACKLOG` searches are waiting or running. Jobs past that get an
+    error output right away: their search would start long after the API
+    gave up, and with the stream transport they would be claimed and
+    classified again meanwhile.
+
+    Parameters
+    ----------
+    searches : list(tuple(dict, dict, np.ndarray))
+        (job, output, embedding) items filled by `process_batch`.
+    search_pool : ThreadPoolExecutor
+        Pool running `search_job`.
+    slots : threading.BoundedSemaphore
+        One slot per search waiting or running.
+    job_queue : queues.ListQueue or queues.StreamQueue
+        Transport the jobs were read from.
+
+    Returns
+    -------
+    refused : list(tuple(str, dict))
+        (job_id, output) pairs of the jobs turned away, to be stored with
+        the rest of the batch.
+    """
+    refused = []
+    for job, output, vector in searches:
+        if not slots.acquire(blocking=False):
+            ERRORS.inc(stage="search", type="BacklogFull")
+            refused.append((get_job_id(job), {"prediction": "error", "score": 0.0}))
+            continue
+        future = search_pool.submit(search_job, job, output, vector, job_queue)
+        future.add_done_callback(lambda _: slots.release())
+    return refused
+
+
+def prefetch_jobs(job_queue, pool, prefetch, throughput):
+    """
+    Loop indefinitely pulling jobs from Redis and handing them to the decode
+    pool. The futures are put on the bounded `prefetch` queue, so we stop
+    taking jobs from Redis while inference is behind.
+
+    Jobs past their deadline are dropped (and acknowledged) here: nobody is
+    waiting for their result anymore, and classifying them would only delay
+    live requests.
+
+    Parameters
+    ----------
+    job_queue : queues.ListQueue or queues.StreamQueue
+        Transport the jobs are read from.
+    pool : ThreadPoolExecutor
+        Pool running `prepare`.
+    prefetch : queue.Queue
+        Queue of futures consumed by the inference loop.
+    throughput : Throughput
+        Counters of the worker loop, dropped jobs are accounted there.
+    """
+    # This is the only thread feeding the inference loop: whatever goes wrong
+    # is logged and counted, and it keeps going
+    while True:
+        try:
+            jobs = job_queue.fetch()
+        except Exception as exc:
+            logger.exception("Could not fetch jobs from Redis")
+            ERRORS.inc(stage="fetch", type=type(exc).__name__)
+            time.sleep(1)
+            continue
 
-    preds = model.predict(x)
-    top1 = decode_predictions(preds, top=1)[0][0]
-    class_name = top1[1]
-    pred_probability = float(np.round(top1[2], 4))
+        now = time.time()
+        dropped = []
+        for job in jobs:
+            try:
+                if "enqueued_at" in job:
+                    STAGE_SECONDS.observe(now - job["enqueued_at"], stage="queue_wait")
+                if is_expired(job, now):
+                    dropped.append(job)
+                    continue
+            except Exception as exc:
+                # Malformed payload, acknowledged so it isn't claimed again
+                logger.exception("Dropping invalid job %r", job)
+                ERRORS.inc(stage="fetch", type=type(exc).__name__)
+                dropped.append(job)
+                continue
+            prefetch.put(pool.submit(prepare, job))
 
-    return class_name, pred_probability
+        if dropped:
+            throughput.expired += len(dropped)
+            JOBS.inc(len(dropped), outcome="expired")
+            try:
+                store_results([], dropped, job_queue)
+            except Exception as exc:
+                logger.exception("Could not acknowledge dropped jobs")
+                ERRORS.inc(stage="fetch", type=type(exc).__name__)
+
+
+def next_batch(prefetch):
+    """
+    Wait for the next prefetched job and take up to `BATCH_SIZE` of them.
+
+    Parameters
+    ----------
+    prefetch : queue.Queue
+        Queue of futures filled by `prefetch_jobs`.
+
+    Returns
+    -------
+    futures : list(concurrent.futures.Future)
+        Futures resolving to `prepare` results.
+    """
+    futures = [prefetch.get()]
+    while len(futures) < settings.BATCH_SIZE:
+        try:
+            futures.append(prefetch.get_nowait())
+        except queue.Empty:
+            break
+    return futures
+
+
+def store_results(results, jobs=(), job_queue=None):
+    """
+    Write a batch of job outputs back to Redis in a single round trip.
+
+    Outputs are stored under the job ID for the "result_ttl" of the job,
+    `RESULT_TTL` seconds by default, and also published on the "reply_to"
+    channel of jobs that have one. With the stream transport the jobs are
+    acknowledged in the same transaction, so a job is either answered and
+    acknowledged or still pending for another consumer to claim. The jobs
+    are also counted under `PROCESSED_KEY`, which the API reads to estimate
+    how fast the queue drains.
+
+    Parameters
+    ----------
+    results : list(tuple(str, dict))
+        (job_id, output) pairs as returned by `process_batch`.
+    jobs : list(dict)
+        Jobs of the batch, acknowledged on `job_queue`.
+    job_queue : queues.ListQueue or queues.StreamQueue, optional
+        Transport the jobs were read from.
+    """
+    reply_to = {get_job_id(job): job.get("reply_to") for job in jobs}
+    result_ttl = {get_job_id(job): job.get("result_ttl") for job in jobs}
+    pipe = db.pipeline()
+    for job_id, output in results:
+        ttl = result_ttl.get(job_id) or settings.RESULT_TTL
+        pipe.set(job_id, json.dumps(output), ex=ttl)
+        # Wakes up the API worker waiting for the job
+        if reply_to.get(job_id):
+            pipe.publish(reply_to[job_id], json.dumps({"id": job_id, "output": output}))
+    if job_queue is not None:
+        job_queue.ack(pipe, jobs)
+    pipe.incrby(settings.PROCESSED_KEY, len(jobs) or len(results))
+    pipe.execute()
+
+
+class Throughput:
+    """
+    Counters for the worker loop, logged every `interval` seconds.
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.jobs = 0
+        self.batches = 0
+        self.errors = 0
+        self.expired = 0
+        self.busy = 0.0
+        self.started = time.monotonic()
+        self.last_report = self.started
+        self.last_jobs = 0
+        self.stages = {}
+
+    def update(self, results, elapsed, timings):
+        """
+        Account for one processed batch and report if the interval elapsed.
+
+        Parameters
+        ----------
+        results : list(tuple(str, dict))
+            Outputs of the batch.
+        elapsed : float
+            Seconds the inference loop spent on the batch.
+        timings : dict
+            Seconds spent on each pipeline stage for the batch.
+        """
+        self.jobs += len(results)
+        self.batches += 1
+        self.errors += sum(1 for _, out in results if out["prediction"] == "error")
+        self.busy += elapsed
+        for stage, seconds in timings.items():
+            self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+        now = time.monotonic()
+        if now - self.last_report >= self.interval:
+            rate = (self.jobs - self.last_jobs) / (now - self.last_report)
+            logger.info(
+                "jobs=%d batches=%d errors=%d expired=%d avg_batch=%.2f "
+                "jobs/s=%.2f busy=%.0f%%",
+                self.jobs,
+                self.batches,
+                self.errors,
+                self.expired,
+                self.jobs / self.batches,
+                rate,
+                100 * self.busy / (now - self.started),
+            )
+            logger.info(
+                "ms/job %s",
+                " ".join(
+                    f"{stage}={1000 * seconds / self.jobs:.1f}"
+                    for stage, seconds in self.stages.items()
+                ),
+            )
+            self.last_report = now
+            self.last_jobs = self.jobs
 
 
 def classify_process():
     """
     Loop indefinitely asking Redis for new jobs.
-    When a new job arrives, takes it from the Redis queue, uses the loaded ML
-    model to get predictions and stores the results back in Redis using
-    the original job ID so other services can see it was processed and access
-    the results.
+    When new jobs arrive, takes up to `BATCH_SIZE` of them from the Redis
+    queue, uses the loaded ML model to get predictions for the whole batch
+    at once and stores the results back in Redis using the original job IDs
+    so other services can see they were processed and access the results.
+
+    Jobs go through a staged pipeline: a background thread pulls them from
+    Redis, a pool of `DECODE_WORKERS` threads decodes and preprocesses the
+    images, and up to `PREFETCH_DEPTH` ready jobs wait for this loop, which
+    only runs inference and writes results. The loop only blocks while the
+    queue is empty, so throughput is bounded by the model and not by sleeps
+    or round trips. Similarity searches of "similar" jobs run on a pool of
+    `SEARCH_WORKERS` threads once the job is classified, see
+    `submit_searches`.
     """
+    job_queue = queues.create(db)
+    pool = ThreadPoolExecutor(settings.DECODE_WORKERS, thread_name_prefix="decode")
+    search_pool = ThreadPoolExecutor(
+        settings.SEARCH_WORKERS, thread_name_prefix="search"
+    )
+    search_slots = threading.BoundedSemaphore(settings.SEARCH_BACKLOG)
+    prefetch = queue.Queue(maxsize=settings.PREFETCH_DEPTH)
+    throughput = Throughput(settings.STATS_INTERVAL)
+    threading.Thread(
+        target=prefetch_jobs,
+        args=(job_queue, pool, prefetch, throughput),
+        name="prefetch",
+        daemon=True,
+    ).start()
+
     while True:
-        _, job_json = db.brpop(settings.REDIS_QUEUE)
+        futures = next_batch(prefetch)
 
-        job = json.loads(job_json)
+        start = time.monotonic()
+        prepared = [future.result() for future in futures]
+        ready = time.monotonic()
+        searches = []
+        results = process_batch(prepared, searches)
+        inferred = time.monotonic()
+        refused = submit_searches(searches, search_pool, search_slots, job_queue)
+        results += refused
+        # Jobs waiting for their search are acknowledged with their output
+        searching = {get_job_id(job) for job, _, _ in searches} - dict(refused).keys()
+        jobs = [job for job, _, _ in prepared if get_job_id(job) not in searching]
+        store_results(results, jobs, job_queue)
+        done = time.monotonic()
 
-        job_id = job.get("id") or job.get("job_id")
+        timings = {
+            "read": sum(t["read"] for _, _, t in prepared),
+            "decode": sum(t["decode"] for _, _, t in prepared),
+            "preprocess": sum(t["preprocess"] for _, _, t in prepared),
+            "wait": ready - start,
+            "inference": inferred - ready,
+            "write": done - inferred,
+        }
+        logger.debug(
+            "batch=%d %s",
+            len(prepared),
+            " ".join(f"{k}={1000 * v:.1f}ms" for k, v in timings.items()),
+        )
+        throughput.update(results, done - start, timings)
 
-        image_name = job.get("image_name") or job.get("image_file_name")
+        for stage in ("wait", "inference", "write"):
+            STAGE_SECONDS.observe(timings[stage], stage=stage)
+        BATCH_JOBS.observe(len(prepared))
+        PREFETCHED_JOBS.set(prefetch.qsize())
+        errors = sum(1 for _, out in results if out["prediction"] == "error")
+        JOBS.inc(len(results) - errors, outcome="ok")
+        JOBS.inc(errors, outcome="error")
 
-        try:
-            class_name, pred_probability = predict(image_name)
-            output = {"prediction": class_name, "score": float(pred_probability)}
-        except Exception:
 
-            output = {"prediction": "error", "score": 0.0}
+def configure_process(cpus=None):
+    """
+    Apply per-process CPU settings. Must run before the first TensorFlow op.
+
+    Parameters
+    ----------
+    cpus : list(int), optional
+        CPUs this process is pinned to. When given and no intra-op thread
+        count is configured, TensorFlow uses one thread per pinned CPU.
+    """
+    intra_op = settings.TF_INTRA_OP_THREADS
+    if cpus:
+        os.sched_setaffinity(0, cpus)
+        intra_op = intra_op or len(cpus)
+
+    tf.config.threading.set_intra_op_parallelism_threads(intra_op)
+    tf.config.threading.set_inter_op_parallelism_threads(settings.TF_INTER_OP_THREADS)
+
+
+def run_consumer(index=0, cpus=None):
+    """
+    Entry point of a consumer process: configure it, load and warm up the
+    model and start consuming jobs.
+
+    Parameters
+    ----------
+    index : int
+        Position of the consumer, its metrics are served on
+        `METRICS_PORT + index`.
+    cpus : list(int), optional
+        CPUs to pin the process to.
+    """
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    try:
+        configure_process(cpus)
+        if settings.METRICS_PORT:
+            metrics.start_server(settings.METRICS_PORT + index)
+        start_up()
+        logger.info("Consumer %d ready on CPUs %s", os.getpid(), cpus or "all")
+        classify_process()
+    except Exception:
+        # Reported here, the supervisor only sees the exit code
+        logger.exception("Consumer %d failed", index)
+        raise SystemExit(1)
 
-        db.set(job_id, json.dumps(output))
 
-        time.sleep(settings.SERVER_SLEEP)
+def restart_delay(crashes):
+    """
+    Seconds to wait before restarting a consumer, exponential in the number
+    of crashes in a row so a consumer failing at start up doesn't reload the
+    model in a tight loop.
+
+    Parameters
+    ----------
+    crashes : int
+        Crashes in a row of the consumer, at least 1.
+
+    Returns
+    -------
+    delay : float
+    """
+    delay = settings.RESTART_BACKOFF * 2 ** (crashes - 1)
+    return min(delay, settings.RESTART_BACKOFF_MAX)
+
+
+def cpu_slices(processes):
+    """
+    Split the CPUs available to us into one contiguous slice per process.
+
+    Parameters
+    ----------
+    processes : int
+        Number of consumer processes.
+
+    Returns
+    -------
+    slices : list(list(int))
+        CPUs for each process, or None for every process when affinity is
+        disabled.
+    """
+    if not settings.CPU_AFFINITY:
+        return [None] * processes
+
+    cpus = sorted(os.sched_getaffinity(0))
+    size, extra = divmod(len(cpus), processes)
+    slices, start = [], 0
+    for i in range(processes):
+        end = start + size + (1 if i < extra else 0)
+        slices.append(cpus[start:end] or None)
+        start = end
+    return slices
+
+
+def supervise(processes):
+    """
+    Fork `processes` consumer processes and restart them if they die, after
+    `restart_delay` seconds.
+
+    TensorFlow is not fork-safe once its runtime has started, so a missing
+    model artifact is exported once by a short-lived process and the
+    supervisor forks the consumers with TensorFlow imported but not
+    initialized. The consumers share the imported Python modules
+    copy-on-write and load the weights from the same artifact, instead of
+    each container importing and downloading everything on its own.
+
+    Parameters
+    ----------
+    processes : int
+        Number of consumer processes.
+    """
+    ctx = multiprocessing.get_context("fork")
+
+    if not os.path.exists(settings.MODEL_PATH):
+        exporter = ctx.Process(target=export_model, name="export-model")
+        exporter.start()
+        exporter.join()
+
+    slices = cpu_slices(processes)
+    consumers = {}
+    started = {}
+    crashes = [0] * processes
+    restarts = {}
+
+    def start(i):
+        consumer = ctx.Process(
+            target=run_consumer, args=(i, slices[i]), name=f"consumer-{i}"
+        )
+        consumer.start()
+        consumers[consumer.sentinel] = (i, consumer)
+        started[i] = time.monotonic()
+
+    def stop(signum, frame):
+        for _, consumer in consumers.values():
+            consumer.terminate()
+        raise SystemExit(0)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    for i in range(processes):
+        start(i)
+
+    while True:
+        for i, at in list(restarts.items()):
+            if at <= time.monotonic():
+                del restarts[i]
+                start(i)
+
+        timeout = None
+        if restarts:
+            timeout = max(0.0, min(restarts.values()) - time.monotonic())
+        for sentinel in wait(list(consumers), timeout):
+            i, consumer = consumers.pop(sentinel)
+            consumer.join()
+            uptime = time.monotonic() - started[i]
+            crashes[i] = 1 if uptime >= settings.RESTART_RESET_AFTER else crashes[i] + 1
+            delay = restart_delay(crashes[i])
+            logger.error(
+                "Consumer %s exited with code %s after %.0fs, restarting in %.1fs",
+                consumer.name,
+                consumer.exitcode,
+                uptime,
+                delay,
+            )
+            restarts[i] = time.monotonic() + delay
 
 
 if __name__ == "__main__":
-    print("Launching ML service...")
-    classify_process()
+    parser = argparse.ArgumentParser(description="ML service worker")
+    parser.add_argument(
+        "--export-model",
+        action="store_true",
+        help="save the model artifact to MODEL_PATH and exit",
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s"
+    )
+    if args.export_model:
+        export_model()
+        raise SystemExit(0)
+
+    logger.info("Launching ML service...")
+    if settings.WORKER_PROCESSES > 1:
+        supervise(settings.WORKER_PROCESSES)
+    else:
+        run_consumer()
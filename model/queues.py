@@ -0,0 +1,272 @@
+import json
+import logging
+import os
+import socket
+import time
+
+import redis
+import settings
+
+logger = logging.getLogger(__name__)
+
+
+def lane_quotas(slots, lanes):
+    """
+    Split the free slots of a batch between the priority lanes according to
+    `PRIORITY_WEIGHTS`, higher priority lanes first.
+
+    Parameters
+    ----------
+    slots : int
+        Free slots in the batch.
+    lanes : dict
+        Priority name to queue (or stream) name, highest priority first.
+
+    Returns
+    -------
+    quotas : list(tuple(str, int))
+        (queue name, number of jobs to take) pairs, adding up to `slots` at
+        most.
+    """
+    total = sum(settings.PRIORITY_WEIGHTS.values())
+    quotas = []
+    for priority, name in lanes.items():
+        share = round(slots * settings.PRIORITY_WEIGHTS[priority] / total)
+        quota = min(slots, max(1, share))
+        if quota:
+            quotas.append((name, quota))
+        slots -= quota
+    return quotas
+
+
+class ListQueue:
+    """
+    Jobs pushed with LPUSH on one Redis list per priority lane.
+
+    A job is gone from Redis as soon as it's popped, so jobs of a worker that
+    dies are lost and only the API timeout notices.
+    """
+
+    def __init__(self, db):
+        self.db = db
+        self.lanes = settings.PRIORITY_QUEUES
+
+    def fetch(self):
+        """
+        Wait for a job in any of the priority queues and then drain up to
+        `BATCH_SIZE` jobs, waiting at most `BATCH_MAX_WAIT` seconds for the
+        batch to fill.
+
+        While several lanes have jobs waiting, the batch is shared between
+        them in proportion to `PRIORITY_WEIGHTS`, so bulk work still
+        progresses under interactive load. Idle lanes leave their share to
+        the others.
+
+        Returns
+        -------
+        jobs : list(dict)
+            Decoded job payloads.
+        """
+        queue_names = list(self.lanes.values())
+
+        # BRPOP serves the first non-empty queue, i.e. the highest priority
+        _, job_json = self.db.brpop(queue_names)
+        jobs = [json.loads(job_json)]
+
+        deadline = time.monotonic() + settings.BATCH_MAX_WAIT
+        while len(jobs) < settings.BATCH_SIZE:
+            pipe = self.db.pipeline(transaction=False)
+            for name, quota in lane_quotas(settings.BATCH_SIZE - len(jobs), self.lanes):
+                pipe.rpop(name, quota)
+            pending = [job for popped in pipe.execute() for job in popped or []]
+            if pending:
+                jobs.extend(json.loads(job_json) for job_json in pending)
+                continue
+
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            popped = self.db.brpop(queue_names, timeout=remaining)
+            if popped is None:
+                break
+            jobs.append(json.loads(popped[1]))
+
+        return jobs
+
+    def ack(self, pipe, jobs):
+        """
+        Nothing to acknowledge, popped jobs are already gone.
+        """
+
+
+class StreamQueue:
+    """
+    Jobs added with XADD on one Redis stream per priority lane, read through
+    a consumer group.
+
+    Entries stay pending until the worker acknowledges them together with
+    their results. Entries left pending by a consumer that died are claimed
+    by the others once idle for `STREAM_CLAIM_IDLE_MS`, so no job is lost
+    when a worker crashes.
+    """
+
+    def __init__(self, db, consumer=None):
+        self.db = db
+        self.lanes = settings.PRIORITY_STREAMS
+        self.group = settings.STREAM_GROUP
+        self.consumer = consumer or f"{socket.gethostname()}:{os.getpid()}"
+        self.last_claim = 0.0
+
+        for stream in self.lanes.values():
+            try:
+                # "0" so jobs added before the group existed are served too
+                self.db.xgroup_create(stream, self.group, id="0", mkstream=True)
+            except redis.exceptions.ResponseError as exc:
+                if "BUSYGROUP" not in str(exc):
+                    raise
+
+    @staticmethod
+    def _decode(stream, entries):
+        jobs = []
+        for entry_id, fields in entries:
+            job = json.loads(fields["job"])
+            job["_stream"] = stream
+            job["_entry_id"] = entry_id
+            jobs.append(job)
+        return jobs
+
+    def claim(self):
+        """
+        Take over entries pending for longer than `STREAM_CLAIM_IDLE_MS`,
+        left behind by consumers that died before acknowledging them.
+
+        Returns
+        -------
+        jobs : list(dict)
+            Decoded job payloads.
+        """
+        jobs = []
+        for stream in self.lanes.values():
+            # Follow the cursor, a scan only looks at `count` pending entries
+            cursor = "0-0"
+            while len(jobs) < settings.BATCH_SIZE:
+                cursor, entries, *_ = self.db.xautoclaim(
+                    stream,
+                    self.group,
+                    self.consumer,
+                    settings.STREAM_CLAIM_IDLE_MS,
+                    start_id=cursor,
+                    count=settings.BATCH_SIZE - len(jobs),
+                )
+                # Entries deleted meanwhile come back without fields
+                entries = [(i, fields) for i, fields in entries if fields]
+                jobs.extend(self._decode(stream, entries))
+                if cursor == "0-0":
+                    break
+
+        if jobs:
+            logger.warning("Claimed %d jobs from dead consumers", len(jobs))
+        return jobs
+
+    def fetch(self):
+        """
+        Wait for new entries in any of the priority streams and read up to
+        `BATCH_SIZE` of them, shared between the lanes in proportion to
+        `PRIORITY_WEIGHTS` and waiting at most `BATCH_MAX_WAIT` seconds for
+        the batch to fill. Every `STREAM_CLAIM_INTERVAL` seconds, entries
+        abandoned by dead consumers are served first.
+
+        Returns
+        -------
+        jobs : list(dict)
+            Decoded job payloads, with the stream and entry ID used to
+            acknowledge them.
+        """
+        jobs = []
+        if time.monotonic() - self.last_claim >= settings.STREAM_CLAIM_INTERVAL:
+            self.last_claim = time.monotonic()
+            jobs = self.claim()
+
+        # Block at most until the next claim is due
+        block_ms = int(1000 * settings.STREAM_CLAIM_INTERVAL)
+        while not jobs:
+            response = self.db.xreadgroup(
+                self.group,
+                self.consumer,
+                {stream: ">" for stream in self.lanes.values()},
+                count=1,
+                block=block_ms,
+            )
+            if not response:
+                return []
+            for stream, entries in response:
+                jobs.extend(self._decode(stream, entries))
+
+        deadline = time.monotonic() + settings.BATCH_MAX_WAIT
+        while len(jobs) < settings.BATCH_SIZE:
+            pipe = self.db.pipeline(transaction=False)
+            for name, quota in lane_quotas(settings.BATCH_SIZE - len(jobs), self.lanes):
+                pipe.xreadgroup(self.group, self.consumer, {name: ">"}, count=quota)
+            pending = [
+                job
+                for response in pipe.execute()
+                for stream, entries in response or []
+                for job in self._decode(stream, entries)
+            ]
+            if pending:
+                jobs.extend(pending)
+                continue
+
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            response = self.db.xreadgroup(
+                self.group,
+                self.consumer,
+                {stream: ">" for stream in self.lanes.values()},
+                count=settings.BATCH_SIZE - len(jobs),
+                block=max(1, int(1000 * remaining)),
+            )
+            if not response:
+                break
+            for stream, entries in response:
+                jobs.extend(self._decode(stream, entries))
+
+        return jobs
+
+    def ack(self, pipe, jobs):
+        """
+        Acknowledge and delete the entries of processed jobs.
+
+        Parameters
+        ----------
+        pipe : redis.client.Pipeline
+            Pipeline writing the results, so results and acks are applied
+            together.
+        jobs : list(dict)
+            Jobs as returned by `fetch`.
+        """
+        for job in jobs:
+            if "_entry_id" in job:
+                pipe.xack(job["_stream"], self.group, job["_entry_id"])
+                pipe.xdel(job["_stream"], job["_entry_id"])
+
+
+def create(db):
+    """
+    Create the job queue selected by `QUEUE_TRANSPORT`.
+
+    Parameters
+    ----------
+    db : redis.Redis
+        Client decoding responses to str.
+
+    Returns
+    -------
+    queue : ListQueue or StreamQueue
+    """
+    if settings.QUEUE_TRANSPORT == "stream":
+        return StreamQueue(db)
+    if settings.QUEUE_TRANSPORT == "list":
+        return ListQueue(db)
+    raise ValueError(f"Unknown QUEUE_TRANSPORT {settings.QUEUE_TRANSPORT!r}")
@@ -13,6 +13,118 @@ REDIS_PORT = 6379
 REDIS_DB_ID = 0
 # Host IP
 REDIS_IP = os.getenv("REDIS_IP", "redis")
-# Sleep parameters which manages the
-# interval between requests to our redis queue
-SERVER_SLEEP = 0.05
+# Priority lanes, highest priority first, each one with its own queue
+PRIORITY_QUEUES = {"interactive": REDIS_QUEUE, "bulk": f"{REDIS_QUEUE}:bulk"}
+# Share of every batch each lane gets while several of them have jobs waiting
+PRIORITY_WEIGHTS = {
+    "interactive": int(os.getenv("INTERACTIVE_WEIGHT", 4)),
+    "bulk": int(os.getenv("BULK_WEIGHT", 1)),
+}
+# Job transport: "list" (LPUSH/BRPOP, a job popped by a worker that dies is
+# lost) or "stream" (consumer group, jobs stay pending until acknowledged)
+QUEUE_TRANSPORT = os.getenv("QUEUE_TRANSPORT", "list")
+# Streams of the priority lanes and the consumer group all workers join
+PRIORITY_STREAMS = {"interactive": "service_stream", "bulk": "service_stream:bulk"}
+STREAM_GROUP = "ml_service"
+# Pending entries idle for this long belong to a dead consumer and are
+# claimed by the others, checked every STREAM_CLAIM_INTERVAL seconds
+STREAM_CLAIM_IDLE_MS = int(os.getenv("STREAM_CLAIM_IDLE_MS", 30000))
+STREAM_CLAIM_INTERVAL = float(os.getenv("STREAM_CLAIM_INTERVAL", 5))
+# Prefetch pipeline
+# Threads decoding and preprocessing images while the model runs
+DECODE_WORKERS = int(os.getenv("DECODE_WORKERS", 4))
+# Maximum number of jobs taken from Redis and waiting for inference
+PREFETCH_DEPTH = int(os.getenv("PREFETCH_DEPTH", 32))
+
+# Seconds job outputs are kept under their job ID, in case the API missed
+# the notification published on the job "reply_to" channel. Jobs submitted
+# through the asynchronous API carry their own "result_ttl"
+RESULT_TTL = int(os.getenv("RESULT_TTL", 300))
+# Counter of the jobs taken off the queues by every consumer, answered or
+# dropped, for the API admission control
+PROCESSED_KEY = "ml_service:processed"
+
+# Pre-fork supervisor
+# Number of consumer processes, each one runs its own copy of the model
+WORKER_PROCESSES = int(os.getenv("WORKER_PROCESSES", 1))
+# Seconds before restarting a dead consumer, doubled after each crash up to
+# RESTART_BACKOFF_MAX. Consumers that ran RESTART_RESET_AFTER seconds start
+# over from RESTART_BACKOFF
+RESTART_BACKOFF = float(os.getenv("RESTART_BACKOFF", 1))
+RESTART_BACKOFF_MAX = float(os.getenv("RESTART_BACKOFF_MAX", 60))
+RESTART_RESET_AFTER = float(os.getenv("RESTART_RESET_AFTER", 60))
+# TensorFlow thread pools of each process, 0 lets TensorFlow decide
+TF_INTRA_OP_THREADS = int(os.getenv("TF_INTRA_OP_THREADS", 0))
+TF_INTER_OP_THREADS = int(os.getenv("TF_INTER_OP_THREADS", 0))
+# Pin each consumer process to its own slice of the available CPUs
+CPU_AFFINITY = os.getenv("CPU_AFFINITY", "0") == "1"
+
+# Port of the Prometheus metrics endpoint (GET /metrics), consumer i of the
+# supervisor listens on METRICS_PORT + i. 0 disables it
+METRICS_PORT = int(os.getenv("METRICS_PORT", 9100))
+
+# Seconds between two throughput reports of the worker loop
+STATS_INTERVAL = float(os.getenv("STATS_INTERVAL", 30))
+
+# Image decoding
+# Decode JPEGs at reduced resolution (DCT scaling) close to the model input
+FAST_DECODE = os.getenv("FAST_DECODE", "1") == "1"
+# Smallest side of a reduced-resolution decode. Twice the model input keeps
+# the nearest neighbour resize close to the one of a full decode, images
+# smaller than 2x this are decoded at full resolution
+DECODE_MIN_SIZE = int(os.getenv("DECODE_MIN_SIZE", 448))
+# Images declaring more pixels than this in their header are rejected before
+# being decoded, 40 MP fits any phone camera
+MAX_IMAGE_PIXELS = int(os.getenv("MAX_IMAGE_PIXELS", 40_000_000))
+
+# Embedding store
+# Keep the pooled 2048-d embedding of every classified image, needed by the
+# similar-image search. Only the keras backend produces embeddings
+EMBEDDINGS = os.getenv("EMBEDDINGS", "1") == "1"
+# Folder of the store, shared by every worker process
+EMBEDDINGS_PATH = os.getenv("EMBEDDINGS_PATH", "embedding_store")
+# Rows scored at once by the similarity search, 8192 rows take 64 MB
+SEARCH_BLOCK_ROWS = int(os.getenv("SEARCH_BLOCK_ROWS", 8192))
+# Threads running the similarity searches, off the inference loop
+SEARCH_WORKERS = int(os.getenv("SEARCH_WORKERS", 1))
+# Searches waiting or running at most, "similar" jobs past it are answered
+# with an error. A search of a large store takes seconds, keep it within
+# what SEARCH_WORKERS go through before the API gives up on a job
+SEARCH_BACKLOG = int(os.getenv("SEARCH_BACKLOG", 16))
+
+# Pre-serialized model, bundled at image build time with
+# `python3 ml_service.py --export-model`
+MODEL_PATH = os.getenv("MODEL_PATH", "artifacts/resnet50.h5")
+# Imagenet class names, bundled next to the model artifact
+LABELS_PATH = os.getenv("LABELS_PATH", "artifacts/imagenet_class_index.json")
+LABELS_URL = (
+    "https://storage.googleapis.com/download.tensorflow.org/data/"
+    "imagenet_class_index.json"
+)
+LABELS_HASH = "c2c37ea517e94d9795004a39431a14cb"
+# Inference backend: "keras", "tflite" or "onnx" (needs onnxruntime). The
+# TFLite and ONNX artifacts are produced with `python3 convert_model.py`
+INFERENCE_BACKEND = os.getenv("INFERENCE_BACKEND", "keras")
+# Use the int8-quantized variant of the TFLite/ONNX artifact
+INFERENCE_INT8 = os.getenv("INFERENCE_INT8", "0") == "1"
+TFLITE_PATH = os.getenv("TFLITE_PATH", "artifacts/resnet50.tflite")
+TFLITE_INT8_PATH = os.getenv("TFLITE_INT8_PATH", "artifacts/resnet50_int8.tflite")
+ONNX_PATH = os.getenv("ONNX_PATH", "artifacts/resnet50.onnx")
+ONNX_INT8_PATH = os.getenv("ONNX_INT8_PATH", "artifacts/resnet50_int8.onnx")
+# Dummy predictions run before consuming jobs, to trace the model graph
+WARMUP_ROUNDS = int(os.getenv("WARMUP_ROUNDS", 1))
+# Readiness keys, "<READY_KEY>:<host>:<pid>", refreshed while the consumer is
+# alive and expiring READY_TTL seconds after it stops
+READY_KEY = "ml_service:ready"
+READY_TTL = int(os.getenv("READY_TTL", 30))
+
+# Version of the served model, published under MODEL_VERSION_KEY so the API
+# never serves cached predictions of another model
+MODEL_VERSION = os.getenv("MODEL_VERSION", "resnet50-imagenet")
+MODEL_VERSION_KEY = "model_version"
+
+# Micro-batching
+# Maximum number of jobs stacked into a single model.predict call
+BATCH_SIZE = int(os.getenv("BATCH_SIZE", 8))
+# Seconds to keep waiting for more jobs once the first one of a batch arrived
+BATCH_MAX_WAIT = float(os.getenv("BATCH_MAX_WAIT", 0.01))
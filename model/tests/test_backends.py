@@ -0,0 +1,26 @@
+import unittest
+
+import backends
+import ml_service
+import numpy as np
+
+
+class TestBackends(unittest.TestCase):
+    def test_artifact_path(self):
+        self.assertEqual(
+            backends.artifact_path("tflite", int8=True),
+            backends.settings.TFLITE_INT8_PATH,
+        )
+        with self.assertRaises(ValueError):
+            backends.artifact_path("torch")
+
+    def test_keras_backend_matches_predict(self):
+        model = ml_service.load_model()
+        x = np.random.RandomState(0).uniform(-100, 100, (2, 224, 224, 3))
+        probs = backends.KerasBackend(model).predict(x.astype("float32"))
+        self.assertEqual(probs.shape, (2, 1000))
+        np.testing.assert_allclose(probs, model.predict(x), atol=1e-5)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,40 @@
+import json
+import os
+import tempfile
+import unittest
+
+import bulk_classify
+
+
+class TestBulkClassify(unittest.TestCase):
+    def test_list_images_manifest(self):
+        with tempfile.TemporaryDirectory() as folder:
+            manifest = os.path.join(folder, "manifest.txt")
+            with open(manifest, "w") as f:
+                f.write("# backfill\na.jpeg\n\n/data/b.png\n")
+            self.assertEqual(
+                bulk_classify.list_images(manifest),
+                [os.path.join(folder, "a.jpeg"), "/data/b.png"],
+            )
+            self.assertEqual(bulk_classify.list_images(folder), [])
+
+    def test_load_checkpoint(self):
+        records = [
+            {"path": "a.jpeg", "md5": "aaa", "prediction": "cat", "score": 0.9},
+            {"path": "b.jpeg", "prediction": "error", "score": 0.0, "error": "x"},
+        ]
+        with tempfile.TemporaryDirectory() as folder:
+            output = os.path.join(folder, "predictions.jsonl")
+            with open(output, "w") as f:
+                f.writelines(json.dumps(record) + "\n" for record in records)
+                # Killed mid-write
+                f.write('{"path": "c.jpeg", "md5"')
+
+            done, known = bulk_classify.load_checkpoint(output)
+
+        self.assertEqual(done, {"a.jpeg"})
+        self.assertEqual(known, {"aaa": {"prediction": "cat", "score": 0.9}})
+
+
+if __name__ == "__main__":
+    unittest.main()
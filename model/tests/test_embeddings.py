@@ -0,0 +1,41 @@
+import tempfile
+import unittest
+
+import embeddings
+import numpy as np
+
+
+class TestEmbeddingStore(unittest.TestCase):
+    def test_add_and_search(self):
+        rng = np.random.default_rng(0)
+        vectors = rng.normal(size=(50, 16)).astype(np.float32)
+        ids = [f"hash{i}" for i in range(50)]
+
+        with tempfile.TemporaryDirectory() as folder:
+            store = embeddings.EmbeddingStore(folder, dim=16)
+            self.assertEqual(store.add(ids[:30], vectors[:30]), 30)
+            # Known IDs are skipped
+            self.assertEqual(store.add(ids[20:], vectors[20:]), 20)
+            self.assertEqual(len(store), 50)
+
+            # Search in blocks smaller than the store, like brute force
+            neighbours = store.search(vectors[7], 3, exclude={"hash7"}, block_rows=8)
+            normalized = embeddings.normalize(vectors).astype(np.float16)
+            scores = (
+                normalized.astype(np.float32) @ embeddings.normalize(vectors[7:8])[0]
+            )
+            scores[7] = -np.inf
+            expected = [ids[i] for i in np.argsort(-scores)[:3]]
+            self.assertEqual([id_ for id_, _ in neighbours], expected)
+
+            # Another process opening the store sees the same rows
+            other = embeddings.EmbeddingStore(folder, dim=16)
+            self.assertIn("hash42", other)
+            np.testing.assert_allclose(
+                other.get("hash42"), normalized[42].astype(np.float32)
+            )
+            self.assertIsNone(other.get("missing"))
+
+
+if __name__ == "__main__":
+    unittest.main()
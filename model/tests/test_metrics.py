@@ -0,0 +1,30 @@
+import unittest
+
+import metrics
+
+
+class TestMetrics(unittest.TestCase):
+    def test_counter_and_histogram_render(self):
+        counter = metrics.Counter("test_jobs_total", "Jobs", ["outcome"])
+        counter.inc(outcome="ok")
+        counter.inc(2, outcome="ok")
+        histogram = metrics.Histogram("test_seconds", "Time", buckets=(0.1, 1.0))
+        histogram.observe(0.05)
+        histogram.observe(5.0)
+
+        text = metrics.render()
+        self.assertIn("# TYPE test_jobs_total counter", text)
+        self.assertIn('test_jobs_total{outcome="ok"} 3', text)
+        self.assertIn('test_seconds_bucket{le="0.1"} 1', text)
+        self.assertIn('test_seconds_bucket{le="1.0"} 1', text)
+        self.assertIn('test_seconds_bucket{le="+Inf"} 2', text)
+        self.assertIn("test_seconds_count 2", text)
+
+    def test_wrong_labels(self):
+        counter = metrics.Counter("test_errors_total", "Errors", ["type"])
+        with self.assertRaises(ValueError):
+            counter.inc(stage="load")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,6 +1,10 @@
+import io
 import unittest
+from unittest import mock
 
 import ml_service
+import numpy as np
+from PIL import Image
 
 
 class TestMLService(unittest.TestCase):
@@ -10,6 +14,187 @@ class TestMLService(unittest.TestCase):
         self.assertEqual(class_name, "Eskimo_dog")
         self.assertAlmostEqual(pred_probability, 0.9346, 5)
 
+    def test_load_image_from_bytes(self):
+        ml_service.settings.UPLOAD_FOLDER = "tests"
+        with open("tests/dog.jpeg", "rb") as f:
+            data = f.read()
+        np.testing.assert_array_equal(
+            ml_service.load_image("dog.jpeg", data), ml_service.load_image("dog.jpeg")
+        )
+
+    def test_load_image_rejects_oversized(self):
+        ml_service.settings.UPLOAD_FOLDER = "tests"
+        limit = ml_service.settings.MAX_IMAGE_PIXELS
+        ml_service.settings.MAX_IMAGE_PIXELS = 100 * 100
+        try:
+            with self.assertRaises(ValueError):
+                ml_service.load_image("dog.jpeg")
+        finally:
+            ml_service.settings.MAX_IMAGE_PIXELS = limit
+
+    def test_load_image_fast_decode(self):
+        # A large JPEG goes through draft mode, pixels stay close to a full
+        # resolution decode
+        with Image.open("tests/dog.jpeg") as img:
+            img = img.resize((2916, 1944), Image.BICUBIC)
+        buffer = io.BytesIO()
+        img.save(buffer, format="JPEG", quality=90)
+
+        ml_service.settings.FAST_DECODE = True
+        fast = ml_service.load_image("large.jpeg", buffer.getvalue())
+        ml_service.settings.FAST_DECODE = False
+        full = ml_service.load_image("large.jpeg", buffer.getvalue())
+        ml_service.settings.FAST_DECODE = True
+
+        self.assertEqual(fast.shape, (224, 224, 3))
+        self.assertLess(np.abs(fast - full).mean(), 10)
+
+    def test_predict_batch(self):
+        ml_service.settings.UPLOAD_FOLDER = "tests"
+        x = ml_service.load_image("dog.jpeg")
+        predictions = ml_service.predict_batch([x, x, x])
+        self.assertEqual(len(predictions), 3)
+        for class_name, pred_probability in predictions:
+            self.assertEqual(class_name, "Eskimo_dog")
+            self.assertAlmostEqual(pred_probability, 0.9346, 4)
+
+    def test_process_batch(self):
+        ml_service.settings.UPLOAD_FOLDER = "tests"
+        prepared = [
+            ml_service.prepare({"id": "1", "image_name": "dog.jpeg"}),
+            ml_service.prepare({"id": "2", "image_name": "missing.jpeg"}),
+        ]
+        results = dict(ml_service.process_batch(prepared))
+        self.assertEqual(results["1"]["prediction"], "Eskimo_dog")
+        self.assertEqual(results["2"], {"prediction": "error", "score": 0.0})
+
+    def test_process_batch_top_k(self):
+        ml_service.settings.UPLOAD_FOLDER = "tests"
+        prepared = [
+            ml_service.prepare({"id": "1", "image_name": "dog.jpeg", "top_k": 3}),
+            ml_service.prepare({"id": "2", "image_name": "dog.jpeg"}),
+        ]
+        results = dict(ml_service.process_batch(prepared))
+        top_k = results["1"]["top_k"]
+        self.assertEqual(len(top_k), 3)
+        self.assertEqual(top_k[0], ("Eskimo_dog", results["1"]["score"]))
+        self.assertEqual([s for _, s in top_k], sorted([s for _, s in top_k])[::-1])
+        self.assertNotIn("top_k", results["2"])
+
+    def test_process_batch_defers_searches(self):
+        jobs = [
+            {"id": "1", "image_name": "a.jpeg", "task": "similar", "k": 2},
+            {"id": "2", "image_name": "b.jpeg"},
+        ]
+        prepared = [(job, np.zeros((224, 224, 3)), {}) for job in jobs]
+        vectors = np.ones((2, 2048))
+        with mock.patch.multiple(
+            ml_service,
+            run_model=mock.Mock(return_value=(None, vectors)),
+            decode=mock.Mock(return_value=[[("cat", 0.9)]] * 2),
+            load_embedding_store=mock.Mock(),
+            find_similar=mock.Mock(return_value=[("c", 0.8)]),
+        ):
+            searches = []
+            results = ml_service.process_batch(prepared, searches)
+            # Classified, but not searched on the inference loop
+            self.assertEqual(results, [("2", {"prediction": "cat", "score": 0.9})])
+            ml_service.find_similar.assert_not_called()
+            self.assertEqual(len(searches), 1)
+            job, output, vector = searches[0]
+            self.assertIs(job, jobs[0])
+
+            job_queue = mock.MagicMock()
+            with mock.patch.object(ml_service, "store_results") as store_results:
+                ml_service.search_job(job, output, vector, job_queue)
+            store_results.assert_called_once_with(
+                [("1", {"prediction": "cat", "score": 0.9, "similar": [("c", 0.8)]})],
+                [job],
+                job_queue,
+            )
+
+    def test_search_backlog_is_bounded(self):
+        output = {"prediction": "cat", "score": 0.9}
+        searches = [({"id": str(i)}, output, None) for i in range(3)]
+        search_pool = mock.MagicMock()
+        slots = ml_service.threading.BoundedSemaphore(2)
+        job_queue = mock.MagicMock()
+
+        refused = ml_service.submit_searches(searches, search_pool, slots, job_queue)
+        self.assertEqual(refused, [("2", {"prediction": "error", "score": 0.0})])
+        self.assertEqual(search_pool.submit.call_count, 2)
+
+        # A finished search frees its slot
+        done = search_pool.submit.return_value.add_done_callback.call_args[0][0]
+        done(None)
+        refused = ml_service.submit_searches(
+            searches[2:], search_pool, slots, job_queue
+        )
+        self.assertEqual(refused, [])
+
+    def test_search_job_skips_expired(self):
+        job = {"id": "1", "image_name": "a.jpeg", "deadline": 1}
+        job_queue = mock.MagicMock()
+        with mock.patch.multiple(
+            ml_service, find_similar=mock.DEFAULT, store_results=mock.DEFAULT
+        ) as mocks:
+            ml_service.search_job(job, {"prediction": "cat"}, None, job_queue)
+
+        mocks["find_similar"].assert_not_called()
+        # Acknowledged without an output, nobody is waiting for it
+        mocks["store_results"].assert_called_once_with([], [job], job_queue)
+
+    def test_prepare_from_tensor(self):
+        # Pixels decoded by the API skip reading and decoding the image
+        ml_service.settings.UPLOAD_FOLDER = "tests"
+        img = ml_service.load_image("dog.jpeg")
+        tensor = img.astype(np.uint8).tobytes()
+        job = {"id": "1", "image_name": "missing.jpeg", "tensor_key": "tensor:1"}
+        with mock.patch.object(ml_service.raw_db, "get", return_value=tensor):
+            _, x, _ = ml_service.prepare(job)
+        np.testing.assert_array_equal(x, ml_service.preprocess_input(img.copy()))
+
+        # Expired pixels: back to the image
+        job["image_name"] = "dog.jpeg"
+        with mock.patch.object(ml_service.raw_db, "get", return_value=None):
+            _, x, _ = ml_service.prepare(job)
+        np.testing.assert_array_equal(x, ml_service.preprocess_input(img.copy()))
+
+    def test_prefetch_jobs_survives_errors(self):
+        class Stop(BaseException):
+            pass
+
+        job = {"id": "1", "image_name": "dog.jpeg"}
+        job_queue = mock.MagicMock()
+        job_queue.fetch.side_effect = [ValueError("bad payload"), [job], Stop()]
+        pool = mock.MagicMock()
+        prefetch = mock.MagicMock()
+
+        with mock.patch.object(ml_service.time, "sleep"):
+            with self.assertRaises(Stop):
+                ml_service.prefetch_jobs(
+                    job_queue, pool, prefetch, ml_service.Throughput(30)
+                )
+
+        pool.submit.assert_called_once_with(ml_service.prepare, job)
+        prefetch.put.assert_called_once_with(pool.submit.return_value)
+
+    def test_restart_delay(self):
+        with mock.patch.multiple(
+            ml_service.settings, RESTART_BACKOFF=1, RESTART_BACKOFF_MAX=60
+        ):
+            delays = [ml_service.restart_delay(n) for n in range(1, 9)]
+        self.assertEqual(delays, [1, 2, 4, 8, 16, 32, 60, 60])
+
+    def test_cpu_slices(self):
+        ml_service.settings.CPU_AFFINITY = False
+        self.assertEqual(ml_service.cpu_slices(2), [None, None])
+
+        ml_service.settings.CPU_AFFINITY = True
+        slices = ml_service.cpu_slices(1)
+        self.assertEqual(slices, [sorted(ml_service.os.sched_getaffinity(0))])
+        ml_service.settings.CPU_AFFINITY = False
+
 
 if __name__ == "__main__":
     unittest.main()
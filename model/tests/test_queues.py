@@ -0,0 +1,84 @@
+import json
+import os
+import tempfile
+import unittest
+from unittest import mock
+from unittest.mock import MagicMock
+
+import queues
+import settings
+
+try:
+    import redislite
+except ImportError:
+    redislite = None
+
+
+class TestQueues(unittest.TestCase):
+    def test_lane_quotas(self):
+        quotas = queues.lane_quotas(5, settings.PRIORITY_QUEUES)
+        self.assertEqual(quotas, [("service_queue", 4), ("service_queue:bulk", 1)])
+        # A single free slot still goes to the highest priority lane
+        self.assertEqual(queues.lane_quotas(1, settings.PRIORITY_QUEUES)[0][1], 1)
+
+    def test_stream_ack(self):
+        db = MagicMock()
+        job_queue = queues.StreamQueue(db, consumer="test")
+        self.assertEqual(db.xgroup_create.call_count, len(settings.PRIORITY_STREAMS))
+
+        pipe = MagicMock()
+        job = {"id": "1", "_stream": "service_stream", "_entry_id": "1-0"}
+        job_queue.ack(pipe, [job])
+        pipe.xack.assert_called_once_with("service_stream", "ml_service", "1-0")
+        pipe.xdel.assert_called_once_with("service_stream", "1-0")
+
+
+@unittest.skipIf(redislite is None, "needs redislite for a real Redis server")
+class TestStreamQueue(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.db = redislite.Redis(
+            os.path.join(self.tmp.name, "redis.db"), decode_responses=True
+        )
+        patcher = mock.patch.multiple(
+            settings, BATCH_MAX_WAIT=0.01, STREAM_CLAIM_INTERVAL=0.1
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        self.db.shutdown(nosave=True)
+        self.tmp.cleanup()
+
+    def push(self, job_id):
+        job = json.dumps({"id": job_id, "image_name": f"{job_id}.jpeg"})
+        self.db.xadd(settings.PRIORITY_STREAMS["interactive"], {"job": job})
+
+    def test_claim_nothing_pending(self):
+        job_queue = queues.StreamQueue(self.db, consumer="alive")
+        self.assertEqual(job_queue.claim(), [])
+
+    def test_fetch_claims_jobs_of_dead_consumer(self):
+        dead = queues.StreamQueue(self.db, consumer="dead")
+        alive = queues.StreamQueue(self.db, consumer="alive")
+        for job_id in ("1", "2"):
+            self.push(job_id)
+
+        # Read but never acknowledged
+        self.assertEqual([job["id"] for job in dead.fetch()], ["1", "2"])
+        self.assertEqual(alive.claim(), [])
+
+        with mock.patch.object(settings, "STREAM_CLAIM_IDLE_MS", 0):
+            jobs = alive.fetch()
+        self.assertEqual([job["id"] for job in jobs], ["1", "2"])
+
+        pipe = self.db.pipeline()
+        alive.ack(pipe, jobs)
+        pipe.execute()
+        stream = settings.PRIORITY_STREAMS["interactive"]
+        self.assertEqual(self.db.xpending(stream, settings.STREAM_GROUP)["pending"], 0)
+        self.assertEqual(self.db.xlen(stream), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()